@@ -3,9 +3,11 @@ import os
 import subprocess
 from datetime import datetime
 
-from aiogram.types import BufferedInputFile
+from bot_api import capabilities, input_file
 from config import ADMIN_ID, DB_NAME, DB_PASSWORD, DB_USER, BACK_DIR
 
+BACKUP_UPLOAD_TIMEOUT = 600
+
 
 async def backup_database():
     """
@@ -13,7 +15,9 @@ async def backup_database():
 
     Функция выполняет следующие шаги:
     1. Создает резервную копию базы данных с помощью утилиты pg_dump и сохраняет файл в указанной директории.
-    2. Отправляет созданный файл резервной копии администратору в Telegram.
+    2. Отправляет созданный файл резервной копии администратору в Telegram. Файл не читается в память:
+       собственному серверу Bot API в режиме --local передается путь к файлу, иначе файл отправляется
+       потоком. Файл больше лимита сервера (50 МБ для api.telegram.org) не отправляется и остается в BACKUP_DIR.
     3. Удаляет старые резервные копии из директории, которые были созданы более 7 дней назад.
 
     Используемые переменные:
@@ -52,10 +56,13 @@ async def backup_database():
         return
 
     try:
-        with open(BACKUP_FILE, 'rb') as backup_file:
-            backup_input_file = BufferedInputFile(backup_file.read(), filename=os.path.basename(BACKUP_FILE))
-            await bot.send_document(ADMIN_ID, backup_input_file)
-        logging.info(f"Бэкап базы данных отправлен админу: {ADMIN_ID}")
+        size = os.path.getsize(BACKUP_FILE)
+        if size > capabilities.upload_limit:
+            logging.error(f"Бэкап {BACKUP_FILE} ({size // (1024 * 1024)} МБ) больше лимита сервера Bot API "
+                          f"({capabilities.upload_limit // (1024 * 1024)} МБ) и не отправлен в Telegram.")
+        else:
+            await bot.send_document(ADMIN_ID, input_file(BACKUP_FILE), request_timeout=BACKUP_UPLOAD_TIMEOUT)
+            logging.info(f"Бэкап базы данных отправлен админу: {ADMIN_ID}")
     except Exception as e:
         logging.error(f"Ошибка при отправке бэкапа в Telegram: {e}")
 
@@ -0,0 +1,66 @@
+"""
+Сравнение маршрутизации нажатий на кнопки: CallbackRouter.resolve против прежней цепочки
+фильтров aiogram вида lambda c: c.data.startswith('action|').
+
+Цепочка проверяет фильтры по порядку до первого совпадения, поэтому ее стоимость растет
+с количеством обработчиков. resolve находит обработчик по имени действия в словаре.
+
+Запуск из корня репозитория:
+    python benchmarks/callback_routing.py
+"""
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callback_router import CallbackRouter, pack_callback  # noqa: E402
+
+NUMBERS = (10, 1000)
+REPEAT = 5
+CLIENT_ID = 'AAECAwQFBgcICQoLDA0ODw'
+
+
+def build_router(count: int) -> CallbackRouter:
+    router = CallbackRouter(name=f'bench_{count}')
+    for i in range(count):
+        router.action(f'action_{i}')(lambda callback_query: None)
+    return router
+
+
+def build_chain(count: int) -> list:
+    # Как в прежних обработчиках: фильтр замыкает свой префикс через аргумент по умолчанию.
+    return [(lambda c, prefix=f'action_{i}|': c.data.startswith(prefix), f'action_{i}') for i in range(count)]
+
+
+def resolve_chain(chain: list, callback_query):
+    for check, handler in chain:
+        if check(callback_query):
+            return handler
+    return None
+
+
+def best(stmt, number: int) -> float:
+    """Лучшее время одного вызова в микросекундах."""
+    return min(timeit.repeat(stmt, number=number, repeat=REPEAT)) / number * 1e6
+
+
+def main():
+    print(f"{'действий':>9} {'кнопка':>10} {'resolve, мкс':>13} {'цепочка, мкс':>13} {'ускорение':>10}")
+    for count in NUMBERS:
+        router = build_router(count)
+        chain = build_chain(count)
+        number = max(1000, 200000 // count)
+        for position, index in (('первая', 0), ('средняя', count // 2), ('последняя', count - 1)):
+            data = pack_callback(f'action_{index}', CLIENT_ID)
+            callback_query = SimpleNamespace(data=data)
+            assert router.resolve(data)[0].action == resolve_chain(chain, callback_query)
+
+            router_time = best(lambda: router.resolve(data), number)
+            chain_time = best(lambda: resolve_chain(chain, callback_query), number)
+            print(f"{count:>9} {position:>10} {router_time:>13.2f} {chain_time:>13.2f} {chain_time / router_time:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
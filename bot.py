@@ -1,18 +1,28 @@
 from aiogram import Bot, Dispatcher, Router
-from aiogram.fsm.storage.memory import MemoryStorage
 
+from bot_api import create_session
 from config import API_TOKEN
+from flood_control import FloodControlMiddleware
+from fsm_storage import create_storage
+from throttling import ThrottlingMiddleware
 
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+bot = Bot(token=API_TOKEN, session=create_session())
+bot.session.middleware(FloodControlMiddleware())
+storage = create_storage()
 dp = Dispatcher(bot=bot, storage=storage)
 router = Router()
 
+throttling = ThrottlingMiddleware()
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+
 from handlers.admin import admin, admin_panel, user_editor
 from handlers.keys import key_management, keys
 from handlers import (notifications, pay,
                       profile, start, commands)
+from callback_router import callbacks
 
+dp.include_router(callbacks.router)
 dp.include_router(admin.router)
 dp.include_router(admin_panel.router)
 dp.include_router(user_editor.router)
@@ -23,3 +33,4 @@ dp.include_router(keys.router)
 dp.include_router(key_management.router)
 dp.include_router(pay.router)
 dp.include_router(notifications.router)
+dp.include_router(commands.fallback_router)
@@ -0,0 +1,116 @@
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import asyncpg
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import FSInputFile
+
+import config
+from config import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_SERVER = getattr(config, 'TELEGRAM_API_SERVER', None)
+TELEGRAM_API_LOCAL = getattr(config, 'TELEGRAM_API_LOCAL', True)
+
+PUBLIC_UPLOAD_LIMIT = 50 * 1024 * 1024
+LOCAL_UPLOAD_LIMIT = 2000 * 1024 * 1024
+
+
+class ApiCapabilities:
+    """
+    Возможности сервера Bot API, к которому подключен бот.
+
+    local_files - сервер запущен с --local и сам читает файлы по пути, указанному в запросе,
+    поэтому файл не передается через HTTP. upload_limit - максимальный размер отправляемого файла.
+    """
+
+    __slots__ = ('local_files', 'upload_limit')
+
+    def __init__(self, local_files: bool = False, upload_limit: int = PUBLIC_UPLOAD_LIMIT):
+        self.local_files = local_files
+        self.upload_limit = upload_limit
+
+
+capabilities = ApiCapabilities()
+
+
+def create_session() -> Optional[AiohttpSession]:
+    """
+    Создает сессию для собственного сервера Bot API из настройки TELEGRAM_API_SERVER.
+
+    :return: Сессия или None, если бот работает через api.telegram.org.
+    """
+    if not TELEGRAM_API_SERVER:
+        return None
+    return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER, is_local=TELEGRAM_API_LOCAL))
+
+
+async def _probe_local_files(bot: Bot) -> Optional[bool]:
+    """
+    Проверяет, отдает ли сервер пути к файлам на своем диске: так getFile отвечает только
+    сервер, запущенный с --local. Для проверки берется любое уже загруженное изображение.
+    """
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        file_id = await conn.fetchval('SELECT file_id FROM media_cache LIMIT 1')
+    finally:
+        await conn.close()
+    if not file_id:
+        return None
+    file = await bot.get_file(file_id)
+    return bool(file.file_path) and os.path.isabs(file.file_path)
+
+
+async def detect_capabilities(bot: Bot):
+    """
+    Определяет возможности сервера Bot API при старте.
+
+    Для api.telegram.org файлы передаются потоком, не больше 50 МБ. Для собственного сервера
+    проверяется, что он отвечает, и, если в TELEGRAM_API_LOCAL указан режим --local, что
+    сервер действительно в нем работает. Тогда файлы до 2000 МБ отправляются по локальному пути.
+
+    :param bot: Объект бота.
+    """
+    if not TELEGRAM_API_SERVER:
+        return
+
+    try:
+        await bot.get_me()
+    except Exception as e:
+        logger.error(f"Сервер Bot API {TELEGRAM_API_SERVER} не отвечает: {e}")
+        return
+
+    local_files = bot.session.api.is_local
+    if local_files:
+        try:
+            probed = await _probe_local_files(bot)
+        except Exception as e:
+            logger.warning(f"Не удалось проверить режим --local сервера Bot API: {e}")
+            probed = None
+        if probed is False:
+            logger.warning(f"Сервер Bot API {TELEGRAM_API_SERVER} работает не в режиме --local, "
+                           f"файлы будут передаваться потоком.")
+            local_files = False
+
+    capabilities.local_files = local_files
+    capabilities.upload_limit = LOCAL_UPLOAD_LIMIT if local_files else PUBLIC_UPLOAD_LIMIT
+    logger.info(f"Сервер Bot API {TELEGRAM_API_SERVER}: отправка файлов "
+                f"{'по локальному пути' if local_files else 'потоком'}, "
+                f"лимит {capabilities.upload_limit // (1024 * 1024)} МБ.")
+
+
+def input_file(path: str) -> Union[str, FSInputFile]:
+    """
+    Возвращает файл для отправки: путь file:// для сервера в режиме --local (сервер читает файл
+    сам, бот его не читает) или FSInputFile, который передается потоком по частям.
+
+    :param path: Путь к файлу. Для режима --local сервер должен видеть файл по тому же пути.
+    """
+    if capabilities.local_files:
+        return Path(path).resolve().as_uri()
+    return FSInputFile(path)
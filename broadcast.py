@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import time
+
+import asyncpg
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+from callback_router import pack_callback
+from config import DATABASE_URL
+from flood_control import mark_bulk
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_RATE = getattr(config, 'BROADCAST_RATE', 25)
+BROADCAST_CONCURRENCY = getattr(config, 'BROADCAST_CONCURRENCY', 10)
+BROADCAST_CHUNK_SIZE = getattr(config, 'BROADCAST_CHUNK_SIZE', 200)
+BROADCAST_PROGRESS_INTERVAL = getattr(config, 'BROADCAST_PROGRESS_INTERVAL', 5)
+BROADCAST_POLL_INTERVAL = 5
+
+# Получатели рассылки; запрос должен возвращать колонку tg_id
+AUDIENCES = {
+    'all': 'SELECT tg_id FROM connections',
+    'trial': 'SELECT tg_id FROM connections WHERE trial = 0',
+}
+
+_wakeup = asyncio.Event()
+
+
+class RateLimiter:
+    """
+    Простой token bucket: не больше rate отправок в секунду на весь процесс рассылки.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def create_broadcast(admin_chat_id: int, audience: str, from_chat_id: int = None,
+                           message_id: int = None, text: str = None) -> int:
+    """
+    Создает задание рассылки. Рассылку выполняет broadcast_supervisor на реплике-лидере.
+
+    Сообщение задается либо исходным сообщением (from_chat_id, message_id), которое будет
+    скопировано каждому получателю без повторной загрузки медиа, либо текстом.
+
+    :param admin_chat_id: Чат администратора, куда публикуется прогресс.
+    :param audience: Ключ из AUDIENCES.
+    :param from_chat_id: (необязательно) Чат исходного сообщения.
+    :param message_id: (необязательно) ID исходного сообщения.
+    :param text: (необязательно) Текст сообщения, если исходного сообщения нет.
+    :return: ID рассылки.
+    """
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        total = await conn.fetchval(f'SELECT COUNT(*) FROM ({AUDIENCES[audience]}) AS recipients')
+        broadcast_id = await conn.fetchval('''
+            INSERT INTO broadcasts (admin_chat_id, audience, from_chat_id, message_id, text, total)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            RETURNING id
+        ''', admin_chat_id, audience, from_chat_id, message_id, text, total)
+    finally:
+        await conn.close()
+
+    _wakeup.set()
+    return broadcast_id
+
+
+async def cancel_broadcast(broadcast_id: int) -> bool:
+    """
+    Останавливает рассылку. Уже отправленные сообщения не отзываются.
+
+    :param broadcast_id: ID рассылки.
+    :return: True, если рассылка была активна и остановлена.
+    """
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        status = await conn.execute('''
+            UPDATE broadcasts SET status = 'cancelled', finished_at = now()
+            WHERE id = $1 AND status = 'running'
+        ''', broadcast_id)
+    finally:
+        await conn.close()
+    return status.endswith(' 1')
+
+
+def _progress_text(broadcast, started_at: float, done_at_start: int) -> str:
+    done = broadcast['sent'] + broadcast['failed'] + broadcast['blocked']
+    text = (
+        f"📨 <b>Рассылка #{broadcast['id']}</b>\n"
+        f"• Отправлено: <b>{broadcast['sent']}</b>\n"
+        f"• Ошибок: <b>{broadcast['failed']}</b>\n"
+        f"• Заблокировали бота: <b>{broadcast['blocked']}</b>\n"
+        f"• Обработано: <b>{done}</b> из <b>{broadcast['total']}</b>\n"
+    )
+    if broadcast['status'] == 'running':
+        elapsed = time.monotonic() - started_at
+        processed = done - done_at_start
+        if processed > 0:
+            eta = int(elapsed / processed * max(broadcast['total'] - done, 0))
+            text += f"• Осталось примерно: <b>{eta // 60} мин {eta % 60} с</b>"
+    elif broadcast['status'] == 'done':
+        text += "✅ Рассылка завершена."
+    else:
+        text += "⛔️ Рассылка остановлена."
+    return text
+
+
+async def _report_progress(bot: Bot, conn, broadcast_id: int, started_at: float, done_at_start: int):
+    """
+    Публикует или обновляет сообщение администратора с прогрессом рассылки.
+    """
+    broadcast = await conn.fetchrow('SELECT * FROM broadcasts WHERE id = $1', broadcast_id)
+    text = _progress_text(broadcast, started_at, done_at_start)
+    keyboard = None
+    if broadcast['status'] == 'running':
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text='⛔️ Остановить', callback_data=pack_callback('cancel_broadcast', broadcast_id))]
+        ])
+
+    try:
+        if broadcast['progress_message_id']:
+            await bot.edit_message_text(text, chat_id=broadcast['admin_chat_id'],
+                                        message_id=broadcast['progress_message_id'],
+                                        parse_mode='HTML', reply_markup=keyboard)
+        else:
+            message = await bot.send_message(broadcast['admin_chat_id'], text, parse_mode='HTML',
+                                             reply_markup=keyboard)
+            await conn.execute('UPDATE broadcasts SET progress_message_id = $1 WHERE id = $2',
+                               message.message_id, broadcast_id)
+    except Exception as e:
+        logger.warning(f"Не удалось обновить прогресс рассылки #{broadcast_id}: {e}")
+
+
+async def _send_one(bot: Bot, broadcast, tg_id: int, limiter: RateLimiter, semaphore: asyncio.Semaphore) -> str:
+    """
+    Отправляет сообщение рассылки одному получателю.
+
+    :return: 'sent', 'blocked' или 'failed'.
+    """
+    async with semaphore:
+        for _ in range(3):
+            await limiter.acquire()
+            try:
+                if broadcast['message_id']:
+                    await bot.copy_message(chat_id=tg_id, from_chat_id=broadcast['from_chat_id'],
+                                           message_id=broadcast['message_id'])
+                else:
+                    await bot.send_message(chat_id=tg_id, text=broadcast['text'])
+                return 'sent'
+            except TelegramRetryAfter as e:
+                # Паузу выдерживает FloodControlMiddleware только для этого чата, остальные получатели не ждут.
+                logger.warning(f"Flood control при рассылке #{broadcast['id']} пользователю {tg_id}, "
+                               f"повтор через {e.retry_after} с.")
+            except TelegramForbiddenError:
+                return 'blocked'
+            except Exception as e:
+                logger.error(f"Ошибка при отправке рассылки #{broadcast['id']} пользователю {tg_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+
+async def run_broadcast(bot: Bot, broadcast_id: int):
+    """
+    Выполняет рассылку с последней сохраненной контрольной точки.
+
+    Получатели читаются курсором на стороне сервера в порядке tg_id, пачками по
+    BROADCAST_CHUNK_SIZE. Каждая пачка отправляется параллельно с общим ограничением скорости,
+    после чего в таблицу broadcasts записываются счетчики и последний обработанный tg_id.
+    После перезапуска рассылка продолжается с этой точки.
+
+    :param bot: Объект бота для отправки сообщений.
+    :param broadcast_id: ID рассылки.
+    """
+    mark_bulk()
+    limiter = RateLimiter(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    state_conn = await asyncpg.connect(DATABASE_URL)
+    cursor_conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        broadcast = await state_conn.fetchrow('SELECT * FROM broadcasts WHERE id = $1', broadcast_id)
+        started_at = time.monotonic()
+        done_at_start = broadcast['sent'] + broadcast['failed'] + broadcast['blocked']
+        last_report = 0.0
+
+        query = f'''
+            SELECT tg_id FROM ({AUDIENCES[broadcast['audience']]}) AS recipients
+            WHERE tg_id > $1 ORDER BY tg_id
+        '''
+        async with cursor_conn.transaction(readonly=True):
+            cursor = await cursor_conn.cursor(query, broadcast['last_tg_id'])
+            while True:
+                chunk = [record['tg_id'] for record in await cursor.fetch(BROADCAST_CHUNK_SIZE)]
+                if not chunk:
+                    break
+
+                status = await state_conn.fetchval('SELECT status FROM broadcasts WHERE id = $1', broadcast_id)
+                if status != 'running':
+                    logger.info(f"Рассылка #{broadcast_id} остановлена.")
+                    break
+
+                results = await asyncio.gather(*(
+                    _send_one(bot, broadcast, tg_id, limiter, semaphore) for tg_id in chunk
+                ))
+
+                await state_conn.execute('''
+                    UPDATE broadcasts
+                    SET last_tg_id = $2, sent = sent + $3, failed = failed + $4, blocked = blocked + $5,
+                        updated_at = now()
+                    WHERE id = $1
+                ''', broadcast_id, chunk[-1], results.count('sent'), results.count('failed'),
+                    results.count('blocked'))
+
+                if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    await _report_progress(bot, state_conn, broadcast_id, started_at, done_at_start)
+                    last_report = time.monotonic()
+
+        await state_conn.execute('''
+            UPDATE broadcasts SET status = 'done', finished_at = now()
+            WHERE id = $1 AND status = 'running'
+        ''', broadcast_id)
+        await _report_progress(bot, state_conn, broadcast_id, started_at, done_at_start)
+        logger.info(f"Рассылка #{broadcast_id} завершена.")
+    finally:
+        await cursor_conn.close()
+        await state_conn.close()
+
+
+async def broadcast_supervisor(bot: Bot):
+    """
+    Находит активные рассылки и выполняет их по очереди.
+
+    Запускается через leader.run_as_leader, поэтому рассылки выполняет только одна реплика,
+    а незавершенные рассылки продолжаются после перезапуска или смены лидера.
+
+    :param bot: Объект бота для отправки сообщений.
+    """
+    while True:
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            broadcast_id = await conn.fetchval('''
+                SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id LIMIT 1
+            ''')
+        finally:
+            await conn.close()
+
+        if broadcast_id is not None:
+            try:
+                await run_broadcast(bot, broadcast_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при выполнении рассылки #{broadcast_id}: {e}")
+                await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+            continue
+
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=BROADCAST_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
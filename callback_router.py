@@ -0,0 +1,144 @@
+import base64
+import binascii
+import uuid
+from typing import NamedTuple
+
+from aiogram import Router
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.types import CallbackQuery
+
+CALLBACK_DATA_LIMIT = 64
+SEPARATOR = '|'
+
+
+class CallbackData(NamedTuple):
+    """Разобранные данные кнопки: действие и его аргументы."""
+    action: str
+    args: tuple
+
+
+def pack_callback(action: str, *args) -> str:
+    """
+    Собирает callback_data вида action|arg1|arg2.
+
+    :param action: Имя действия.
+    :param args: Аргументы действия.
+    :return: Строка callback_data.
+    :raises ValueError: Если данные не помещаются в 64 байта, разрешенные Telegram.
+    """
+    data = SEPARATOR.join((action, *map(str, args)))
+    if len(data.encode()) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data}")
+    return data
+
+
+def parse_callback(data: str) -> CallbackData:
+    """
+    Разбирает callback_data, собранную pack_callback.
+
+    :param data: Строка callback_data.
+    :return: CallbackData с действием и аргументами.
+    """
+    action, *args = data.split(SEPARATOR)
+    return CallbackData(action, tuple(args))
+
+
+def short_id(client_id: str) -> str:
+    """
+    Кодирует UUID клиента в 22 символа base64url вместо 36 символов канонической записи.
+
+    :param client_id: UUID клиента.
+    :return: Короткий идентификатор для callback_data. Если client_id не UUID, он возвращается как есть.
+    """
+    try:
+        return base64.urlsafe_b64encode(uuid.UUID(client_id).bytes).rstrip(b'=').decode()
+    except ValueError:
+        return client_id
+
+
+def full_id(value: str) -> str:
+    """
+    Восстанавливает UUID клиента из короткого идентификатора.
+
+    Строки другой длины и строки из 22 символов, которые не являются base64 от UUID (например,
+    email), возвращаются без изменений: так продолжают работать кнопки в уже отправленных
+    сообщениях, где записан полный UUID или email.
+
+    :param value: Короткий идентификатор или UUID.
+    :return: UUID клиента.
+    """
+    if len(value) != 22:
+        return value
+    try:
+        return str(uuid.UUID(bytes=base64.urlsafe_b64decode(value + '==')))
+    except (ValueError, binascii.Error):
+        return value
+
+
+class CallbackRouter:
+    """
+    Маршрутизатор нажатий на кнопки.
+
+    Вместо цепочки фильтров по всем роутерам callback_data разбирается один раз, а обработчик
+    находится по имени действия в словаре, поэтому стоимость маршрутизации не зависит
+    от количества обработчиков. Обработчик получает те же аргументы, что и обычный обработчик
+    aiogram (callback_query, state, bot...), и дополнительно callback с разобранными данными.
+
+    Для старых форматов без разделителя (amount_100, select_server&...) можно зарегистрировать
+    префикс: он проверяется, только если действие не найдено в словаре.
+    """
+
+    def __init__(self, name: str = 'callbacks'):
+        self.router = Router(name=name)
+        self._actions = {}
+        self._legacy = []
+        self.router.callback_query.register(self._dispatch, self._resolve)
+
+    def action(self, name: str):
+        """Регистрирует обработчик действия name."""
+        def decorator(func):
+            if name in self._actions:
+                raise ValueError(f"Обработчик действия {name} уже зарегистрирован")
+            self._actions[name] = CallableObject(func)
+            return func
+        return decorator
+
+    def legacy(self, prefix: str, action: str, separator: str = None):
+        """
+        Сопоставляет старый формат callback_data с действием.
+
+        :param prefix: Префикс старого формата, например amount_.
+        :param action: Действие, которому передается нажатие.
+        :param separator: Разделитель аргументов после префикса. Если не указан,
+                          весь остаток строки передается одним аргументом.
+        """
+        self._legacy.append((prefix, action, separator))
+
+    def resolve(self, data: str):
+        """Возвращает разобранные данные и обработчик или None, если действие неизвестно."""
+        callback = parse_callback(data)
+        handler = self._actions.get(callback.action)
+        if handler is not None:
+            return callback, handler
+
+        for prefix, action, separator in self._legacy:
+            if data.startswith(prefix):
+                rest = data[len(prefix):]
+                args = tuple(rest.split(separator)) if separator else (rest,)
+                return CallbackData(action, args), self._actions.get(action)
+        return None
+
+    def _resolve(self, callback_query: CallbackQuery):
+        if not callback_query.data:
+            return False
+        resolved = self.resolve(callback_query.data)
+        if resolved is None or resolved[1] is None:
+            return False
+        callback, handler = resolved
+        return {'callback': callback, 'callback_handler': handler}
+
+    async def _dispatch(self, callback_query: CallbackQuery, callback_handler: CallableObject, **kwargs):
+        return await callback_handler.call(callback_query, **kwargs)
+
+
+callbacks = CallbackRouter()
@@ -36,7 +36,136 @@ async def init_db():
             reward_issued BOOLEAN DEFAULT FALSE  -- Был ли начислен бонус
         )
     ''')
-    
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            reply_markup TEXT,  -- JSON inline-клавиатуры
+            dedup_key TEXT UNIQUE,  -- повторная постановка с тем же ключом игнорируется
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending / sent / failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            sent_at TIMESTAMPTZ
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            admin_chat_id BIGINT NOT NULL,  -- куда публикуется прогресс
+            audience TEXT NOT NULL,  -- ключ из broadcast.AUDIENCES
+            from_chat_id BIGINT,  -- исходное сообщение, которое копируется получателям
+            message_id BIGINT,
+            text TEXT,  -- текст, если исходного сообщения нет
+            status TEXT NOT NULL DEFAULT 'running',  -- running / done / cancelled
+            last_tg_id BIGINT NOT NULL DEFAULT 0,  -- контрольная точка: последний обработанный получатель
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            progress_message_id BIGINT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            id BIGSERIAL PRIMARY KEY,
+            job_name TEXT NOT NULL,
+            replica TEXT NOT NULL,  -- hostname:pid процесса, выполнившего задачу
+            started_at TIMESTAMPTZ NOT NULL,
+            finished_at TIMESTAMPTZ,
+            duration_ms INTEGER,
+            status TEXT NOT NULL,  -- running / success / error / timeout / cancelled
+            error TEXT
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,  -- ID платежа в ЮKassa
+            tg_id BIGINT NOT NULL,
+            amount NUMERIC(12, 2) NOT NULL,
+            status TEXT NOT NULL,  -- pending / waiting_for_capture / succeeded / canceled
+            confirmation_url TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            credited_at TIMESTAMPTZ  -- когда сумма зачислена на баланс
+        )
+    ''')
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS payments_pending_idx
+        ON payments (tg_id, amount, created_at DESC) WHERE status = 'pending'
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS payment_inbox (
+            id BIGSERIAL PRIMARY KEY,
+            payment_id TEXT NOT NULL,
+            event TEXT NOT NULL,  -- payment.succeeded / payment.canceled
+            payload JSONB NOT NULL,  -- тело вебхука
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending / done / failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_error TEXT,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            processed_at TIMESTAMPTZ,
+            UNIQUE (payment_id, event)
+        )
+    ''')
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS payment_inbox_pending_idx
+        ON payment_inbox (next_attempt_at) WHERE status = 'pending'
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS renewal_jobs (
+            tg_id BIGINT PRIMARY KEY,  -- одно задание на пользователя
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending / failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            requested_at TIMESTAMPTZ NOT NULL DEFAULT now(),  -- когда зачислен последний платеж
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_error TEXT
+        )
+    ''')
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS renewal_jobs_pending_idx
+        ON renewal_jobs (next_attempt_at) WHERE status = 'pending'
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,  -- ключ aiogram: fsm:<bot_id>:<chat_id>:<user_id>:<destiny>
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            expires_at TIMESTAMPTZ NOT NULL
+        )
+    ''')
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS fsm_storage_expires_at_idx ON fsm_storage (expires_at)
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            sha256 TEXT PRIMARY KEY,  -- хеш содержимого файла
+            file_id TEXT NOT NULL,  -- file_id загруженного в Telegram файла
+            path TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,  -- update_id принятого вебхуком обновления
+            received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS job_runs_job_name_idx ON job_runs (job_name, started_at DESC)
+    ''')
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS outbox_pending_idx
+        ON outbox (next_attempt_at) WHERE status = 'pending'
+    ''')
+
     try:
         await conn.execute('''
             ALTER TABLE keys
@@ -59,6 +188,20 @@ async def init_db():
         ''')
     except asyncpg.exceptions.DuplicateColumnError:
         pass
+    try:
+        await conn.execute('''
+            ALTER TABLE keys
+            ADD COLUMN reminder_sent_hours DOUBLE PRECISION  -- за сколько часов до истечения отправлено последнее напоминание
+        ''')
+        # Перенос статусов из старых флагов уведомлений за 24 и 10 часов
+        await conn.execute('''
+            UPDATE keys SET reminder_sent_hours = CASE WHEN notified THEN 10 WHEN notified_24h THEN 24 END
+        ''')
+    except asyncpg.exceptions.DuplicateColumnError:
+        pass
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS keys_expiry_time_idx ON keys (expiry_time, reminder_sent_hours)
+    ''')
 
     await conn.close()
 
@@ -118,17 +261,26 @@ async def get_balance(tg_id: int) -> float:
     await conn.close()
     return balance if balance is not None else 0.0
 
-async def update_balance(tg_id: int, amount: float):
-    conn = await asyncpg.connect(DATABASE_URL)
-    await conn.execute('''
-        UPDATE connections 
-        SET balance = balance + $1 
-        WHERE tg_id = $2
-    ''', amount, tg_id)
+async def update_balance(tg_id: int, amount: float, conn=None):
+    """
+    Изменение баланса пользователя с начислением реферального бонуса.
 
-    await handle_referral_on_balance_update(tg_id, amount)
+    Если передано соединение, изменения выполняются в нем, то есть в транзакции вызывающего кода.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await conn.execute('''
+            UPDATE connections 
+            SET balance = balance + $1 
+            WHERE tg_id = $2
+        ''', amount, tg_id)
 
-    await conn.close()
+        await handle_referral_on_balance_update(tg_id, amount, conn=conn)
+    finally:
+        if own_conn:
+            await conn.close()
 
 async def get_trial(tg_id: int) -> int:
     conn = await asyncpg.connect(DATABASE_URL)
@@ -153,29 +305,32 @@ async def add_referral(referred_tg_id: int, referrer_tg_id: int):
     ''', referred_tg_id, referrer_tg_id)
     await conn.close()
 
-async def handle_referral_on_balance_update(tg_id: int, amount: float):
-    conn = await asyncpg.connect(DATABASE_URL)
-
-    referral = await conn.fetchrow('''
-        SELECT referrer_tg_id FROM referrals WHERE referred_tg_id = $1
-    ''', tg_id)
+async def handle_referral_on_balance_update(tg_id: int, amount: float, conn=None):
+    own_conn = conn is None
+    if own_conn:
+        conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        referral = await conn.fetchrow('''
+            SELECT referrer_tg_id FROM referrals WHERE referred_tg_id = $1
+        ''', tg_id)
 
-    if referral:
-        referrer_tg_id = referral['referrer_tg_id']
-        
-        bonus = amount * 0.25 
+        if referral:
+            referrer_tg_id = referral['referrer_tg_id']
 
-        if bonus < 0:
-            bonus = 0
+            bonus = amount * 0.25 
 
-        await update_balance(referrer_tg_id, bonus)
+            if bonus < 0:
+                bonus = 0
 
-        await conn.execute('''
-            UPDATE referrals SET reward_issued = TRUE 
-            WHERE referrer_tg_id = $1 AND referred_tg_id = $2
-        ''', referrer_tg_id, tg_id)
+            await update_balance(referrer_tg_id, bonus, conn=conn)
 
-    await conn.close()
+            await conn.execute('''
+                UPDATE referrals SET reward_issued = TRUE 
+                WHERE referrer_tg_id = $1 AND referred_tg_id = $2
+            ''', referrer_tg_id, tg_id)
+    finally:
+        if own_conn:
+            await conn.close()
 
 async def get_referral_stats(referrer_tg_id: int):
     conn = await asyncpg.connect(DATABASE_URL)
@@ -201,7 +356,7 @@ async def update_key_expiry(client_id: str, new_expiry_time: int):
     conn = await asyncpg.connect(DATABASE_URL)
     await conn.execute('''
         UPDATE keys
-        SET expiry_time = $1, notified = FALSE, notified_24h = FALSE
+        SET expiry_time = $1, reminder_sent_hours = NULL
         WHERE client_id = $2
     ''', new_expiry_time, client_id)
     await conn.close()
@@ -244,4 +399,77 @@ async def get_tg_id_by_client_id(client_id: str):
         result = await conn.fetchrow('SELECT tg_id FROM keys WHERE client_id = $1', client_id)
         return result['tg_id'] if result else None
     finally:
-        await conn.close()
\ No newline at end of file
+        await conn.close()
+
+
+async def add_payment(payment_id: str, tg_id: int, amount: float, status: str, confirmation_url: str = None,
+                      conn=None):
+    """
+    Сохранение платежа. Если платеж с таким ID уже есть, запись не изменяется.
+
+    :return: True, если платеж добавлен; False, если он уже был.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        inserted = await conn.fetchval('''
+            INSERT INTO payments (payment_id, tg_id, amount, status, confirmation_url)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (payment_id) DO NOTHING
+            RETURNING TRUE
+        ''', payment_id, tg_id, amount, status, confirmation_url)
+    finally:
+        if own_conn:
+            await conn.close()
+    return bool(inserted)
+
+
+async def get_pending_payment(tg_id: int, amount: float, max_age_seconds: int):
+    """
+    Получение последнего неоплаченного платежа пользователя на указанную сумму, созданного
+    не раньше чем max_age_seconds секунд назад.
+
+    :return: Запись платежа (payment_id, confirmation_url) или None.
+    """
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        return await conn.fetchrow('''
+            SELECT payment_id, confirmation_url
+            FROM payments
+            WHERE tg_id = $1 AND amount = $2 AND status = 'pending'
+              AND confirmation_url IS NOT NULL
+              AND created_at > now() - make_interval(secs => $3)
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''', tg_id, amount, float(max_age_seconds))
+    finally:
+        await conn.close()
+
+
+async def mark_payment_succeeded(conn, payment_id: str):
+    """
+    Перевод платежа в статус succeeded.
+
+    Статус меняется только один раз: для уже успешного платежа возвращается None, поэтому
+    повторная доставка вебхука не приводит к повторному зачислению.
+
+    :return: Запись платежа (tg_id, amount), если это первый переход в succeeded, иначе None.
+    """
+    return await conn.fetchrow('''
+        UPDATE payments
+        SET status = 'succeeded', updated_at = now(), credited_at = now()
+        WHERE payment_id = $1 AND status <> 'succeeded'
+        RETURNING tg_id, amount
+    ''', payment_id)
+
+
+async def set_payment_status(conn, payment_id: str, status: str):
+    """
+    Обновление статуса незавершенного платежа (успешный платеж не меняется).
+    """
+    await conn.execute('''
+        UPDATE payments
+        SET status = $2, updated_at = now()
+        WHERE payment_id = $1 AND status <> 'succeeded'
+    ''', payment_id, status)
@@ -0,0 +1,163 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+import config
+from metrics import counter, gauge, histogram
+
+logger = logging.getLogger(__name__)
+
+FLOOD_GLOBAL_RATE = getattr(config, 'FLOOD_GLOBAL_RATE', 30)
+FLOOD_CHAT_RATE = getattr(config, 'FLOOD_CHAT_RATE', 1)
+FLOOD_CHAT_BURST = getattr(config, 'FLOOD_CHAT_BURST', 3)
+FLOOD_GROUP_RATE = getattr(config, 'FLOOD_GROUP_RATE', 20 / 60)
+FLOOD_INTERACTIVE_RESERVE = getattr(config, 'FLOOD_INTERACTIVE_RESERVE', 5)
+FLOOD_MAX_RETRY_WAIT = getattr(config, 'FLOOD_MAX_RETRY_WAIT', 5)
+FLOOD_CHAT_MAX_ENTRIES = 10000
+
+# Фоновые отправки (outbox, рассылки) помечают себя через mark_bulk() и уступают очередь ответам пользователям.
+bulk_traffic = contextvars.ContextVar('bulk_traffic', default=False)
+
+interactive_delay = histogram('flood_control_delay_seconds', 'Задержка ответов пользователям перед отправкой в Telegram')
+bulk_delay = histogram('flood_control_bulk_delay_seconds', 'Задержка фоновых отправок перед отправкой в Telegram')
+retry_after_received = counter('flood_control_retry_after_total', 'Ответы Telegram с retry_after')
+
+
+def mark_bulk():
+    """
+    Помечает текущую задачу (и задачи, созданные из нее) как фоновую отправку.
+    """
+    bulk_traffic.set(True)
+
+
+class TokenBucket:
+    """
+    Token bucket с паузой: после retry_after токены не выдаются до paused_until.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at', 'paused_until')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now: float, reserve: float = 0) -> float:
+        """Через сколько секунд появится токен сверх reserve (0 - уже есть)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        missing = 1 + reserve - self.tokens
+        return missing / self.rate if missing > 0 else 0
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class FloodControlMiddleware(BaseRequestMiddleware):
+    """
+    Общий ограничитель скорости для всех запросов бота к Telegram, которые адресованы чату.
+
+    - Общий token bucket на FLOOD_GLOBAL_RATE сообщений в секунду.
+    - Отдельный bucket на каждый чат: FLOOD_CHAT_RATE в секунду для личных чатов и
+      FLOOD_GROUP_RATE для групп.
+    - Фоновые отправки (см. mark_bulk) не берут последние FLOOD_INTERACTIVE_RESERVE токенов
+      общего bucket и ждут, пока есть ожидающие ответы пользователям.
+    - retry_after приостанавливает чат, для которого он получен. Если у bucket чата при этом
+      оставались токены, лимит чата не превышен и retry_after относится ко всему боту: тогда
+      на то же время приостанавливаются все фоновые отправки, а ответы пользователям - нет.
+    - Ответ пользователю после retry_after повторяется автоматически, если ждать не больше
+      FLOOD_MAX_RETRY_WAIT секунд. Фоновым отправкам ошибка передается дальше: outbox и
+      рассылка переносят сообщение сами.
+
+    Ограничения действуют в пределах процесса.
+    """
+
+    def __init__(self, global_rate: float = FLOOD_GLOBAL_RATE, chat_rate: float = FLOOD_CHAT_RATE,
+                 chat_burst: float = FLOOD_CHAT_BURST, group_rate: float = FLOOD_GROUP_RATE,
+                 interactive_reserve: float = FLOOD_INTERACTIVE_RESERVE):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.bulk_paused_until = 0.0
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.interactive_reserve = min(interactive_reserve, max(global_rate - 1, 0))
+        self.chats = OrderedDict()
+        self.interactive_waiting = 0
+        self.bulk_waiting = 0
+        gauge('flood_control_waiting', 'Запросы, ожидающие разрешения ограничителя',
+              func=lambda: self.interactive_waiting + self.bulk_waiting)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self.chats[chat_id] = TokenBucket(rate, 1 if is_group else self.chat_burst)
+            while len(self.chats) > FLOOD_CHAT_MAX_ENTRIES:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire(self, chat_id, bulk: bool) -> float:
+        """Ждет разрешения на запрос и возвращает, сколько токенов осталось у bucket чата."""
+        started = time.monotonic()
+        chat = self._chat_bucket(chat_id)
+        if bulk:
+            self.bulk_waiting += 1
+        else:
+            self.interactive_waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                wait = max(self.global_bucket.delay(now, self.interactive_reserve if bulk else 0), chat.delay(now))
+                if bulk:
+                    wait = max(wait, self.bulk_paused_until - now)
+                    if self.interactive_waiting:
+                        wait = max(wait, 1 / self.global_bucket.rate)
+                if wait <= 0:
+                    self.global_bucket.take()
+                    chat.take()
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            if bulk:
+                self.bulk_waiting -= 1
+            else:
+                self.interactive_waiting -= 1
+        (bulk_delay if bulk else interactive_delay).observe(time.monotonic() - started)
+        return chat.tokens
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot, method: TelegramMethod):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        bulk = bulk_traffic.get()
+        for attempt in range(2):
+            chat_tokens = await self._acquire(chat_id, bulk)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                retry_after_received.inc()
+                self._chat_bucket(chat_id).pause(e.retry_after)
+                if chat_tokens >= 1:
+                    self.bulk_paused_until = max(self.bulk_paused_until, time.monotonic() + e.retry_after)
+                    logger.warning(f"Flood control Telegram для бота: фоновые отправки на паузе {e.retry_after} с.")
+                else:
+                    logger.warning(f"Flood control Telegram для чата {chat_id}: пауза {e.retry_after} с.")
+                if bulk or attempt or e.retry_after > FLOOD_MAX_RETRY_WAIT:
+                    raise
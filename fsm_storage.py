@@ -0,0 +1,323 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import asyncpg
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (BaseStorage, DefaultKeyBuilder,
+                                      KeyBuilder, StateType, StorageKey)
+
+import config
+from config import DATABASE_URL
+from metrics import gauge
+
+logger = logging.getLogger(__name__)
+
+FSM_STORAGE = getattr(config, 'FSM_STORAGE', 'postgres')
+FSM_STATE_TTL = getattr(config, 'FSM_STATE_TTL', 86400)
+# Буфер отложенной записи живет в процессе, поэтому при нескольких процессах изменения по умолчанию пишутся сразу.
+FSM_FLUSH_INTERVAL = getattr(config, 'FSM_FLUSH_INTERVAL', 0 if getattr(config, 'WEB_WORKERS', 1) > 1 else 0.2)
+FSM_FLUSH_BATCH_SIZE = getattr(config, 'FSM_FLUSH_BATCH_SIZE', 100)
+FSM_POOL_SIZE = getattr(config, 'FSM_POOL_SIZE', 5)
+FSM_REDIS_URL = getattr(config, 'FSM_REDIS_URL', 'redis://localhost:6379/0')
+FSM_MEMORY_MAX_ENTRIES = getattr(config, 'FSM_MEMORY_MAX_ENTRIES', 100000)
+FSM_CLEANUP_INTERVAL = 600
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в таблице fsm_storage.
+
+    Состояние общее для всех процессов бота и переживает перезапуск. Записи хранятся FSM_STATE_TTL
+    секунд с последнего изменения, просроченные записи не читаются и периодически удаляются.
+
+    Изменения пишутся отложенно: они копятся в памяти процесса и сбрасываются в базу одним запросом
+    каждые flush_interval секунд или при накоплении batch_size ключей. Пока изменение не записано,
+    чтения в этом процессе видят его из буфера. Другие процессы увидят изменение только после записи,
+    а при падении процесса незаписанные изменения теряются. При flush_interval = 0 каждое изменение
+    пишется сразу; так по умолчанию работает режим WEB_WORKERS > 1.
+    """
+
+    def __init__(self, dsn: str = DATABASE_URL, ttl: int = FSM_STATE_TTL, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 batch_size: int = FSM_FLUSH_BATCH_SIZE, key_builder: Optional[KeyBuilder] = None):
+        self.dsn = dsn
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.pool = None
+        self._pool_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._pending = {}
+        self._flushing = {}
+        self._flush_requested = asyncio.Event()
+        self._flush_task = None
+        self._last_cleanup = time.monotonic()
+
+    async def _get_pool(self):
+        async with self._pool_lock:
+            if self.pool is None:
+                self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=FSM_POOL_SIZE)
+        return self.pool
+
+    def _key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key)
+
+    async def _load(self, key: str):
+        """
+        Возвращает (state, data) ключа: из буфера незаписанных изменений или из базы.
+        """
+        if key in self._pending:
+            return self._pending[key]
+        if key in self._flushing:
+            return self._flushing[key]
+
+        pool = await self._get_pool()
+        record = await pool.fetchrow('''
+            SELECT state, data FROM fsm_storage WHERE key = $1 AND expires_at > now()
+        ''', key)
+        if record is None:
+            return None, {}
+        return record['state'], json.loads(record['data'])
+
+    async def _store(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        self._pending[key] = (state, data)
+        if self.flush_interval <= 0:
+            await self.flush()
+            return
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if len(self._pending) >= self.batch_size:
+            self._flush_requested.set()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        _, data = await self._load(storage_key)
+        await self._store(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        state, _ = await self._load(storage_key)
+        await self._store(storage_key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return data.copy()
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        storage_key = self._key(key)
+        state, current_data = await self._load(storage_key)
+        current_data = {**current_data, **data}
+        await self._store(storage_key, state, current_data)
+        return current_data.copy()
+
+    async def flush(self):
+        """
+        Записывает накопленные изменения в базу одной транзакцией. Пустые записи удаляются.
+        """
+        async with self._flush_lock:
+            if self._pending:
+                await self._flush_pending()
+
+    async def _flush_pending(self):
+        self._flushing, self._pending = self._pending, {}
+        batch = self._flushing
+
+        upserts = [(key, state, data) for key, (state, data) in batch.items() if state is not None or data]
+        deletes = [key for key, (state, data) in batch.items() if state is None and not data]
+        try:
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    if upserts:
+                        await conn.execute('''
+                            INSERT INTO fsm_storage (key, state, data, expires_at)
+                            SELECT u.key, u.state, u.data::jsonb, now() + make_interval(secs => $4)
+                            FROM unnest($1::text[], $2::text[], $3::text[]) AS u(key, state, data)
+                            ON CONFLICT (key) DO UPDATE
+                            SET state = EXCLUDED.state, data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                        ''', [key for key, _, _ in upserts], [state for _, state, _ in upserts],
+                            [json.dumps(data) for _, _, data in upserts], float(self.ttl))
+                    if deletes:
+                        await conn.execute('DELETE FROM fsm_storage WHERE key = ANY($1::text[])', deletes)
+        except Exception:
+            # Незаписанные изменения возвращаются в буфер, если их не перекрыли более новые.
+            # При записи без буфера повторять их некому: они отбрасываются, ошибка получает
+            # обработчик, а состояние остается тем, что записано в базе для всех процессов.
+            if self.flush_interval > 0:
+                for key, value in batch.items():
+                    self._pending.setdefault(key, value)
+            raise
+        finally:
+            self._flushing = {}
+
+    async def _cleanup(self):
+        pool = await self._get_pool()
+        await pool.execute('DELETE FROM fsm_storage WHERE expires_at <= now()')
+        self._last_cleanup = time.monotonic()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_cleanup > FSM_CLEANUP_INTERVAL:
+                    await self._cleanup()
+            except Exception as e:
+                logger.error(f"Ошибка при записи состояний FSM: {e}")
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        try:
+            await self.flush()
+        finally:
+            if self.pool is not None:
+                await self.pool.close()
+                self.pool = None
+
+
+class _Slot:
+    """
+    Запись BoundedMemoryStorage. Пустые данные хранятся как None, чтобы не держать пустой dict на каждого
+    пользователя.
+    """
+
+    __slots__ = ('state', 'data', 'touched_at')
+
+    def __init__(self, state: Optional[str], data: Optional[Dict[str, Any]], touched_at: float):
+        self.state = state
+        self.data = data
+        self.touched_at = touched_at
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в памяти процесса с ограничением размера.
+
+    В отличие от MemoryStorage aiogram, записи не копятся бесконечно:
+    - запись удаляется, как только у ключа не остается ни состояния, ни данных;
+    - запись, к которой не обращались ttl секунд, считается пустой и удаляется;
+    - при превышении max_entries вытесняются записи, к которым дольше всего не обращались.
+
+    Записи лежат в OrderedDict в порядке последнего обращения, поэтому поиск просроченных и
+    вытесняемых записей начинается с начала словаря и не требует полного обхода.
+    """
+
+    def __init__(self, max_entries: int = FSM_MEMORY_MAX_ENTRIES, ttl: int = FSM_STATE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.slots = OrderedDict()
+        self.evicted = 0
+        gauge('fsm_memory_entries', 'Количество записей в хранилище состояний FSM', func=lambda: len(self.slots))
+        gauge('fsm_memory_approx_bytes', 'Примерный объем памяти хранилища состояний FSM',
+              func=self.approximate_size)
+
+    @staticmethod
+    def _key(key: StorageKey) -> tuple:
+        return key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+
+    def _expire(self, now: float):
+        while self.slots:
+            slot = next(iter(self.slots.values()))
+            if now - slot.touched_at < self.ttl:
+                break
+            self.slots.popitem(last=False)
+            self.evicted += 1
+
+    def _get(self, key: StorageKey) -> Optional[_Slot]:
+        now = time.monotonic()
+        self._expire(now)
+        storage_key = self._key(key)
+        slot = self.slots.get(storage_key)
+        if slot is not None:
+            slot.touched_at = now
+            self.slots.move_to_end(storage_key)
+        return slot
+
+    def _put(self, key: StorageKey, state: Optional[str], data: Optional[Dict[str, Any]]):
+        storage_key = self._key(key)
+        if state is None and not data:
+            self.slots.pop(storage_key, None)
+            return
+
+        now = time.monotonic()
+        self._expire(now)
+        slot = self.slots.get(storage_key)
+        if slot is None:
+            self.slots[storage_key] = _Slot(state, data or None, now)
+            while len(self.slots) > self.max_entries:
+                self.slots.popitem(last=False)
+                self.evicted += 1
+        else:
+            slot.state, slot.data, slot.touched_at = state, data or None, now
+            self.slots.move_to_end(storage_key)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        slot = self._get(key)
+        self._put(key, state.state if isinstance(state, State) else state, slot.data if slot else None)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        slot = self._get(key)
+        return slot.state if slot else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        slot = self._get(key)
+        self._put(key, slot.state if slot else None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        slot = self._get(key)
+        return dict(slot.data) if slot and slot.data else {}
+
+    def approximate_size(self, sample_size: int = 100) -> int:
+        """
+        Оценивает объем памяти хранилища в байтах по выборке из первых sample_size записей.
+        """
+        if not self.slots:
+            return sys.getsizeof(self.slots)
+        sample = []
+        for key, slot in self.slots.items():
+            size = sys.getsizeof(key) + sys.getsizeof(slot) + sys.getsizeof(slot.state or '')
+            if slot.data:
+                size += sys.getsizeof(slot.data) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in slot.data.items())
+            sample.append(size)
+            if len(sample) >= sample_size:
+                break
+        return sys.getsizeof(self.slots) + len(self.slots) * sum(sample) // len(sample)
+
+    async def close(self) -> None:
+        self.slots.clear()
+
+
+def create_storage(backend: str = FSM_STORAGE) -> BaseStorage:
+    """
+    Создает хранилище состояний FSM по имени из настройки FSM_STORAGE.
+
+    :param backend: 'postgres' - общее хранилище в базе данных (по умолчанию),
+                    'redis' - RedisStorage aiogram (нужен пакет redis),
+                    'memory' - состояние только в памяти процесса (BoundedMemoryStorage).
+    :return: Хранилище состояний для Dispatcher.
+    """
+    if backend == 'postgres':
+        return PostgresStorage()
+    if backend == 'redis':
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(FSM_REDIS_URL, key_builder=DefaultKeyBuilder(with_destiny=True),
+                                     state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    if backend == 'memory':
+        return BoundedMemoryStorage()
+    raise ValueError(f"Неизвестное хранилище FSM: {backend}")
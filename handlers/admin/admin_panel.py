@@ -6,6 +6,7 @@ from config import ADMIN_ID, DATABASE_URL
 import asyncpg
 from datetime import datetime
 from bot import bot
+from callback_router import callbacks
 
 router = Router()
 
@@ -43,7 +44,7 @@ async def handle_admin_command(message: types.Message):
     ])
     await message.reply("Панель администратора", reply_markup=keyboard)
 
-@router.callback_query(lambda c: c.data == "user_stats")
+@callbacks.action('user_stats')
 async def user_stats_menu(callback_query: CallbackQuery):
     """
     Обрабатывает запрос на отображение статистики пользователей.
@@ -86,7 +87,7 @@ async def user_stats_menu(callback_query: CallbackQuery):
 
     await callback_query.answer()
 
-@router.callback_query(lambda c: c.data == "user_editor")
+@callbacks.action('user_editor')
 async def user_editor_menu(callback_query: CallbackQuery):
     """
     Обрабатывает запрос на отображение меню редактора пользователей.
@@ -106,7 +107,7 @@ async def user_editor_menu(callback_query: CallbackQuery):
     ])
     await callback_query.message.edit_text("Выберите метод поиска:", reply_markup=keyboard)
 
-@router.callback_query(lambda c: c.data == "back_to_admin_menu")
+@callbacks.action('back_to_admin_menu')
 async def back_to_admin_menu(callback_query: CallbackQuery):
     """
     Обрабатывает запрос на возврат в меню администратора.
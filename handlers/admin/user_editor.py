@@ -6,6 +6,7 @@ from config import DATABASE_URL, SERVERS
 import asyncpg
 from datetime import datetime
 from bot import bot
+from callback_router import CallbackData, callbacks, full_id, pack_callback, short_id
 from database import update_key_expiry, get_client_id_by_email, get_tg_id_by_client_id
 from config import DATABASE_URL, ADMIN_PASSWORD, ADMIN_USERNAME
 from datetime import datetime
@@ -26,7 +27,7 @@ class UserEditorState(StatesGroup):
     waiting_for_expiry_time = State()
 
 
-@router.callback_query(lambda c: c.data == "search_by_tg_id")
+@callbacks.action('search_by_tg_id')
 async def prompt_tg_id(callback_query: CallbackQuery, state: FSMContext):
     """
     Запрашивает у пользователя ввод tg_id клиента.
@@ -51,7 +52,7 @@ async def handle_tg_id_input(message: types.Message, state: FSMContext):
     conn = await asyncpg.connect(DATABASE_URL)
     try:
         balance = await conn.fetchval("SELECT balance FROM connections WHERE tg_id = $1", tg_id)
-        key_records = await conn.fetch("SELECT email FROM keys WHERE tg_id = $1", tg_id)
+        key_records = await conn.fetch("SELECT email, client_id FROM keys WHERE tg_id = $1", tg_id)
         referral_count = await conn.fetchval("SELECT COUNT(*) FROM referrals WHERE referrer_tg_id = $1", tg_id)
 
         if balance is None:
@@ -60,12 +61,12 @@ async def handle_tg_id_input(message: types.Message, state: FSMContext):
             return
 
         key_buttons = [
-            [InlineKeyboardButton(text=email, callback_data=f"edit_key_{email}")]
-            for email, in key_records
+            [InlineKeyboardButton(text=email, callback_data=pack_callback('edit_key', short_id(client_id)))]
+            for email, client_id in key_records
         ]
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             *key_buttons,
-            [InlineKeyboardButton(text="📝 Изменить баланс", callback_data=f"change_balance_{tg_id}")],
+            [InlineKeyboardButton(text="📝 Изменить баланс", callback_data=pack_callback('change_balance', tg_id))],
             [InlineKeyboardButton(text="Назад", callback_data="back_to_user_editor")]
         ])
 
@@ -82,15 +83,18 @@ async def handle_tg_id_input(message: types.Message, state: FSMContext):
         await conn.close()
 
 
-@router.callback_query(lambda c: c.data.startswith('change_balance_'))
-async def process_balance_change(callback_query: CallbackQuery, state: FSMContext):
+callbacks.legacy('change_balance_', 'change_balance')
+
+
+@callbacks.action('change_balance')
+async def process_balance_change(callback_query: CallbackQuery, state: FSMContext, callback: CallbackData):
     """
     Запрашивает новую сумму баланса для указанного tg_id.
 
     :param callback_query: Объект callback_query от Telegram, содержащий информацию о событии.
     :param state: Контекст состояния для хранения данных о состоянии пользователя.
     """
-    tg_id = int(callback_query.data.split('_')[2])
+    tg_id = int(callback.args[0])
     await state.update_data(tg_id=tg_id)
 
     await callback_query.message.edit_text("Введите новую сумму баланса:")
@@ -131,14 +135,15 @@ async def handle_new_balance_input(message: types.Message, state: FSMContext):
     await state.clear()
 
 
-@router.callback_query(lambda c: c.data.startswith('edit_key_'))
-async def process_key_edit(callback_query: CallbackQuery):
+@callbacks.action('edit_key')
+async def process_key_edit(callback_query: CallbackQuery, callback: CallbackData):
     """
-    Обрабатывает запрос на редактирование ключа по его email.
+    Обрабатывает запрос на редактирование ключа по его client_id.
 
     :param callback_query: Объект callback_query от Telegram, содержащий информацию о событии.
+    :param callback: Разобранные данные кнопки с коротким идентификатором ключа.
     """
-    email = callback_query.data.split('_', 2)[2]
+    client_id = full_id(callback.args[0])
 
     try:
         conn = await asyncpg.connect(DATABASE_URL)
@@ -146,8 +151,8 @@ async def process_key_edit(callback_query: CallbackQuery):
             record = await conn.fetchrow('''
                 SELECT k.key, k.expiry_time, k.server_id 
                 FROM keys k
-                WHERE k.email = $1
-            ''', email)
+                WHERE k.client_id = $1
+            ''', client_id)
 
             if record:
                 key = record['key']
@@ -177,9 +182,9 @@ async def process_key_edit(callback_query: CallbackQuery):
                 )
 
                 change_expiry_button = types.InlineKeyboardButton(text='⏳ Изменить время истечения',
-                                                                  callback_data=f'change_expiry|{email}')
+                                                                  callback_data=pack_callback('change_expiry', short_id(client_id)))
                 delete_button = types.InlineKeyboardButton(text='❌ Удалить ключ',
-                                                           callback_data=f'delete_key_admin|{email}')
+                                                           callback_data=pack_callback('delete_key_admin', short_id(client_id)))
 
                 keyboard = types.InlineKeyboardMarkup(
                     inline_keyboard=[
@@ -201,7 +206,7 @@ async def process_key_edit(callback_query: CallbackQuery):
     await callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data == "search_by_key_name")
+@callbacks.action('search_by_key_name')
 async def prompt_key_name(callback_query: CallbackQuery, state: FSMContext):
     """
     Обрабатывает нажатие на кнопку поиска по имени ключа.
@@ -235,7 +240,7 @@ async def handle_key_name_input(message: types.Message, state: FSMContext):
     conn = await asyncpg.connect(DATABASE_URL)
     try:
         user_records = await conn.fetch('''
-            SELECT c.tg_id, c.balance, k.email, k.key, k.expiry_time, k.server_id 
+            SELECT c.tg_id, c.balance, k.email, k.client_id, k.key, k.expiry_time, k.server_id 
             FROM connections c 
             JOIN keys k ON c.tg_id = k.tg_id 
             WHERE k.email = $1
@@ -252,7 +257,7 @@ async def handle_key_name_input(message: types.Message, state: FSMContext):
         for record in user_records:
             tg_id = record['tg_id']
             balance = record['balance']
-            email = record['email']
+            client_id = record['client_id']
             key = record['key']
             expiry_time = record['expiry_time']
             server_id = record['server_id']
@@ -267,8 +272,8 @@ async def handle_key_name_input(message: types.Message, state: FSMContext):
             )
 
             change_expiry_button = InlineKeyboardButton(text='⏳ Изменить время истечения',
-                                                        callback_data=f'change_expiry|{email}')
-            delete_button = InlineKeyboardButton(text='❌ Удалить ключ', callback_data=f'delete_key_admin|{email}')
+                                                        callback_data=pack_callback('change_expiry', short_id(client_id)))
+            delete_button = InlineKeyboardButton(text='❌ Удалить ключ', callback_data=pack_callback('delete_key_admin', short_id(client_id)))
 
             key_buttons.append([change_expiry_button, delete_button])
 
@@ -284,8 +289,8 @@ async def handle_key_name_input(message: types.Message, state: FSMContext):
     await state.clear()
 
 
-@router.callback_query(lambda c: c.data.startswith('change_expiry|'))
-async def prompt_expiry_change(callback_query: CallbackQuery, state: FSMContext):
+@callbacks.action('change_expiry')
+async def prompt_expiry_change(callback_query: CallbackQuery, state: FSMContext, callback: CallbackData):
     """
     Запрашивает у пользователя новое время истечения для ключа.
 
@@ -295,8 +300,19 @@ async def prompt_expiry_change(callback_query: CallbackQuery, state: FSMContext)
     Args:
         callback_query (CallbackQuery): Объект обратного вызова, содержащий информацию о нажатой кнопке.
         state (FSMContext): Объект контекста состояния для управления состоянием пользователя.
+        callback (CallbackData): Разобранные данные кнопки с коротким идентификатором ключа.
     """
-    email = callback_query.data.split('|')[1]
+    client_id = full_id(callback.args[0])
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        email = await conn.fetchval('SELECT email FROM keys WHERE client_id = $1', client_id)
+    finally:
+        await conn.close()
+
+    if email is None:
+        await callback_query.answer("Ключ не найден.")
+        return
+
     await callback_query.message.edit_text(
         f"Введите новое время истечения для ключа <b>{email}</b> в формате <code>YYYY-MM-DD HH:MM:SS</code>:",
         parse_mode="HTML"
@@ -382,31 +398,32 @@ async def handle_expiry_time_input(message: types.Message, state: FSMContext):
     await state.clear()
 
 
-@router.callback_query(lambda c: c.data.startswith('delete_key_admin|'))
-async def process_callback_delete_key(callback_query: types.CallbackQuery):
+@callbacks.action('delete_key_admin')
+async def process_callback_delete_key(callback_query: types.CallbackQuery, callback: CallbackData):
     """
     Обрабатывает запрос на удаление ключа от пользователя.
 
-    Функция извлекает email из данных обратного вызова и ищет соответствующий client_id в базе данных.
+    Функция извлекает client_id из данных обратного вызова и проверяет, что ключ есть в базе данных.
     Если клиент найден, запрашивает подтверждение на удаление ключа. В противном случае
     отправляет сообщение об ошибке.
 
     Args:
         callback_query (types.CallbackQuery): Обратный вызов от пользователя с запросом на удаление ключа.
+        callback (CallbackData): Разобранные данные кнопки с коротким идентификатором ключа.
     """
     tg_id = callback_query.from_user.id
-    email = callback_query.data.split('|')[1]
+    client_id = full_id(callback.args[0])
 
     conn = await asyncpg.connect(DATABASE_URL)
     try:
-        client_id = await conn.fetchval('SELECT client_id FROM keys WHERE email = $1', email)
+        client_id = await conn.fetchval('SELECT client_id FROM keys WHERE client_id = $1', client_id)
 
         if client_id is None:
             await bot.edit_message_text("Ключ не найден.", chat_id=tg_id, message_id=callback_query.message.message_id)
             return
 
         confirmation_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text='✅ Да, удалить', callback_data=f'confirm_delete_admin|{client_id}')],
+            [types.InlineKeyboardButton(text='✅ Да, удалить', callback_data=pack_callback('confirm_delete_admin', short_id(client_id)))],
             [types.InlineKeyboardButton(text='❌ Нет, отменить', callback_data='view_keys')]
         ])
 
@@ -419,8 +436,8 @@ async def process_callback_delete_key(callback_query: types.CallbackQuery):
     await callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data.startswith('confirm_delete_admin|'))
-async def process_callback_confirm_delete(callback_query: types.CallbackQuery):
+@callbacks.action('confirm_delete_admin')
+async def process_callback_confirm_delete(callback_query: types.CallbackQuery, callback: CallbackData):
     """
     Подтверждает удаление ключа клиента.
 
@@ -429,9 +446,10 @@ async def process_callback_confirm_delete(callback_query: types.CallbackQuery):
 
     Args:
         callback_query (types.CallbackQuery): Данные обратного вызова от пользователя.
+        callback (CallbackData): Разобранные данные кнопки с коротким идентификатором ключа.
     """
     tg_id = callback_query.from_user.id
-    client_id = callback_query.data.split('|')[1]
+    client_id = full_id(callback.args[0])
 
     try:
         conn = await asyncpg.connect(DATABASE_URL)
@@ -469,7 +487,7 @@ async def process_callback_confirm_delete(callback_query: types.CallbackQuery):
     await callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data == "back_to_user_editor")
+@callbacks.action('back_to_user_editor')
 async def back_to_user_editor(callback_query: CallbackQuery):
     """
     Возвращает пользователя в меню редактора пользователей.
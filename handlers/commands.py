@@ -2,19 +2,18 @@ from aiogram import F, Router, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-import asyncpg
 
-from bot import bot
-from config import ADMIN_ID, DATABASE_URL
-from handlers.pay import ReplenishBalanceState, process_custom_amount_input
+from callback_router import CallbackData, callbacks
+from config import ADMIN_ID
 from handlers.profile import process_callback_view_profile
 from handlers.start import start_command
 from handlers.texts import TRIAL
 from handlers.admin.admin import cmd_add_balance
-from handlers.keys.key_management import handle_key_name_input
+from broadcast import cancel_broadcast, create_broadcast
 from aiogram.types import Message
 
 router = Router()
+fallback_router = Router(name='fallback')
 
 class Form(StatesGroup):
     """Класс состояний для управления состояниями FSM (Finite State Machine)."""
@@ -88,9 +87,8 @@ async def handle_send_trial_command(message: types.Message, state: FSMContext):
     пользователям.
 
     Проверяет, является ли пользователь администратором. Если нет,
-    отправляет сообщение об отсутствии доступа. Если да, то извлекает
-    пользователей с неиспользованными пробными ключами из базы данных и
-    отправляет им сообщения. Обрабатывает возможные ошибки при отправке сообщений.
+    отправляет сообщение об отсутствии доступа. Если да, то запускает рассылку
+    пользователям с неиспользованными пробными ключами.
 
     Args:
         message (types.Message): Сообщение, полученное от пользователя.
@@ -102,30 +100,8 @@ async def handle_send_trial_command(message: types.Message, state: FSMContext):
         return
 
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        try:
-            records = await conn.fetch('''
-                SELECT tg_id FROM connections WHERE trial = 0
-            ''')
-
-            if records:
-                for record in records:
-                    tg_id = record['tg_id']
-                    trial_message = TRIAL
-                    try:
-                        await bot.send_message(chat_id=tg_id, text=trial_message)
-                    except Exception as e:
-                        if "Forbidden: bot was blocked by the user" in str(e):
-                            print(f"Бот заблокирован пользователем с tg_id: {tg_id}")
-                        else:
-                            print(f"Ошибка при отправке сообщения пользователю {tg_id}: {e}")
-
-                await message.answer("Сообщения о пробном периоде отправлены всем пользователям с не использованным ключом.")
-            else:
-                await message.answer("Нет пользователей с не использованными пробными ключами.")
-
-        finally:
-            await conn.close()
+        broadcast_id = await create_broadcast(message.chat.id, 'trial', text=TRIAL)
+        await message.answer(f"Рассылка #{broadcast_id} о пробном периоде запущена, прогресс будет опубликован здесь.")
 
     except Exception as e:
         await message.answer(f"Ошибка при отправке сообщений: {e}")
@@ -148,65 +124,65 @@ async def send_message_to_all_clients(message: types.Message, state: FSMContext)
         await message.answer("У вас нет прав для выполнения этой команды.")
         return
 
-    await message.answer("Введите текст сообщения, который вы хотите отправить всем клиентам:")
+    await message.answer("Отправьте сообщение (текст, фото, видео и т.д.), которое вы хотите разослать всем клиентам:")
     await state.set_state(Form.waiting_for_message)
 
 @router.message(Form.waiting_for_message)
 async def process_message_to_all(message: types.Message, state: FSMContext):
     """
-    Обрабатывает ввод текстового сообщения для отправки всем клиентам.
+    Обрабатывает сообщение администратора для рассылки всем клиентам.
 
-    Получает текст сообщения и пытается соединиться с базой данных для извлечения всех идентификаторов
-    телеграм-пользователей. Затем отправляет сообщение каждому пользователю.
-    В случае возникновения ошибок при отправке сообщения или подключении к базе данных,
-    выводит соответствующее сообщение и завершает состояние.
+    Создает рассылку, которая копирует присланное сообщение (любого типа, включая медиа)
+    всем телеграм-пользователям. Рассылка выполняется в фоне, прогресс публикуется администратору.
+    В случае возникновения ошибок при создании рассылки выводит соответствующее
+    сообщение и завершает состояние.
 
     Args:
         message (types.Message): Сообщение, полученное от пользователя.
         state (FSMContext): Контекст состояния для управления состояниями.
     """
-    text_message = message.text
-
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        tg_ids = await conn.fetch('SELECT tg_id FROM connections')
-
-        for record in tg_ids:
-            tg_id = record['tg_id']
-            try:
-                await bot.send_message(chat_id=tg_id, text=text_message)
-            except Exception as e:
-                print(f"Ошибка при отправке сообщения пользователю {tg_id}: {e}. Пропускаем этого пользователя.")
-
-        await message.answer("Сообщение было отправлено всем клиентам.")
+        broadcast_id = await create_broadcast(message.chat.id, 'all', from_chat_id=message.chat.id,
+                                              message_id=message.message_id)
+        await message.answer(f"Рассылка #{broadcast_id} запущена, прогресс будет опубликован здесь.")
     except Exception as e:
-        print(f"Ошибка при подключении к базе данных: {e}")
+        print(f"Ошибка при создании рассылки: {e}")
         await message.answer("Произошла ошибка при отправке сообщения.")
-    finally:
-        await conn.close()
 
     await state.clear()
 
-@router.message()
+@callbacks.action('cancel_broadcast')
+async def handle_cancel_broadcast(callback_query: types.CallbackQuery, callback: CallbackData):
+    """
+    Останавливает рассылку по кнопке в сообщении с прогрессом.
+
+    Args:
+        callback_query (types.CallbackQuery): Объект колбека от администратора.
+        callback (CallbackData): Разобранные данные кнопки с номером рассылки.
+    """
+    if callback_query.from_user.id != ADMIN_ID:
+        await callback_query.answer("У вас нет прав для выполнения этой команды.")
+        return
+
+    broadcast_id = int(callback.args[0])
+    if await cancel_broadcast(broadcast_id):
+        await callback_query.answer(f"Рассылка #{broadcast_id} будет остановлена.")
+    else:
+        await callback_query.answer("Рассылка уже завершена.")
+
+@fallback_router.message()
 async def handle_text(message: types.Message, state: FSMContext):
     """
-    Обрабатывает текстовые сообщения от пользователей.
+    Обрабатывает сообщения, которые не подошли ни одному обработчику.
 
-    В зависимости от текста сообщения выполняет соответствующие действия:
-    отправляет команду отправки сообщения всем клиентам, обрабатывает запросы на просмотр профиля,
-    управление балансом и резервное копирование.
-    Если состояние не задано, обрабатывает команду старта.
+    Роутер подключается последним, поэтому сюда попадают только сообщения без команды
+    и без обработчика для текущего состояния. Текст "Мой профиль" открывает профиль,
+    остальные сообщения вне состояния открывают главное меню.
 
     Args:
         message (types.Message): Сообщение, полученное от пользователя.
         state (FSMContext): Контекст состояния для управления состояниями.
     """
-    current_state = await state.get_state()
-
-    if message.text in ["/send_to_all"]:
-        await send_message_to_all_clients(message, state)
-        return
-
     if message.text == "Мой профиль":
         callback_query = types.CallbackQuery(
             id="1",
@@ -218,17 +194,16 @@ async def handle_text(message: types.Message, state: FSMContext):
         await process_callback_view_profile(callback_query, state)
         return
 
-    if current_state == ReplenishBalanceState.entering_custom_amount.state:
-        await process_custom_amount_input(message, state)
-        return
+    if await state.get_state() is None:
+        await start_command(message)
 
-    if current_state == Form.waiting_for_key_name.state:
-        await handle_key_name_input(message, state)
-        return
 
-    if message.text == "/backup":
-        await backup_command(message)
-        return
+@fallback_router.callback_query()
+async def handle_unknown_callback(callback_query: types.CallbackQuery):
+    """
+    Отвечает на нажатие кнопки, для которой нет обработчика (например, в старом сообщении).
 
-    elif current_state is None:
-        await start_command(message)
\ No newline at end of file
+    Args:
+        callback_query (types.CallbackQuery): Объект колбека от пользователя.
+    """
+    await callback_query.answer("Кнопка устарела, откройте меню заново.")
@@ -1,15 +1,15 @@
 import uuid
 from datetime import datetime, timedelta
 
-from bot import dp
 import asyncpg
-from aiogram import F, Router
+from aiogram import Router
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (CallbackQuery, InlineKeyboardButton,
                            InlineKeyboardMarkup, Message)
 
 from auth import link, login_with_credentials
+from callback_router import CallbackData, callbacks, pack_callback
 from client import add_client
 from config import (ADMIN_PASSWORD, ADMIN_USERNAME, DATABASE_URL,
                     SERVERS)
@@ -28,7 +28,7 @@ class Form(StatesGroup):
     waiting_for_message = State()
 
 
-@dp.callback_query(F.data == 'create_key')
+@callbacks.action('create_key')
 async def process_callback_create_key(callback_query: CallbackQuery, state: FSMContext):
     """
     Обрабатывает нажатие кнопки создания ключа.
@@ -53,7 +53,7 @@ async def process_callback_create_key(callback_query: CallbackQuery, state: FSMC
             count = await conn.fetchval('SELECT COUNT(*) FROM keys WHERE server_id = $1', server_id)
             percent_full = (count / 60) * 100 if count <= 60 else 100
             server_name = f"{server['name']} ({percent_full:.1f}%)"
-            server_buttons.append([InlineKeyboardButton(text=server_name, callback_data=f'select_server|{server_id}')])
+            server_buttons.append([InlineKeyboardButton(text=server_name, callback_data=pack_callback('select_server', server_id))])
     finally:
         await conn.close()
 
@@ -68,11 +68,11 @@ async def process_callback_create_key(callback_query: CallbackQuery, state: FSMC
 
     await state.set_state(Form.waiting_for_server_selection)
 
-    await callback_query.answer()
+    return callback_query.answer()
 
 
-@dp.callback_query(F.data.startswith('select_server|'))
-async def select_server(callback_query: CallbackQuery, state: FSMContext):
+@callbacks.action('select_server')
+async def select_server(callback_query: CallbackQuery, state: FSMContext, callback: CallbackData):
     """
     Обрабатывает выбор сервера для создания ключа.
 
@@ -83,11 +83,12 @@ async def select_server(callback_query: CallbackQuery, state: FSMContext):
     Args:
         callback_query (CallbackQuery): Объект, представляющий нажатие кнопки.
         state (FSMContext): Контекст состояния для управления состоянием пользователя.
+        callback (CallbackData): Разобранные данные кнопки с идентификатором сервера.
 
     Returns:
         None
     """
-    server_id = callback_query.data.split('|')[1]
+    server_id = callback.args[0]
     await state.update_data(selected_server_id=server_id)
 
     conn = await asyncpg.connect(DATABASE_URL)
@@ -118,7 +119,7 @@ async def select_server(callback_query: CallbackQuery, state: FSMContext):
 
     await callback_query.answer()
 
-@dp.callback_query(F.data == 'confirm_create_new_key')
+@callbacks.action('confirm_create_new_key')
 async def confirm_create_new_key(callback_query: CallbackQuery, state: FSMContext):
     """
     Обрабатывает подтверждение создания нового ключа.
@@ -157,7 +158,7 @@ async def confirm_create_new_key(callback_query: CallbackQuery, state: FSMContex
     await callback_query.answer()
 
 
-@dp.callback_query(F.data == 'cancel_create_key')
+@callbacks.action('cancel_create_key')
 async def cancel_create_key(callback_query: CallbackQuery, state: FSMContext):
     """
     Обрабатывает отмену создания ключа.
@@ -172,10 +173,10 @@ async def cancel_create_key(callback_query: CallbackQuery, state: FSMContext):
     Returns:
         None
     """
-    await process_callback_view_profile(callback_query, state)
-    await callback_query.answer()
+    return await process_callback_view_profile(callback_query, state)
 
 
+@router.message(Form.waiting_for_key_name)
 async def handle_key_name_input(message: Message, state: FSMContext):
     """
     Обрабатывает ввод имени ключа пользователем.
@@ -285,7 +286,7 @@ async def handle_key_name_input(message: Message, state: FSMContext):
         await state.clear()
 
 
-@dp.callback_query(F.data == 'instructions')
+@callbacks.action('instructions')
 async def handle_instructions(callback_query: CallbackQuery):
     """
     Обрабатывает нажатие кнопки "Инструкции".
@@ -296,10 +297,10 @@ async def handle_instructions(callback_query: CallbackQuery):
     Args:
         callback_query (CallbackQuery): Объект обратного вызова, содержащий информацию о нажатой кнопке.
     """
-    await send_instructions(callback_query)
+    return await send_instructions(callback_query)
 
 
-@dp.callback_query(F.data == 'back_to_main')
+@callbacks.action('back_to_main')
 async def handle_back_to_main(callback_query: CallbackQuery, state: FSMContext):
     """
     Обрабатывает нажатие кнопки "Назад к главному меню".
@@ -312,5 +313,4 @@ async def handle_back_to_main(callback_query: CallbackQuery, state: FSMContext):
         callback_query (CallbackQuery): Объект обратного вызова, содержащий информацию о нажатой кнопке.
         state (FSMContext): Контекст состояния для управления состоянием, если используется конечный автомат.
     """
-    await process_callback_view_profile(callback_query, state)
-    await callback_query.answer()
\ No newline at end of file
+    return await process_callback_view_profile(callback_query, state)
\ No newline at end of file
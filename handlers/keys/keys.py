@@ -6,9 +6,11 @@ from aiogram import Router, types
 
 from auth import link, login_with_credentials
 from bot import bot
-from client import add_client, delete_client, extend_client_key
+from callback_router import CallbackData, callbacks, full_id, pack_callback, short_id
+from client import add_client, delete_client
 from config import ADMIN_PASSWORD, ADMIN_USERNAME, DATABASE_URL, SERVERS
-from database import get_balance, update_balance
+from database import get_balance
+from renewal import extend_keys, renewal_lock
 from handlers.texts import NO_KEYS
 from handlers.texts import key_message, key_relocated
 from handlers.texts import RENEWAL_PLANS, INSUFFICIENT_FUNDS_MSG, KEY_NOT_FOUND_MSG, SUCCESS_RENEWAL_MSG, ERROR_RENEWAL_MSG, PLAN_SELECTION_MSG
@@ -17,7 +19,7 @@ locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
 
 router = Router()
 
-@router.callback_query(lambda c: c.data == 'view_keys')
+@callbacks.action('view_keys')
 async def process_callback_view_keys(callback_query: types.CallbackQuery):
     tg_id = callback_query.from_user.id
 
@@ -33,7 +35,7 @@ async def process_callback_view_keys(callback_query: types.CallbackQuery):
                 for record in records:
                     key_name = record['email']
                     client_id = record['client_id']
-                    button = types.InlineKeyboardButton(text=f"🔑 {key_name}", callback_data=f'view_key|{key_name}|{client_id}')
+                    button = types.InlineKeyboardButton(text=f"🔑 {key_name}", callback_data=pack_callback('view_key', short_id(client_id)))
                     buttons.append([button])
 
                 back_button = types.InlineKeyboardButton(text='🔙 Назад', callback_data='view_profile')
@@ -63,13 +65,13 @@ async def process_callback_view_keys(callback_query: types.CallbackQuery):
     except Exception as e:
         await handle_error(tg_id, callback_query, f"Ошибка при получении ключей: {e}")
 
-    await callback_query.answer()
+    return callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data.startswith('view_key|'))
-async def process_callback_view_key(callback_query: types.CallbackQuery):
+@callbacks.action('view_key')
+async def process_callback_view_key(callback_query: types.CallbackQuery, callback: CallbackData):
     tg_id = callback_query.from_user.id
-    key_name, client_id = callback_query.data.split('|')[1], callback_query.data.split('|')[2]
+    client_id = full_id(callback.args[-1])
 
     try:
         conn = await asyncpg.connect(DATABASE_URL)
@@ -77,8 +79,8 @@ async def process_callback_view_key(callback_query: types.CallbackQuery):
             record = await conn.fetchrow('''
                 SELECT k.key, k.expiry_time, k.server_id 
                 FROM keys k
-                WHERE k.tg_id = $1 AND k.email = $2
-            ''', tg_id, key_name)
+                WHERE k.tg_id = $1 AND k.client_id = $2
+            ''', tg_id, client_id)
 
             if record:
                 key = record['key']
@@ -105,10 +107,10 @@ async def process_callback_view_key(callback_query: types.CallbackQuery):
                     key_message(key, formatted_expiry_date, days_left_message, server_name)
                 ) 
 
-                renew_button = types.InlineKeyboardButton(text='⏳ Продлить ключ', callback_data=f'renew_key|{client_id}')
+                renew_button = types.InlineKeyboardButton(text='⏳ Продлить ключ', callback_data=pack_callback('renew_key', short_id(client_id)))
                 instructions_button = types.InlineKeyboardButton(text='📘 Инструкции', callback_data='instructions')
-                delete_button = types.InlineKeyboardButton(text='❌ Удалить ключ', callback_data=f'delete_key|{client_id}')
-                change_location_button = types.InlineKeyboardButton(text='🌍 Сменить локацию', callback_data=f'change_location|{client_id}')
+                delete_button = types.InlineKeyboardButton(text='❌ Удалить ключ', callback_data=pack_callback('delete_key', short_id(client_id)))
+                change_location_button = types.InlineKeyboardButton(text='🌍 Сменить локацию', callback_data=pack_callback('change_location', short_id(client_id)))
                 back_button = types.InlineKeyboardButton(text='🔙 Назад в профиль', callback_data='view_profile')
 
                 keyboard = types.InlineKeyboardMarkup(
@@ -130,25 +132,25 @@ async def process_callback_view_key(callback_query: types.CallbackQuery):
     except Exception as e:
         await handle_error(tg_id, callback_query, f"Ошибка при получении информации о ключе: {e}")
 
-    await callback_query.answer()
+    return callback_query.answer()
 
-@router.callback_query(lambda c: c.data.startswith('delete_key|'))
-async def process_callback_delete_key(callback_query: types.CallbackQuery):
+@callbacks.action('delete_key')
+async def process_callback_delete_key(callback_query: types.CallbackQuery, callback: CallbackData):
     tg_id = callback_query.from_user.id
-    client_id = callback_query.data.split('|')[1] 
+    client_id = full_id(callback.args[0])
 
     confirmation_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-        [types.InlineKeyboardButton(text='✅ Да, удалить', callback_data=f'confirm_delete|{client_id}')],
+        [types.InlineKeyboardButton(text='✅ Да, удалить', callback_data=pack_callback('confirm_delete', short_id(client_id)))],
         [types.InlineKeyboardButton(text='❌ Нет, отменить', callback_data='view_keys')]
     ])
 
     await bot.edit_message_text("<b>Вы уверены, что хотите удалить ключ?</b>", chat_id=tg_id, message_id=callback_query.message.message_id, reply_markup=confirmation_keyboard, parse_mode="HTML")
-    await callback_query.answer()
+    return callback_query.answer()
 
-@router.callback_query(lambda c: c.data.startswith('renew_key|'))
-async def process_callback_renew_key(callback_query: types.CallbackQuery):
+@callbacks.action('renew_key')
+async def process_callback_renew_key(callback_query: types.CallbackQuery, callback: CallbackData):
     tg_id = callback_query.from_user.id
-    client_id = callback_query.data.split('|')[1] 
+    client_id = full_id(callback.args[0])
 
     try:
         conn = await asyncpg.connect(DATABASE_URL)
@@ -160,10 +162,10 @@ async def process_callback_renew_key(callback_query: types.CallbackQuery):
                 expiry_time = record['expiry_time']
                 current_time = datetime.utcnow().timestamp() * 1000  
                 keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-                    [types.InlineKeyboardButton(text=f'📅 1 месяц ({RENEWAL_PLANS["1"]["price"]} руб.)', callback_data=f'renew_plan|1|{client_id}')],
-                    [types.InlineKeyboardButton(text=f'📅 3 месяца ({RENEWAL_PLANS["3"]["price"]} руб.)', callback_data=f'renew_plan|3|{client_id}')],
-                    [types.InlineKeyboardButton(text=f'📅 6 месяцев ({RENEWAL_PLANS["6"]["price"]} руб.)', callback_data=f'renew_plan|6|{client_id}')],
-                    [types.InlineKeyboardButton(text=f'📅 12 месяцев ({RENEWAL_PLANS["12"]["price"]} руб.)', callback_data=f'renew_plan|12|{client_id}')],
+                    [types.InlineKeyboardButton(text=f'📅 1 месяц ({RENEWAL_PLANS["1"]["price"]} руб.)', callback_data=pack_callback('renew_plan', 1, short_id(client_id)))],
+                    [types.InlineKeyboardButton(text=f'📅 3 месяца ({RENEWAL_PLANS["3"]["price"]} руб.)', callback_data=pack_callback('renew_plan', 3, short_id(client_id)))],
+                    [types.InlineKeyboardButton(text=f'📅 6 месяцев ({RENEWAL_PLANS["6"]["price"]} руб.)', callback_data=pack_callback('renew_plan', 6, short_id(client_id)))],
+                    [types.InlineKeyboardButton(text=f'📅 12 месяцев ({RENEWAL_PLANS["12"]["price"]} руб.)', callback_data=pack_callback('renew_plan', 12, short_id(client_id)))],
                     [types.InlineKeyboardButton(text='🔙 Назад', callback_data='view_profile')]
                 ])
 
@@ -178,13 +180,13 @@ async def process_callback_renew_key(callback_query: types.CallbackQuery):
     except Exception as e:
         await bot.edit_message_text(f"<b>Ошибка при выборе плана:</b> {e}", chat_id=tg_id, message_id=callback_query.message.message_id, parse_mode="HTML")
 
-    await callback_query.answer()
+    return callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data.startswith('confirm_delete|'))
-async def process_callback_confirm_delete(callback_query: types.CallbackQuery):
+@callbacks.action('confirm_delete')
+async def process_callback_confirm_delete(callback_query: types.CallbackQuery, callback: CallbackData):
     tg_id = callback_query.from_user.id
-    client_id = callback_query.data.split('|')[1]
+    client_id = full_id(callback.args[0])
 
     try:
         conn = await asyncpg.connect(DATABASE_URL)
@@ -219,69 +221,112 @@ async def process_callback_confirm_delete(callback_query: types.CallbackQuery):
 
     await callback_query.answer()
 
-@router.callback_query(lambda c: c.data.startswith('renew_plan|'))
-async def process_callback_renew_plan(callback_query: types.CallbackQuery):
+@callbacks.action('renew_plan')
+async def process_callback_renew_plan(callback_query: types.CallbackQuery, callback: CallbackData):
     tg_id = callback_query.from_user.id
-    plan, client_id = callback_query.data.split('|')[1], callback_query.data.split('|')[2]
-    days_to_extend = 30 * int(plan)  
+    plan, client_id = callback.args[0], full_id(callback.args[1])
+    days_to_extend = 30 * int(plan)
 
     try:
         conn = await asyncpg.connect(DATABASE_URL)
         try:
-            record = await conn.fetchrow('SELECT email, expiry_time, server_id FROM keys WHERE client_id = $1', client_id)
+            # Ключ перечитывается под блокировкой: его могло продлить автопродление после оплаты.
+            async with renewal_lock(conn, tg_id):
+                record = await conn.fetchrow('''
+                    SELECT client_id, email, expiry_time, server_id FROM keys WHERE client_id = $1 AND tg_id = $2
+                ''', client_id, tg_id)
 
-            if record:
-                email = record['email']
-                expiry_time = record['expiry_time']
-                server_id = record['server_id']  
-                current_time = datetime.utcnow().timestamp() * 1000 
+                if record:
+                    cost = RENEWAL_PLANS[plan]['price']
 
-                if expiry_time <= current_time:
-                    new_expiry_time = int(current_time + timedelta(days=days_to_extend).total_seconds() * 1000)
+                    balance = await conn.fetchval('SELECT balance FROM connections WHERE tg_id = $1', tg_id) or 0
+                    if balance < cost:
+                        replenish_button = types.InlineKeyboardButton(text='Пополнить баланс', callback_data='replenish_balance')
+                        back_button = types.InlineKeyboardButton(text='Назад', callback_data='view_profile')
+                        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[replenish_button], [back_button]])
+
+                        await bot.edit_message_text(INSUFFICIENT_FUNDS_MSG, chat_id=tg_id, message_id=callback_query.message.message_id, reply_markup=keyboard)
+                        return
+
+                    renewed = await extend_keys(conn, tg_id, [record], days_to_extend, cost)
+
+                    if renewed:
+                        response_message = SUCCESS_RENEWAL_MSG.format(months=RENEWAL_PLANS[plan]['months'])
+                        back_button = types.InlineKeyboardButton(text='Назад', callback_data='view_profile')
+                        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[back_button]])
+                        await bot.edit_message_text(response_message, chat_id=tg_id, message_id=callback_query.message.message_id, reply_markup=keyboard)
+                    else:
+                        await bot.edit_message_text(ERROR_RENEWAL_MSG, chat_id=tg_id, message_id=callback_query.message.message_id)
                 else:
-                    new_expiry_time = int(expiry_time + timedelta(days=days_to_extend).total_seconds() * 1000)
+                    await bot.edit_message_text(KEY_NOT_FOUND_MSG, chat_id=tg_id, message_id=callback_query.message.message_id)
 
-                cost = RENEWAL_PLANS[plan]['price']
+        finally:
+            await conn.close()
 
-                balance = await get_balance(tg_id)
+    except Exception as e:
+        await bot.edit_message_text(f"Ошибка при продлении ключа: {e}", chat_id=tg_id, message_id=callback_query.message.message_id)
+
+    await callback_query.answer()
+
+@callbacks.action('renew_all')
+async def process_callback_renew_all(callback_query: types.CallbackQuery):
+    tg_id = callback_query.from_user.id
+    plan = '1'
+    days_to_extend = 30 * int(plan)
+    threshold_time = int((datetime.utcnow() + timedelta(days=1)).timestamp() * 1000)
+
+    try:
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            # Ключи выбираются под блокировкой: уже продленные автопродлением сюда не попадут.
+            async with renewal_lock(conn, tg_id):
+                records = await conn.fetch('''
+                    SELECT client_id, email, expiry_time, server_id FROM keys
+                    WHERE tg_id = $1 AND expiry_time <= $2
+                    ORDER BY server_id
+                ''', tg_id, threshold_time)
+
+                if not records:
+                    await bot.edit_message_text(KEY_NOT_FOUND_MSG, chat_id=tg_id, message_id=callback_query.message.message_id)
+                    await callback_query.answer()
+                    return
+
+                cost = RENEWAL_PLANS[plan]['price'] * len(records)
+                balance = await conn.fetchval('SELECT balance FROM connections WHERE tg_id = $1', tg_id) or 0
                 if balance < cost:
                     replenish_button = types.InlineKeyboardButton(text='Пополнить баланс', callback_data='replenish_balance')
                     back_button = types.InlineKeyboardButton(text='Назад', callback_data='view_profile')
                     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[replenish_button], [back_button]])
 
                     await bot.edit_message_text(INSUFFICIENT_FUNDS_MSG, chat_id=tg_id, message_id=callback_query.message.message_id, reply_markup=keyboard)
+                    await callback_query.answer()
                     return
 
-                session = await login_with_credentials(server_id, ADMIN_USERNAME, ADMIN_PASSWORD)
-                success = await extend_client_key(session, server_id, tg_id, client_id, email, new_expiry_time)
+                renewed = await extend_keys(conn, tg_id, records, days_to_extend, RENEWAL_PLANS[plan]['price'])
 
-                if success:
-                    await update_balance(tg_id, -cost)
-                    await conn.execute('UPDATE keys SET expiry_time = $1 WHERE client_id = $2', new_expiry_time, client_id)
-                    response_message = SUCCESS_RENEWAL_MSG.format(months=RENEWAL_PLANS[plan]['months'])
-                    back_button = types.InlineKeyboardButton(text='Назад', callback_data='view_profile')
-                    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[back_button]])
-                    await bot.edit_message_text(response_message, chat_id=tg_id, message_id=callback_query.message.message_id, reply_markup=keyboard)
-                else:
-                    await bot.edit_message_text(ERROR_RENEWAL_MSG, chat_id=tg_id, message_id=callback_query.message.message_id)
+            back_button = types.InlineKeyboardButton(text='Назад', callback_data='view_profile')
+            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[back_button]])
+            if len(renewed) == len(records):
+                response_message = SUCCESS_RENEWAL_MSG.format(months=RENEWAL_PLANS[plan]['months'])
             else:
-                await bot.edit_message_text(KEY_NOT_FOUND_MSG, chat_id=tg_id, message_id=callback_query.message.message_id)
+                response_message = f"Продлено ключей: {len(renewed)} из {len(records)}. {ERROR_RENEWAL_MSG}"
+            await bot.edit_message_text(response_message, chat_id=tg_id, message_id=callback_query.message.message_id, reply_markup=keyboard)
 
         finally:
             await conn.close()
 
     except Exception as e:
-        await bot.edit_message_text(f"Ошибка при продлении ключа: {e}", chat_id=tg_id, message_id=callback_query.message.message_id)
+        await bot.edit_message_text(f"Ошибка при продлении ключей: {e}", chat_id=tg_id, message_id=callback_query.message.message_id)
 
     await callback_query.answer()
 
 async def handle_error(tg_id, callback_query, message):
     await bot.edit_message_text(message, chat_id=tg_id, message_id=callback_query.message.message_id)
 
-@router.callback_query(lambda c: c.data.startswith('change_location|'))
-async def process_callback_change_location(callback_query: types.CallbackQuery):
+@callbacks.action('change_location')
+async def process_callback_change_location(callback_query: types.CallbackQuery, callback: CallbackData):
     tg_id = callback_query.from_user.id
-    client_id = callback_query.data.split('|')[1] 
+    client_id = full_id(callback.args[0])
     server_buttons = []
     conn = await asyncpg.connect(DATABASE_URL)
     try:
@@ -289,7 +334,7 @@ async def process_callback_change_location(callback_query: types.CallbackQuery):
             count = await conn.fetchval('SELECT COUNT(*) FROM keys WHERE server_id = $1', server_id)
             percent_full = (count / 60) * 100 if count <= 60 else 100  
             server_name = f"{server['name']} ({percent_full:.1f}%)"
-            server_buttons.append([types.InlineKeyboardButton(text=server_name, callback_data=f'select_server&{server_id}&{client_id}')])
+            server_buttons.append([types.InlineKeyboardButton(text=server_name, callback_data=pack_callback('move_key', server_id, short_id(client_id)))])
     finally:
         await conn.close()
 
@@ -297,12 +342,15 @@ async def process_callback_change_location(callback_query: types.CallbackQuery):
     
     response_message = "<b>Выберите новый сервер для вашего ключа:</b>"
     await bot.edit_message_text(response_message, chat_id=tg_id, message_id=callback_query.message.message_id, reply_markup=keyboard, parse_mode="HTML")
-    await callback_query.answer()
+    return callback_query.answer()
+
+callbacks.legacy('select_server&', 'move_key', separator='&')
+
 
-@router.callback_query(lambda c: c.data.startswith('select_server&'))
-async def process_callback_select_server(callback_query: types.CallbackQuery):
+@callbacks.action('move_key')
+async def process_callback_select_server(callback_query: types.CallbackQuery, callback: CallbackData):
     tg_id = callback_query.from_user.id
-    server_id, client_id = callback_query.data.split('&')[1], callback_query.data.split('&')[2]
+    server_id, client_id = callback.args[0], full_id(callback.args[1])
 
     try:
         conn = await asyncpg.connect(DATABASE_URL)
@@ -1,15 +1,17 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import asyncpg
-import asyncio
 from aiogram import Bot
 from aiogram.fsm.state import State, StatesGroup
 import logging
+import config
 from config import DATABASE_URL, ADMIN_USERNAME, ADMIN_PASSWORD, SERVERS
-from database import get_balance, update_key_expiry, delete_key
-from client import extend_client_key, delete_client
+from database import delete_key
+from client import delete_client
 from auth import login_with_credentials
-from handlers.texts import KEY_EXPIRY_10H, KEY_EXPIRY_24H, KEY_RENEWED, KEY_RENEWAL_FAILED, KEY_DELETED, \
-    KEY_DELETION_FAILED
+from callback_router import pack_callback, short_id
+from handlers.texts import KEY_EXPIRY_10H, KEY_EXPIRY_24H, KEY_RENEWAL_FAILED, KEY_DELETED, KEY_DELETION_FAILED, RENEWAL_PLANS
+from outbox import enqueue_message
+from renewal import extend_keys, renewal_lock
 from aiogram import Router, types
 
 logging.basicConfig(level=logging.INFO)
@@ -17,6 +19,25 @@ logger = logging.getLogger(__name__)
 
 router = Router()
 
+# Правила напоминаний: за сколько часов до истечения ключа отправить напоминание и каким шаблоном.
+# Шаблон форматируется полями server_id, email, expiry_date, hours_left и balance.
+REMINDER_RULES = sorted(
+    getattr(config, 'REMINDER_RULES', [
+        {'hours': 24, 'template': KEY_EXPIRY_24H},
+        {'hours': 10, 'template': KEY_EXPIRY_10H},
+    ]),
+    key=lambda rule: rule['hours'],
+    reverse=True
+)
+
+
+# Автопродление ключа: тариф (тот же, что у кнопок продления), его стоимость и срок, а также за сколько
+# часов до истечения ключ продлевается сразу после пополнения баланса.
+AUTO_RENEW_PLAN = '1'
+AUTO_RENEW_PRICE = RENEWAL_PLANS[AUTO_RENEW_PLAN]['price']
+AUTO_RENEW_DAYS = 30 * int(AUTO_RENEW_PLAN)
+AUTO_RENEW_WINDOW_HOURS = getattr(config, 'AUTO_RENEW_WINDOW_HOURS', 24)
+
 
 class NotificationStates(StatesGroup):
     waiting_for_notification_text = State()
@@ -24,14 +45,14 @@ class NotificationStates(StatesGroup):
 
 async def notify_expiring_keys(bot: Bot):
     """
-    Уведомляет пользователей о ключах, срок действия которых истекает в ближайшие 10 и 24 часа,
+    Отправляет напоминания об истекающих ключах по правилам REMINDER_RULES,
     а также обрабатывает истекшие ключи.
 
     Args:
         bot (Bot): Объект бота для отправки сообщений.
 
-    Этот метод создает соединение с базой данных, проверяет, какие ключи истекают в ближайшее время,
-    отправляет соответствующие уведомления и обновляет статус уведомлений в базе данных.
+    Этот метод создает соединение с базой данных, одним запросом находит ключи, для которых
+    наступил очередной этап напоминания, ставит уведомления в очередь и обновляет этапы в базе данных.
     """
     conn = None
     try:
@@ -39,150 +60,159 @@ async def notify_expiring_keys(bot: Bot):
         logger.info("Подключение к базе данных успешно.")
 
         current_time = datetime.utcnow().timestamp() * 1000
-        threshold_time_10h = (datetime.utcnow() + timedelta(hours=10)).timestamp() * 1000
-        threshold_time_24h = (datetime.utcnow() + timedelta(days=1)).timestamp() * 1000
 
         logger.info("Начало обработки уведомлений.")
 
-        await notify_10h_keys(bot, conn, current_time, threshold_time_10h)
-        await asyncio.sleep(1)  # Задержка между уведомлениями за 10 часов и 24 часа
-        await notify_24h_keys(bot, conn, current_time, threshold_time_24h)
-        await asyncio.sleep(1)  # Задержка перед обработкой истекших ключей
+        await notify_due_reminders(bot, conn, current_time)
         await handle_expired_keys(bot, conn, current_time)
 
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомлений: {e}")
+        raise
     finally:
         if conn:
             await conn.close()
             logger.info("Соединение с базой данных закрыто.")
 
 
-async def is_bot_blocked(bot: Bot, chat_id: int) -> bool:
+def group_by_user(records) -> dict:
     """
-    Проверяет, заблокирован ли бот в чате.
+    Группирует записи ключей по tg_id, сохраняя порядок.
 
     Args:
-        bot (Bot): Объект бота для выполнения запроса.
-        chat_id (int): ID чата, в котором проверяется статус бота.
+        records: Записи ключей с полем tg_id.
 
     Returns:
-        bool: True, если бот заблокирован, иначе False.
+        dict: Словарь tg_id -> список записей ключей пользователя.
     """
-    try:
-        member = await bot.get_chat_member(chat_id, bot.id)
-        return member.status == 'left'
-    except Exception as e:
-        logger.error(f"Ошибка при проверке статуса бота у пользователя {chat_id}: {e}")
-        return False
+    grouped = {}
+    for record in records:
+        grouped.setdefault(record['tg_id'], []).append(record)
+    return grouped
 
 
-async def notify_10h_keys(bot: Bot, conn: asyncpg.Connection, current_time: float, threshold_time_10h: float):
+def build_renew_keyboard(records) -> types.InlineKeyboardMarkup:
     """
-    Уведомляет пользователей о ключах, срок действия котор
-
-Нейрокот, [11.12.2024 22:01]
-ых истекает в течение следующих 10 часов.
+    Формирует клавиатуру уведомления: кнопка продления для каждого ключа
+    и, если ключей несколько, кнопка продления всех ключей сразу.
 
     Args:
-        bot (Bot): Объект бота для отправки сообщений.
-        conn (asyncpg.Connection): Соединение с базой данных.
-        current_time (float): Текущее время в миллисекундах.
-        threshold_time_10h (float): Время в миллисекундах, после которого ключи истекают через 10 часов.
+        records: Записи ключей одного пользователя.
 
-    Этот метод извлекает ключи из базы данных, срок действия которых истекает в ближайшие 10 часов,
-    отправляет уведомления пользователям и обновляет статус уведомлений в базе данных.
+    Returns:
+        types.InlineKeyboardMarkup: Клавиатура уведомления.
     """
-    records = await conn.fetch('''
-        SELECT tg_id, email, expiry_time, client_id, server_id FROM keys 
-        WHERE expiry_time <= $1 AND expiry_time > $2 AND notified = FALSE
-    ''', threshold_time_10h, current_time)
+    if len(records) == 1:
+        return types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text='🔄 Продлить VPN',
+                                        callback_data=pack_callback('renew_key', short_id(records[0]['client_id'])))],
+        ])
+
+    buttons = [
+        [types.InlineKeyboardButton(text=f'🔄 Продлить {record["email"]}',
+                                    callback_data=pack_callback('renew_key', short_id(record['client_id'])))]
+        for record in records
+    ]
+    buttons.append([types.InlineKeyboardButton(text='🔄 Продлить все', callback_data='renew_all')])
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def build_expiry_digest(records, balance: float) -> str:
+    """
+    Формирует одно сообщение со списком всех истекающих ключей пользователя.
 
-    logger.info(f"Найдено {len(records)} ключей для уведомления за 10 часов.")
+    Args:
+        records: Записи ключей одного пользователя.
+        balance (float): Баланс пользователя.
+
+    Returns:
+        str: Текст сообщения.
+    """
+    lines = ["⏳ Срок действия ваших ключей скоро истекает:\n"]
     for record in records:
-        tg_id = record['tg_id']
-        email = record['email']
-        expiry_time = record['expiry_time']
-        server_id = record['server_id']
-        expiry_date = datetime.utcfromtimestamp(expiry_time / 1000).strftime('%Y-%m-%d %H:%M:%S')
+        server_name = SERVERS.get(record['server_id'], {}).get('name', record['server_id'])
+        expiry_date = datetime.utcfromtimestamp(record['expiry_time'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
+        lines.append(f"• {record['email']} ({server_name}) — до {expiry_date}")
+    lines.append(f"\nВаш баланс: {balance} руб. Продлите ключи, чтобы не потерять доступ к VPN.")
+    return "\n".join(lines)
 
-        message = KEY_EXPIRY_10H.format(server_id=SERVERS[server_id]['name'], email=email, expiry_date=expiry_date)
 
-        if not await is_bot_blocked(bot, tg_id):
-            try:
-                keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-                    [types.InlineKeyboardButton(text='🔄 Продлить VPN',
-                                                callback_data=f'renew_key|{record["client_id"]}')],
-                ])
-                await bot.send_message(tg_id, message, reply_markup=keyboard)
-                logger.info(f"Уведомление отправлено пользователю {tg_id}.")
-            except Exception as e:
-                logger.error(f"Ошибка при отправке уведомления пользователю {tg_id}: {e}")
-                continue
+def format_reminder(record, rule: dict) -> str:
+    """
+    Формирует текст напоминания об одном ключе по шаблону правила.
 
-            await conn.execute('UPDATE keys SET notified = TRUE WHERE client_id = $1', record['client_id'])
-            logger.info(f"Обновлено поле notified для клиента {record['client_id']}.")
+    Args:
+        record: Запись ключа с полями email, expiry_time, server_id и balance.
+        rule (dict): Правило напоминания из REMINDER_RULES.
 
-        await asyncio.sleep(1)
+    Returns:
+        str: Текст сообщения.
+    """
+    time_left = (record['expiry_time'] / 1000) - datetime.utcnow().timestamp()
+    hours_left = max(0, int(time_left // 3600))
+    expiry_date = datetime.utcfromtimestamp(record['expiry_time'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
+    return rule['template'].format(
+        server_id=SERVERS[record['server_id']]['name'], email=record['email'], hours_left=hours_left,
+        expiry_date=expiry_date, balance=record['balance']
+    )
 
 
-async def notify_24h_keys(bot: Bot, conn: asyncpg.Connection, current_time: float, threshold_time_24h: float):
+async def notify_due_reminders(bot: Bot, conn: asyncpg.Connection, current_time: float):
     """
-    Уведомляет пользователей о ключах, срок действия которых истекает в течение следующих 24 часов.
+    Отправляет напоминания по всем ключам, для которых наступил очередной этап.
 
     Args:
         bot (Bot): Объект бота для отправки сообщений.
         conn (asyncpg.Connection): Соединение с базой данных.
-        current_tim
-
-Нейрокот, [11.12.2024 22:01]
-e (float): Текущее время в миллисекундах.
-        threshold_time_24h (float): Время в миллисекундах, после которого ключи истекают через 24 часа.
+        current_time (float): Текущее время в миллисекундах.
 
-    Этот метод извлекает ключи из базы данных, срок действия которых истекает в ближайшие 24 часа,
-    отправляет уведомления пользователям и обновляет статус уведомлений в базе данных.
+    В колонке keys.reminder_sent_hours хранится, за сколько часов до истечения отправлено последнее
+    напоминание (NULL - еще не отправлялось). Наступившим считается правило с наименьшим числом
+    часов, срок которого уже подошел; напоминание отправляется, если это правило позже отправленного.
+    Так добавление и удаление правил не сдвигает уже отправленные напоминания. Один запрос по индексу
+    на expiry_time возвращает все такие ключи, так что число правил не увеличивает число просмотров
+    таблицы. Если ключ пропустил несколько правил, отправляется только самое позднее. Пользователь
+    получает одно сообщение со всеми своими ключами.
     """
-    logger.info("Проверка истекших ключей...")
-
-    records_24h = await conn.fetch('''
-        SELECT tg_id, email, expiry_time, client_id, server_id FROM keys 
-        WHERE expiry_time <= $1 AND expiry_time > $2 AND notified_24h = FALSE
-    ''', threshold_time_24h, current_time)
+    if not REMINDER_RULES:
+        return
 
-    logger.info(f"Найдено {len(records_24h)} ключей для уведомления за 24 часа.")
-    for record in records_24h:
-        tg_id = record['tg_id']
-        email = record['email']
-        expiry_time = record['expiry_time']
-        server_id = record['server_id']
-
-        time_left = (expiry_time / 1000) - datetime.utcnow().timestamp()
-        hours_left = max(0, int(time_left // 3600))
-
-        expiry_date = datetime.utcfromtimestamp(expiry_time / 1000).strftime('%Y-%m-%d %H:%M:%S')
-        balance = await get_balance(tg_id)
-
-        message_24h = KEY_EXPIRY_24H.format(server_id=SERVERS[server_id]['name'], email=email, hours_left=hours_left,
-                                            expiry_date=expiry_date, balance=balance)
-
-        if not await is_bot_blocked(bot, tg_id):
-            try:
-                keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-                    [types.InlineKeyboardButton(text='🔄 Продлить VPN',
-                                                callback_data=f'renew_key|{record["client_id"]}')],
-                ])
-                await bot.send_message(tg_id, message_24h, reply_markup=keyboard)
-                logger.info(f"Уведомление за 24 часа отправлено пользователю {tg_id}.")
-            except Exception as e:
-                logger.error(f"Ошибка при отправке уведомления за 24 часа пользователю {tg_id}: {e}")
-                continue
-
-            await conn.execute('UPDATE keys SET notified_24h = TRUE WHERE client_id = $1', record['client_id'])
-            logger.info(f"Обновлено поле notified_24h для клиента {record['client_id']}.")
+    current_time = int(current_time)
+    rules = {float(rule['hours']): rule for rule in REMINDER_RULES}
+    hours = list(rules)
 
-        await asyncio.sleep(1)
+    records = await conn.fetch('''
+        SELECT k.tg_id, k.email, k.expiry_time, k.client_id, k.server_id, COALESCE(c.balance, 0) AS balance,
+               due.hours
+        FROM keys k
+        LEFT JOIN connections c ON c.tg_id = k.tg_id
+        CROSS JOIN LATERAL (
+            SELECT MIN(r.hours) AS hours
+            FROM unnest($3::float8[]) AS r(hours)
+            WHERE k.expiry_time <= $1 + r.hours * 3600000
+        ) due
+        WHERE k.expiry_time > $1 AND k.expiry_time <= $1 + $2
+          AND (k.reminder_sent_hours IS NULL OR due.hours < k.reminder_sent_hours)
+        ORDER BY k.tg_id, k.expiry_time
+    ''', current_time, int(max(hours) * 3600 * 1000), hours)
+
+    users = group_by_user(records)
+    logger.info(f"Найдено {len(records)} ключей у {len(users)} пользователей для напоминаний.")
+    for tg_id, user_records in users.items():
+        if len(user_records) == 1:
+            record = user_records[0]
+            message = format_reminder(record, rules[record['hours']])
+        else:
+            message = build_expiry_digest(user_records, user_records[0]['balance'])
 
-        await bot.send_message(tg_id, KEY_RENEWED, reply_markup=keyboard)
+        async with conn.transaction():
+            await enqueue_message(tg_id, message, reply_markup=build_renew_keyboard(user_records), conn=conn)
+            await conn.execute('''
+                UPDATE keys SET reminder_sent_hours = due.hours
+                FROM unnest($1::text[], $2::float8[]) AS due(client_id, hours)
+                WHERE keys.client_id = due.client_id
+            ''', [record['client_id'] for record in user_records], [record['hours'] for record in user_records])
+        logger.info(f"Напоминание для пользователя {tg_id} ({len(user_records)} ключей) поставлено в очередь.")
 
 
 async def handle_expired_keys(bot: Bot, conn: asyncpg.Connection, current_time: float):
@@ -198,73 +228,144 @@ async def handle_expired_keys(bot: Bot, conn: asyncpg.Connection, current_time:
         Текущая временная метка в формате UNIX, используемая для проверки истекших ключей.
 
     Логика работы:
-    - Запрашивает из базы данных ключи, срок действия которых истек.
-    - Для каждого найденного ключа проверяет баланс пользователя.
-    - Если баланс >= 100, продлевает срок действия ключа на 30 дней и уведомляет пользователя.
-    - Если баланс < 100, удаляет ключ и уведомляет пользователя об этом.
+    - Запрашивает из базы данных пользователей, у которых есть истекшие ключи.
+    - Ключи каждого пользователя обрабатываются под renewal_lock, как и все остальные пути
+      продления, и перечитываются под ней: ключ, продленный после оплаты, пока шла проверка,
+      пропускается.
+    - Если баланс >= AUTO_RENEW_PRICE, списывает его и продлевает ключ на AUTO_RENEW_DAYS дней.
+      Новый срок и списание фиксируются одной транзакцией.
+    - Иначе удаляет ключ и уведомляет пользователя об этом.
     - Обрабатывает возможные ошибки при отправке уведомлений пользователям.
     """
     logger.info("Проверка истекших ключей...")
 
     current_time = int(current_time)
-    expiring_keys = await conn.fetch('''
-        SELECT tg_id, client_id, expiry_time, server_id, email FROM keys 
+    users = await conn.fetch('''
+        SELECT DISTINCT tg_id FROM keys
         WHERE expiry_time <= $1
     ''', current_time)
 
-    logger.info(f"Найдено {len(expiring_keys)} истекающих ключей.")
+    logger.info(f"Найдено {len(users)} пользователей с истекшими ключами.")
 
-    for record in expiring_keys:
-        tg_id = record['tg_id']
-        client_id = record['client_id']
-        balance = await get_balance(tg_id)
-        server_id = record['server_id']
-        email = record['email']
+    for user in users:
+        tg_id = user['tg_id']
+        async with renewal_lock(conn, tg_id):
+            expired_keys = await conn.fetch('''
+                SELECT client_id, expiry_time, server_id, email FROM keys
+                WHERE tg_id = $1 AND expiry_time <= $2
+                ORDER BY expiry_time
+            ''', tg_id, current_time)
+            for record in expired_keys:
+                await handle_expired_key(conn, tg_id, record)
 
-        logger.info(f"Проверка баланса для клиента {tg_id}: {balance}.")
 
-        button_profile = types.InlineKeyboardButton(text='👤 Мой профиль', callback_data='view_profile')
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[button_profile]])
+async def handle_expired_key(conn: asyncpg.Connection, tg_id: int, record):
+    """
+    Продлевает или удаляет один истекший ключ. Вызывается под блокировкой пользователя.
 
-        if balance >= 100:
-            new_expiry_time = int((datetime.utcnow() + timedelta(days=30)).timestamp() * 1000)
-            await update_key_expiry(client_id, new_expiry_time)
+    Args:
+        conn (asyncpg.Connection): Соединение, которое держит блокировку пользователя.
+        tg_id (int): ID пользователя в Telegram.
+        record: Запись ключа с полями client_id, expiry_time, server_id и email.
+    """
+    client_id = record['client_id']
+    server_id = record['server_id']
+    balance = await conn.fetchval('SELECT balance FROM connections WHERE tg_id = $1', tg_id) or 0
+
+    logger.info(f"Проверка баланса для клиента {tg_id}: {balance}.")
+
+    button_profile = types.InlineKeyboardButton(text='👤 Мой профиль', callback_data='view_profile')
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[button_profile]])
+
+    if balance >= AUTO_RENEW_PRICE:
+        renewed = await extend_keys(conn, tg_id, [record], AUTO_RENEW_DAYS, AUTO_RENEW_PRICE)
+        if renewed:
+            new_expiry_time = renewed[0][1]
             logger.info(
                 f"Ключ для клиента {tg_id} продлен до {datetime.utcfromtimestamp(new_expiry_time / 1000).strftime('%Y-%m-%d %H:%M:%S')}.")
-
-            session = await login_with_credentials(server_id, ADMIN_USERNAME, ADMIN_PASSWORD)
-            success = await extend_client_key(session, server_id, tg_id, client_id, email, new_expiry_time)
-            if success:
-                try:
-
-                    logger.info(f"Ключ для пользователя {tg_id} успешно продлен на месяц.")
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления о продлении ключа пользователю {tg_id}: {e}")
-            else:
-                try:
-                    await bot.send_message(tg_id, KEY_RENEWAL_FAILED, reply_markup=keyboard)
-                    logger.error(f"Не удалось продлить ключ для пользователя {tg_id}.")
-                except Exception as e:
-                    logger.error(
-                        f"Ошибка при отправке уведомления о неудачном продлении ключа пользователю {tg_id}: {e}")
         else:
-            await delete_key(client_id)
-            logger.info(f"Ключ для клиента {tg_id} удален из-за недостаточного баланса.")
-
-            session = await login_with_credentials(server_id, ADMIN_USERNAME, ADMIN_PASSWORD)
+            await enqueue_message(tg_id, KEY_RENEWAL_FAILED, reply_markup=keyboard, conn=conn)
+            logger.error(f"Не удалось продлить ключ для пользователя {tg_id}.")
+    else:
+        await delete_key(client_id)
+        logger.info(f"Ключ для клиента {tg_id} удален из-за недостаточного баланса.")
+
+        session = await login_with_credentials(server_id, ADMIN_USERNAME, ADMIN_PASSWORD)
+        try:
             success = await delete_client(session, server_id, client_id)
-            if success:
-                try:
-                    await bot.send_message(tg_id, KEY_DELETED, reply_markup=keyboard)
-                    logger.info(f"Ключ для пользователя {tg_id} удален.")
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления об удалении ключа пользователю {tg_id}: {e}")
-            else:
-                try:
-                    await bot.send_message(tg_id, KEY_DELETION_FAILED, reply_markup=keyboard)
-                    logger.error(f"Не удалось удалить ключ для пользователя {tg_id}.")
-                except Exception as e:
-                    logger.error(
-                        f"Ошибка при отправке уведомления о неудачном удалении ключа пользователю {tg_id}: {e}")
-
-        await asyncio.sleep(1)
+        finally:
+            await session.close()
+        if success:
+            await enqueue_message(tg_id, KEY_DELETED, reply_markup=keyboard, conn=conn)
+            logger.info(f"Ключ для пользователя {tg_id} удален.")
+        else:
+            await enqueue_message(tg_id, KEY_DELETION_FAILED, reply_markup=keyboard, conn=conn)
+            logger.error(f"Не удалось удалить ключ для пользователя {tg_id}.")
+
+
+def build_renewal_summary(renewed) -> str:
+    """
+    Формирует одно сообщение о продленных после пополнения ключах.
+
+    Args:
+        renewed: Список пар (запись ключа, новое время истечения в миллисекундах).
+
+    Returns:
+        str: Текст сообщения.
+    """
+    lines = ["✅ После пополнения баланса продлены ключи:\n"]
+    for record, new_expiry_time in renewed:
+        server_name = SERVERS.get(record['server_id'], {}).get('name', record['server_id'])
+        expiry_date = datetime.utcfromtimestamp(new_expiry_time / 1000).strftime('%Y-%m-%d %H:%M:%S')
+        lines.append(f"• {record['email']} ({server_name}) — до {expiry_date}")
+    lines.append(f"\nСписано: {AUTO_RENEW_PRICE * len(renewed)} руб.")
+    return "\n".join(lines)
+
+
+async def renew_user_keys(tg_id: int) -> list:
+    """
+    Продлевает истекшие и истекающие в ближайшие AUTO_RENEW_WINDOW_HOURS часов ключи пользователя.
+    Вызывается воркером очереди renewal_jobs после зачисления платежа, чтобы пользователю
+    не пришлось ждать ежечасной проверки в handle_expired_keys.
+
+    Args:
+        tg_id (int): ID пользователя в Telegram.
+
+    Returns:
+        list: Список пар (запись ключа, новое время истечения) продленных ключей.
+
+    Raises:
+        RuntimeError: Если продлены не все выбранные ключи. Задание повторяется, и уже продленные
+            ключи в него больше не попадают: их новый срок дальше AUTO_RENEW_WINDOW_HOURS.
+
+    Ключи продлеваются по порядку истечения, пока хватает баланса (см. renewal.extend_keys), после
+    чего пользователь получает одно уведомление. Ключи выбираются под renewal_lock, поэтому два
+    одновременно обработанных платежа или нажатие кнопки продления не продлят одни и те же ключи дважды.
+    """
+    threshold_time = int(datetime.utcnow().timestamp() * 1000) + AUTO_RENEW_WINDOW_HOURS * 3600 * 1000
+
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        async with renewal_lock(conn, tg_id):
+            records = await conn.fetch('''
+                SELECT client_id, email, expiry_time, server_id FROM keys
+                WHERE tg_id = $1 AND expiry_time <= $2
+                ORDER BY expiry_time
+            ''', tg_id, threshold_time)
+            balance = await conn.fetchval('SELECT balance FROM connections WHERE tg_id = $1', tg_id) or 0
+            records = records[:int(balance // AUTO_RENEW_PRICE)]
+            if not records:
+                return []
+
+            renewed = await extend_keys(conn, tg_id, records, AUTO_RENEW_DAYS, AUTO_RENEW_PRICE)
+            if renewed:
+                keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                    [types.InlineKeyboardButton(text='👤 Мой профиль', callback_data='view_profile')]
+                ])
+                await enqueue_message(tg_id, build_renewal_summary(renewed), reply_markup=keyboard, conn=conn)
+                logger.info(f"После пополнения продлено {len(renewed)} ключей пользователя {tg_id}.")
+            if len(renewed) < len(records):
+                raise RuntimeError(f"продлено {len(renewed)} из {len(records)} ключей")
+            return renewed
+    finally:
+        await conn.close()
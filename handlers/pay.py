@@ -1,28 +1,34 @@
 import logging
-import uuid
+
 from aiogram import Router, types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiohttp import web
-from yookassa import Configuration, Payment
 
+import config
 from bot import bot
-from config import YOOKASSA_SECRET_KEY, YOOKASSA_SHOP_ID
-from database import (add_connection, check_connection_exists, get_key_count,
+from callback_router import CallbackData, callbacks
+from database import (add_connection, add_payment, check_connection_exists,
+                      get_key_count, get_pending_payment,
+                      mark_payment_succeeded, set_payment_status,
                       update_balance)
 from handlers.profile import process_callback_view_profile
 from handlers.texts import PAYMENT_OPTIONS
+from metrics import counter
+from outbox import enqueue_message
+from payment_gateway import PaymentGatewayError, build_payment_payload, gateway
+from payment_inbox import store_payment_event
+from renewal_jobs import enqueue_renewal
 
 router = Router()
 
 logging.basicConfig(level=logging.DEBUG)
 
-Configuration.account_id = YOOKASSA_SHOP_ID
-Configuration.secret_key = YOOKASSA_SECRET_KEY
+PAYMENT_LINK_TTL = getattr(config, 'PAYMENT_LINK_TTL', 1800)
 
-logging.debug(f"Account ID: {YOOKASSA_SHOP_ID}")
-logging.debug(f"Secret Key: {YOOKASSA_SECRET_KEY}")
+payment_link_reused = counter('payment_link_reused_total', 'Повторно выданные ссылки на оплату')
+payment_link_created = counter('payment_link_created_total', 'Созданные платежи на пополнение')
 
 
 class ReplenishBalanceState(StatesGroup):
@@ -31,7 +37,7 @@ class ReplenishBalanceState(StatesGroup):
     entering_custom_amount = State()
 
 
-@router.callback_query(lambda c: c.data == 'enter_custom_amount')
+@callbacks.action('enter_custom_amount')
 async def process_enter_custom_amount(callback_query: types.CallbackQuery, state: FSMContext):
     """
     Обрабатывает нажатие кнопки для ввода пользовательской суммы пополнения.
@@ -75,7 +81,37 @@ async def send_message_with_deletion(chat_id, text, reply_markup=None, state=Non
     return sent_message
 
 
-@router.callback_query(lambda c: c.data == 'replenish_balance')
+async def create_topup_payment(tg_id: int, full_name: str, amount: int) -> dict:
+    """
+    Создает платеж на пополнение баланса в ЮKassa и сохраняет его в таблицу payments.
+
+    Если у пользователя уже есть неоплаченный платеж на ту же сумму моложе PAYMENT_LINK_TTL секунд,
+    возвращается он, и шлюз не вызывается. Платеж перестает переиспользоваться, как только вебхук
+    или сверка переводят его в succeeded или canceled.
+
+    :param tg_id: ID пользователя в Telegram.
+    :param full_name: Имя пользователя для чека.
+    :param amount: Сумма пополнения в рублях.
+    :return: Объект платежа ЮKassa.
+    :raises PaymentGatewayError: Если платеж не удалось создать.
+    """
+    pending = await get_pending_payment(tg_id, amount, PAYMENT_LINK_TTL)
+    if pending:
+        payment_link_reused.inc()
+        return {
+            'id': pending['payment_id'],
+            'status': 'pending',
+            'confirmation': {'type': 'redirect', 'confirmation_url': pending['confirmation_url']},
+        }
+
+    payment = await gateway.create_payment(build_payment_payload(amount, tg_id, full_name))
+    payment_link_created.inc()
+    confirmation_url = payment.get('confirmation', {}).get('confirmation_url')
+    await add_payment(payment['id'], tg_id, amount, payment['status'], confirmation_url)
+    return payment
+
+
+@callbacks.action('replenish_balance')
 async def process_callback_replenish_balance(callback_query: types.CallbackQuery, state: FSMContext):
     """
     Обрабатывает нажатие кнопки пополнения баланса и отображает клавиатуру с вариантами суммы.
@@ -114,10 +150,10 @@ async def process_callback_replenish_balance(callback_query: types.CallbackQuery
         reply_markup=amount_keyboard
     )
     await state.set_state(ReplenishBalanceState.choosing_amount)
-    await callback_query.answer()
+    return callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data == 'back_to_profile')
+@callbacks.action('back_to_profile')
 async def back_to_profile_handler(callback_query: types.CallbackQuery, state: FSMContext):
     """
     Обрабатывает нажатие кнопки "Назад к профилю" и перенаправляет пользователя к просмотру профиля.
@@ -125,25 +161,29 @@ async def back_to_profile_handler(callback_query: types.CallbackQuery, state: FS
     :param callback_query: Объект обратного вызова, содержащий информацию о нажатой кнопке.
     :param state: Контекст состояния конечного автомата, используемый для хранения информации о состоянии пользователя.
     """
-    await process_callback_view_profile(callback_query, state)
+    return await process_callback_view_profile(callback_query, state)
+
+
+callbacks.legacy('amount_', 'amount')
 
 
-@router.callback_query(lambda c: c.data.startswith('amount_'))
-async def process_amount_selection(callback_query: types.CallbackQuery, state: FSMContext):
+@callbacks.action('amount')
+async def process_amount_selection(callback_query: types.CallbackQuery, state: FSMContext, callback: CallbackData):
     """
     Обрабатывает выбор суммы пополнения и инициирует создание платежа.
 
+    Кнопки сумм из PAYMENT_OPTIONS имеют вид amount_100, они разбираются как legacy-формат.
+
     :param callback_query: Объект обратного вызова, содержащий информацию о нажатой кнопке.
     :param state: Контекст состояния конечного автомата, используемый для хранения информации о состоянии пользователя.
+    :param callback: Разобранные данные кнопки с выбранной суммой.
     """
-    data = callback_query.data.split('_', 1)
-
-    if len(data) != 2:
+    if len(callback.args) != 1:
         await send_message_with_deletion(callback_query.from_user.id, "Неверные данные для выбора суммы.", state=state,
                                          message_key='amount_error_message_id')
         return
 
-    amount_str = data[1]
+    amount_str = callback.args[0]
     try:
         amount = int(amount_str)
     except ValueError:
@@ -154,46 +194,14 @@ async def process_amount_selection(callback_query: types.CallbackQuery, state: F
     await state.update_data(amount=amount)
     await state.set_state(ReplenishBalanceState.waiting_for_payment_confirmation)
 
-    state_data = await state.get_data()
-    customer_name = callback_query.from_user.full_name
-    customer_id = callback_query.from_user.id
-
-    customer_email = f"{customer_id}@solo.net"
-
-    # Создание платежа
-    payment = Payment.create({
-        "amount": {
-            "value": str(amount),
-            "currency": "RUB"
-        },
-        "confirmation": {
-            "type": "redirect",
-            "return_url": "https://pocomacho.ru/"
-        },
-        "capture": True,
-        "description": "Пополнение баланса",
-        "receipt": {
-            "customer": {
-                "full_name": customer_name,
-                "email": customer_email,
-                "phone": "79000000000"
-            },
-            "items": [
-                {
-                    "description": "Пополнение баланса",
-                    "quantity": "1.00",
-                    "amount": {
-                        "value": str(amount),
-                        "currency": "RUB"
-                    },
-                    "vat_code": 6
-                }
-            ]
-        },
-        "metadata": {
-            "user_id": customer_id
-        }
-    }, uuid.uuid4())
+    try:
+        payment = await create_topup_payment(callback_query.from_user.id, callback_query.from_user.full_name, amount)
+    except PaymentGatewayError as e:
+        logging.error(f"Ошибка при создании платежа: {e}")
+        await send_message_with_deletion(callback_query.from_user.id, "Произошла ошибка при создании платежа.",
+                                         state=state)
+        await callback_query.answer()
+        return
 
     if payment['status'] == 'pending':
         payment_url = payment['confirmation']['confirmation_url']
@@ -213,55 +221,109 @@ async def process_amount_selection(callback_query: types.CallbackQuery, state: F
     await callback_query.answer()
 
 
-async def send_payment_success_notification(user_id: int, amount: float):
+async def send_payment_success_notification(user_id: int, amount: float, payment_id: str = None, conn=None):
     """
-    Отправляет пользователю уведомление об успешном пополнении баланса.
+    Ставит в очередь outbox уведомление пользователю об успешном пополнении баланса.
 
     :param user_id: ID пользователя, которому будет отправлено уведомление.
     :param amount: Сумма, на которую был пополнен баланс.
+    :param payment_id: (необязательно) ID платежа, используется для дедупликации уведомления.
+    :param conn: (необязательно) Соединение, в транзакции которого нужно поставить уведомление.
+    """
+    profile_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='Перейти в профиль', callback_data='view_profile')]
+    ])
+
+    await enqueue_message(
+        user_id,
+        f"Ваш баланс успешно пополнен на {amount} рублей. Спасибо за оплату!",
+        reply_markup=profile_keyboard,
+        dedup_key=f'payment|{payment_id}' if payment_id else None,
+        conn=conn
+    )
+
+
+PAYMENT_EVENTS = ('payment.succeeded', 'payment.canceled')
+
+
+def parse_payment_event(event: dict):
+    """
+    Проверяет событие платежа из вебхука.
+
+    :param event: Тело вебхука ЮKassa.
+    :return: Кортеж (payment_id, user_id, amount).
+    :raises ValueError: Если в событии нет нужных полей или они некорректны.
     """
     try:
-        profile_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text='Перейти в профиль', callback_data='view_profile')]
-        ])
+        payment = event['object']
+        return payment['id'], int(payment['metadata']['user_id']), float(payment['amount']['value'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Некорректные данные платежа: {e!r}") from e
 
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"Ваш баланс успешно пополнен на {amount} рублей. Спасибо за оплату!",
-            reply_markup=profile_keyboard
-        )
-    except Exception as e:
-        logging.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
+
+async def apply_payment_event(conn, event: dict):
+    """
+    Применяет событие платежа из входящей очереди. Вызывается воркером payment_inbox в транзакции.
+
+    Обработка идемпотентна: платеж сохраняется в таблицу payments по его ID, а баланс пополняется
+    только при первом переходе платежа в статус succeeded. В той же транзакции ставится задание
+    продлить ключи пользователя за счет платежа (см. renewal_jobs).
+
+    :param conn: Соединение с открытой транзакцией.
+    :param event: Тело вебхука ЮKassa.
+    :return: True, если платеж зачислен этим вызовом.
+    """
+    payment_id, user_id, amount = parse_payment_event(event)
+
+    # Платеж, созданный не через бота, заводится как pending, чтобы переход в succeeded ниже сработал
+    await add_payment(payment_id, user_id, amount, 'pending', conn=conn)
+
+    if event['event'] == 'payment.canceled':
+        await set_payment_status(conn, payment_id, 'canceled')
+        return False
+
+    credited = await mark_payment_succeeded(conn, payment_id)
+    if credited is None:
+        logging.info(f"Платеж {payment_id} уже зачислен, повторное событие пропущено.")
+        return False
+
+    amount = float(credited['amount'])
+    logging.debug(f"Payment succeeded for user_id: {credited['tg_id']}, amount: {amount}")
+    await update_balance(credited['tg_id'], amount, conn=conn)
+    await send_payment_success_notification(credited['tg_id'], amount, payment_id=payment_id, conn=conn)
+    await enqueue_renewal(credited['tg_id'], conn=conn)
+    return True
 
 
 async def payment_webhook(request):
     """
     Обрабатывает вебхуки о событиях платежа.
 
+    Обработчик только проверяет событие и сохраняет его во входящую очередь payment_inbox,
+    поэтому отвечает ЮKassa сразу. Зачисление и уведомления выполняют воркеры очереди
+    (см. apply_payment_event).
+
     :param request: HTTP запрос, содержащий данные о событии платежа.
     :return: HTTP ответ со статусом обработки.
     """
-    event = await request.json()
+    try:
+        event = await request.json()
+    except ValueError:
+        logging.error("Вебхук платежа с некорректным JSON")
+        return web.Response(status=400)
 
     logging.debug(f"Webhook event received: {event}")
 
-    if event['event'] == 'payment.succeeded':
-        user_id_str = event['object']['metadata']['user_id']
-        amount_str = event['object']['amount']['value']
+    if not isinstance(event, dict) or event.get('event') not in PAYMENT_EVENTS:
+        return web.Response(status=200)
 
-        try:
-            user_id = int(user_id_str)
-            amount = float(amount_str)
-
-            logging.debug(f"Payment succeeded for user_id: {user_id}, amount: {amount}")
-            await update_balance(user_id, amount)
-
-            await send_payment_success_notification(user_id, amount)
-
-        except ValueError as e:
-            logging.error(f"Ошибка конвертации user_id или amount: {e}")
-            return web.Response(status=400)
+    try:
+        payment_id, _, _ = parse_payment_event(event)
+    except ValueError as e:
+        logging.error(f"Ошибка в данных вебхука платежа: {e}")
+        return web.Response(status=400)
 
+    await store_payment_event(payment_id, event['event'], event)
     return web.Response(status=200)
 
 
@@ -283,39 +345,7 @@ async def process_custom_amount_input(message: types.Message, state: FSMContext)
         await state.set_state(ReplenishBalanceState.waiting_for_payment_confirmation)
 
         try:
-            payment = Payment.create({
-                "amount": {
-                    "value": str(amount),
-                    "currency": "RUB"
-                },
-                "confirmation": {
-                    "type": "redirect",
-                    "return_url": "https://pocomacho.ru/"
-                },
-                "capture": True,
-                "description": "Пополнение баланса",
-                "receipt": {
-                    "customer": {
-                        "full_name": message.from_user.full_name,
-                        "email": f"{message.from_user.id}@solo.net",
-                        "phone": "79000000000"
-                    },
-                    "items": [
-                        {
-                            "description": "Пополнение баланса",
-                            "quantity": "1.00",
-                            "amount": {
-                                "value": str(amount),
-                                "currency": "RUB"
-                            },
-                            "vat_code": 6
-                        }
-                    ]
-                },
-                "metadata": {
-                    "user_id": message.from_user.id
-                }
-            }, uuid.uuid4())
+            payment = await create_topup_payment(message.from_user.id, message.from_user.full_name, amount)
 
             if payment['status'] == 'pending':
                 payment_url = payment['confirmation']['confirmation_url']
@@ -3,8 +3,9 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
-from bot import bot
+from callback_router import callbacks
 from database import get_balance, get_key_count, get_referral_stats
+from screens import render_screen
 from handlers.texts import profile_message_send, invite_message_send, CHANNEL_LINK, get_referral_link
 
 
@@ -23,12 +24,16 @@ async def process_callback_view_profile(callback_query: types.CallbackQuery, sta
 
     Получает идентификатор пользователя и имя, затем извлекает информацию
     о количестве ключей и балансе. Формирует сообщение профиля с кнопками
-    для взаимодействия. Если возникает ошибка, отправляет сообщение об ошибке.
+    для взаимодействия и показывает его на месте сообщения с кнопкой
+    (см. screens.render_screen). Если возникает ошибка, показывает сообщение об ошибке.
 
     Args:
         callback_query (types.CallbackQuery): Объект колбека от пользователя.
         state (FSMContext): Контекст состояния для управления состояниями пользователя.
 
+    Returns:
+        AnswerCallbackQuery: Ответ на колбек. Обработчик возвращает его aiogram, и он отправляется
+        последним вызовом обновления (при WEBHOOK_REPLY_IN_RESPONSE - прямо в ответе на вебхук).
     """
     tg_id = callback_query.from_user.id
     username = callback_query.from_user.full_name
@@ -68,25 +73,18 @@ async def process_callback_view_profile(callback_query: types.CallbackQuery, sta
             profile_message = f"❗️ Ошибка при получении данных профиля: {e}"
             keyboard = None
 
-    await callback_query.message.delete()
+    await render_screen(callback_query, profile_message, reply_markup=keyboard)
 
-    await bot.send_message(
-        chat_id=tg_id,
-        text=profile_message,
-        parse_mode='HTML',
-        reply_markup=keyboard
-    )
-
-    await callback_query.answer()
+    return callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data == 'invite')
+@callbacks.action('invite')
 async def invite_handler(callback_query: types.CallbackQuery):
     """
     Обрабатывает колбек для приглашения других пользователей.
 
     Получает реферальную ссылку и статистику приглашений для текущего пользователя.
-    Формирует сообщение с информацией о приглашении и отправляет его пользователю.
+    Формирует сообщение с информацией о приглашении и показывает его на месте сообщения с кнопкой.
 
     Args:
         callback_query (types.CallbackQuery): Объект колбека от пользователя.
@@ -104,19 +102,12 @@ async def invite_handler(callback_query: types.CallbackQuery):
     button_back = InlineKeyboardButton(text='⬅️ Назад', callback_data='view_profile')
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[button_back]])
 
-    await callback_query.message.delete()
-
-    await bot.send_message(
-        chat_id=tg_id,
-        text=invite_message,
-        parse_mode='HTML',
-        reply_markup=keyboard
-    )
+    await render_screen(callback_query, invite_message, reply_markup=keyboard)
 
-    await callback_query.answer()
+    return callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data == 'view_profile')
+@callbacks.action('view_profile')
 async def view_profile_handler(callback_query: types.CallbackQuery, state: FSMContext):
     """
     Обрабатывает колбек для отображения профиля пользователя.
@@ -129,5 +120,5 @@ async def view_profile_handler(callback_query: types.CallbackQuery, state: FSMCo
         state (FSMContext): Контекст состояния для управления состояниями пользователя.
 
     """
-    await process_callback_view_profile(callback_query, state)
+    return await process_callback_view_profile(callback_query, state)
 
@@ -2,39 +2,33 @@ import os
 from aiogram import Router
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import (BufferedInputFile, CallbackQuery,
-                           InlineKeyboardButton, InlineKeyboardMarkup, Message)
+from aiogram.types import (CallbackQuery, InlineKeyboardButton,
+                           InlineKeyboardMarkup, Message)
 from handlers.texts import ABOUT_VPN, WELCOME_TEXT
 from bot import bot
+from callback_router import callbacks
 from config import CHANNEL_URL, SUPPORT_CHAT_URL
 from database import add_connection, add_referral, check_connection_exists, get_trial
 from handlers.keys.trial_key import create_trial_key  
 from handlers.texts import INSTRUCTIONS_TRIAL
+from media import send_photo
+from screens import render_screen
 
 router = Router()
 
 class FeedbackState(StatesGroup):
     waiting_for_feedback = State()
 
-async def send_welcome_message(chat_id: int, trial_status: int):
+WELCOME_IMAGE_PATH = os.path.join(os.path.dirname(__file__), 'pic.jpg')
+
+
+def build_welcome_keyboard(trial_status: int) -> InlineKeyboardMarkup:
     """
-    Отправляет приветственное сообщение пользователю с кнопками для взаимодействия.
+    Собирает клавиатуру приветственного экрана.
 
     Args:
-        chat_id (int): Идентификатор чата, в который будет отправлено сообщение.
         trial_status (int): Статус пробного периода пользователя (0 - пробный период активен, иначе - неактивен).
-
-    Sends an image along with a welcome message and a set of buttons based on the user's trial status.
-    If the image file is not found, a message indicating this will be sent instead.
     """
-    welcome_text = WELCOME_TEXT
-
-    image_path = os.path.join(os.path.dirname(__file__), 'pic.jpg')
-
-    if not os.path.isfile(image_path):
-        await bot.send_message(chat_id, "Файл изображения не найден.")
-        return
-
     inline_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text='🔗 Подключить VPN', callback_data='connect_vpn')] if trial_status == 0 else [],
         [InlineKeyboardButton(text='👤 Мой профиль', callback_data='view_profile')],
@@ -44,15 +38,33 @@ async def send_welcome_message(chat_id: int, trial_status: int):
     ])
 
     inline_keyboard.inline_keyboard = [row for row in inline_keyboard.inline_keyboard if row]
+    return inline_keyboard
 
-    with open(image_path, 'rb') as image_from_buffer:
-        await bot.send_photo(
-            chat_id,
-            BufferedInputFile(image_from_buffer.read(), filename="pic.jpg"),
-            caption=welcome_text,
-            parse_mode='HTML',
-            reply_markup=inline_keyboard
-        )
+
+async def send_welcome_message(chat_id: int, trial_status: int):
+    """
+    Отправляет приветственное сообщение пользователю с кнопками для взаимодействия.
+
+    Args:
+        chat_id (int): Идентификатор чата, в который будет отправлено сообщение.
+        trial_status (int): Статус пробного периода пользователя (0 - пробный период активен, иначе - неактивен).
+
+    Sends an image along with a welcome message and a set of buttons based on the user's trial status.
+    The image is uploaded once and then sent by its cached file_id (see media.send_photo).
+    If the image file is not found, a message indicating this will be sent instead.
+    """
+    if not os.path.isfile(WELCOME_IMAGE_PATH):
+        await bot.send_message(chat_id, "Файл изображения не найден.")
+        return
+
+    await send_photo(
+        bot,
+        chat_id,
+        WELCOME_IMAGE_PATH,
+        caption=WELCOME_TEXT,
+        parse_mode='HTML',
+        reply_markup=build_welcome_keyboard(trial_status)
+    )
 
 
 @router.message(Command('start'))
@@ -81,7 +93,7 @@ async def start_command(message: Message):
     await send_welcome_message(message.chat.id, trial_status)
 
 
-@router.callback_query(lambda c: c.data == 'connect_vpn')
+@callbacks.action('connect_vpn')
 async def handle_connect_vpn(callback_query: CallbackQuery):
     """
     Обрабатывает запрос на подключение к VPN и отправляет пользователю ключ доступа.
@@ -89,16 +101,16 @@ async def handle_connect_vpn(callback_query: CallbackQuery):
     Args:
         callback_query (CallbackQuery): Объект обратного вызова, содержащий информацию о запросе и пользователе.
 
-    Эта функция удаляет предыдущее сообщение, создает ключ доступа для пользователя и отправляет его вместе с инструкциями.
-    Если возникла ошибка при создании ключа, сообщение об ошибке будет отправлено пользователю.
+    Эта функция создает ключ доступа для пользователя и показывает его вместе с инструкциями
+    на месте приветственного сообщения (см. screens.render_screen).
+    Если возникла ошибка при создании ключа, пользователю будет показано сообщение об ошибке.
     """
-    await callback_query.message.delete()
     user_id = callback_query.from_user.id
 
     trial_key_info = await create_trial_key(user_id)
 
     if 'error' in trial_key_info:
-        await callback_query.message.answer(trial_key_info['error'])
+        await render_screen(callback_query, trial_key_info['error'], parse_mode=None)
     else:
         key_message = (
             f"<b>Ваш ключ доступа:</b>\n<pre>{trial_key_info['key']}</pre>\n\n"
@@ -108,16 +120,12 @@ async def handle_connect_vpn(callback_query: CallbackQuery):
         button_profile = InlineKeyboardButton(text='👤 Мой профиль', callback_data='view_profile')
         inline_keyboard_profile = InlineKeyboardMarkup(inline_keyboard=[[button_profile]])
 
-        await callback_query.message.answer(
-            key_message,
-            parse_mode='HTML',
-            reply_markup=inline_keyboard_profile
-        )
+        await render_screen(callback_query, key_message, reply_markup=inline_keyboard_profile)
 
     await callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data == 'about_vpn')
+@callbacks.action('about_vpn')
 async def handle_about_vpn(callback_query: CallbackQuery):
     """
     Обрабатывает запрос на получение информации о VPN.
@@ -125,24 +133,19 @@ async def handle_about_vpn(callback_query: CallbackQuery):
     Args:
         callback_query (CallbackQuery): Объект обратного вызова, содержащий информацию о запросе и пользователе.
 
-    Эта функция удаляет предыдущее сообщение и отправляет информацию о VPN пользователю.
+    Эта функция показывает информацию о VPN на месте сообщения с кнопкой.
     Также добавляет кнопку "Назад" для возврата в главное меню.
     """
-    await callback_query.message.delete()
     info_message = ABOUT_VPN
 
     button_back = InlineKeyboardButton(text='⬅️ Назад', callback_data='back_to_menu')
     inline_keyboard_back = InlineKeyboardMarkup(inline_keyboard=[[button_back]])
 
-    await callback_query.message.answer(
-        info_message,
-        parse_mode='HTML',
-        reply_markup=inline_keyboard_back
-    )
-    await callback_query.answer()
+    await render_screen(callback_query, info_message, reply_markup=inline_keyboard_back)
+    return callback_query.answer()
 
 
-@router.callback_query(lambda c: c.data == 'bac')
+@callbacks.action('back_to_menu')
 async def handle_back_to_menu(callback_query: CallbackQuery):
     """
     Обрабатывает запрос на возврат в главное меню.
@@ -150,11 +153,15 @@ async def handle_back_to_menu(callback_query: CallbackQuery):
     Args:
         callback_query (CallbackQuery): Объект обратного вызова, содержащий информацию о запросе и пользователе.
 
-    Эта функция удаляет предыдущее сообщение и отправляет пользователю приветственное сообщение
-    с учетом его статуса пробного периода.
+    Эта функция показывает приветственный экран с учетом статуса пробного периода
+    на месте сообщения с кнопкой.
     """
-    await callback_query.message.delete()
     trial_status = await get_trial(callback_query.from_user.id)
-    await send_welcome_message(callback_query.from_user.id, trial_status)
-    await callback_query.answer()
+    if not os.path.isfile(WELCOME_IMAGE_PATH):
+        await render_screen(callback_query, "Файл изображения не найден.")
+        return callback_query.answer()
+
+    await render_screen(callback_query, WELCOME_TEXT, reply_markup=build_welcome_keyboard(trial_status),
+                        photo=WELCOME_IMAGE_PATH)
+    return callback_query.answer()
 
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+
+import asyncpg
+
+import config
+from config import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+LEADER_HEARTBEAT_INTERVAL = getattr(config, 'LEADER_HEARTBEAT_INTERVAL', 10)
+LEADER_RETRY_INTERVAL = getattr(config, 'LEADER_RETRY_INTERVAL', 15)
+
+_tasks = set()
+
+
+async def _heartbeat(conn):
+    """
+    Проверяет, что соединение, держащее advisory lock, живо.
+
+    Пока соединение открыто, Postgres сохраняет за ним блокировку. Как только проверка не проходит,
+    функция завершается, и лидер должен немедленно остановить работу: блокировка могла перейти
+    к другой реплике.
+    """
+    while True:
+        await asyncio.sleep(LEADER_HEARTBEAT_INTERVAL)
+        try:
+            await asyncio.wait_for(conn.fetchval('SELECT 1'), timeout=LEADER_HEARTBEAT_INTERVAL)
+        except Exception as e:
+            logger.error(f"Потеряно соединение лидера: {e}")
+            return
+
+
+async def run_as_leader(name: str, job_factory):
+    """
+    Выполняет задачу только на одной реплике бота.
+
+    Реплика берет сессионный advisory lock Postgres с ключом, вычисленным из имени задачи. Задача
+    запускается только у владельца блокировки. Если процесс лидера завершится или его соединение
+    с базой пропадет, Postgres освободит блокировку, и ее заберет другая реплика.
+
+    :param name: str - Уникальное имя задачи, используется как ключ блокировки.
+    :param job_factory: Функция без аргументов, возвращающая корутину задачи.
+    """
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            acquired = await conn.fetchval('SELECT pg_try_advisory_lock(hashtext($1))', name)
+
+            if not acquired:
+                await conn.close()
+                conn = None
+                await asyncio.sleep(LEADER_RETRY_INTERVAL)
+                continue
+
+            logger.info(f"Реплика стала лидером для задачи {name}.")
+            job = asyncio.create_task(job_factory())
+            heartbeat = asyncio.create_task(_heartbeat(conn))
+            try:
+                done, _ = await asyncio.wait({job, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                job.cancel()
+                heartbeat.cancel()
+                await asyncio.gather(job, heartbeat, return_exceptions=True)
+
+            if job in done and not job.cancelled() and job.exception():
+                logger.error(f"Задача {name} завершилась с ошибкой: {job.exception()}")
+            logger.info(f"Реплика больше не лидер для задачи {name}.")
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при выборе лидера для задачи {name}: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close(timeout=5)
+
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+
+def start_leader_job(name: str, job_factory):
+    """
+    Запускает задачу под управлением run_as_leader и сохраняет ссылку на нее.
+
+    :param name: str - Уникальное имя задачи.
+    :param job_factory: Функция без аргументов, возвращающая корутину задачи.
+    """
+    task = asyncio.create_task(run_as_leader(name, job_factory))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
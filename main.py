@@ -1,61 +1,81 @@
 import asyncio
 import logging
+import os
 import signal
+import time
 
-from aiogram.webhook.aiohttp_server import (SimpleRequestHandler,
-                                            setup_application)
+from aiogram.webhook.aiohttp_server import setup_application
 from aiohttp import web
 
 from backup import backup_database
 from bot import bot, dp, router
+from bot_api import detect_capabilities
+import config
+from broadcast import broadcast_supervisor
 from config import WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_URL
 from database import init_db
+from fsm_storage import FSM_STORAGE
+from leader import start_leader_job
+from metrics import start_metrics_server
 from handlers.notifications import notify_expiring_keys
-from handlers.pay import payment_webhook
+from handlers.pay import apply_payment_event, payment_webhook
+from outbox import start_outbox_workers
+from payment_gateway import gateway
+from payment_inbox import start_payment_inbox_workers
+from payment_reconciler import PAYMENT_RECONCILE_INTERVAL, reconcile_payments
+from renewal_jobs import start_renewal_workers
+from scheduler import scheduler
+from webhook import create_request_handler
 
 logging.basicConfig(level=logging.DEBUG)
 
+WEB_WORKERS = getattr(config, 'WEB_WORKERS', 1)
+WEB_WORKER_RESTART_DELAY = getattr(config, 'WEB_WORKER_RESTART_DELAY', 1)
+BACKGROUND_WORKER_ID = 0
 
-async def periodic_notifications():
-    """
-    Функция для периодической отправки уведомлений о сроке действия ключей.
-
-    Эта функция выполняет бесконечный цикл, в котором каждые 3600 секунд
-    (1 час) вызывается функция `notify_expiring_keys`. Используется для
-    мониторинга и уведомления о ключах, срок действия которых скоро истечет.
-    """
-    while True:
-        await notify_expiring_keys(bot)
-        await asyncio.sleep(3600)
 
-
-async def periodic_database_backup():
+def register_jobs():
     """
-    Функция для периодического резервного копирования базы данных.
+    Регистрирует периодические задачи в планировщике.
 
-    Эта функция выполняет бесконечный цикл, в котором каждые 21600 секунд
-    (6 часов) вызывается функция `backup_database`. Используется для
-    регулярного создания резервных копий базы данных.
+    Уведомления о сроке действия ключей выполняются каждый час, резервное копирование
+    базы данных - каждые 6 часов, сверка платежей с ЮKassa - каждые
+    PAYMENT_RECONCILE_INTERVAL секунд. Каждый запуск записывается в таблицу job_runs.
     """
-    while True:
-        await backup_database()
-        await asyncio.sleep(21600)
+    scheduler.every(3600, 'notifications', lambda: notify_expiring_keys(bot), jitter=30)
+    scheduler.every(21600, 'database_backup', backup_database, jitter=60)
+    scheduler.every(PAYMENT_RECONCILE_INTERVAL, 'payment_reconcile', reconcile_payments, jitter=30, timeout=600)
 
 
 async def on_startup(app):
     """
     Обработчик события старта приложения.
 
-    Эта функция вызывается при старте приложения. Она устанавливает вебхук
-    для бота, инициализирует базу данных и запускает задачи для
-    периодических уведомлений и резервного копирования базы данных.
+    Эта функция вызывается при старте приложения. Она инициализирует базу данных,
+    устанавливает вебхук для бота только на типы обновлений, для которых есть
+    обработчики, запускает воркеры outbox и входящих платежей, рассылки и
+    планировщик периодических задач. Периодические задачи выполняются только
+    на реплике, владеющей блокировкой лидера.
+
+    В режиме нескольких процессов (WEB_WORKERS > 1) базу данных инициализирует главный
+    процесс до запуска воркеров (см. run_workers), а вебхук и фоновые задачи запускает
+    только процесс BACKGROUND_WORKER_ID, остальные только принимают запросы.
+    Возможности сервера Bot API (см. bot_api.detect_capabilities) определяет каждый процесс.
 
     :param app: Экземпляр приложения aiohttp.
     """
-    await bot.set_webhook(WEBHOOK_URL)
-    await init_db()
-    asyncio.create_task(periodic_notifications())
-    asyncio.create_task(periodic_database_backup())
+    if WEB_WORKERS <= 1:
+        await init_db()
+    await detect_capabilities(bot)
+    if app['worker_id'] != BACKGROUND_WORKER_ID:
+        return
+
+    await bot.set_webhook(WEBHOOK_URL, allowed_updates=dp.resolve_used_update_types())
+    start_outbox_workers(bot)
+    start_payment_inbox_workers(apply_payment_event)
+    start_renewal_workers()
+    scheduler.start()
+    start_leader_job('broadcasts', lambda: broadcast_supervisor(bot))
 
 
 async def on_shutdown(app):
@@ -63,15 +83,21 @@ async def on_shutdown(app):
     Обработчик события завершения работы приложения.
 
     Эта функция вызывается при завершении работы приложения. Она удаляет
-    вебхук бота и отменяет все активные задачи.
+    вебхук бота, закрывает сеанс платежного шлюза и отменяет все активные задачи.
+    В режиме нескольких процессов вебхук не удаляется: остальные процессы и
+    перезапущенный процесс продолжают принимать обновления.
 
     :param app: Экземпляр приложения aiohttp.
     """
-    await bot.delete_webhook()
-    for task in asyncio.all_tasks():
+    if WEB_WORKERS == 1:
+        await bot.delete_webhook()
+    await scheduler.stop()
+    await gateway.close()
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
         task.cancel()
     try:
-        await asyncio.gather(*asyncio.all_tasks(), return_exceptions=True)
+        await asyncio.gather(*tasks, return_exceptions=True)
     except Exception as e:
         logging.error(f"Error during shutdown: {e}")
 
@@ -88,44 +114,139 @@ async def shutdown_site(site):
     await site.stop()
     logging.info("Сервер остановлен.")
 
-async def main():
+async def main(worker_id: int = BACKGROUND_WORKER_ID):
     """
     Основная функция для запуска веб-приложения.
 
     Эта функция инициализирует приложение aiohttp, настраивает маршруты,
-    запускает сервер и обрабатывает сигналы завершения работы.
+    запускает сервер и обрабатывает сигналы завершения работы. По SIGINT или
+    SIGTERM сервер перестает принимать соединения и корректно завершает работу.
+
+    :param worker_id: Номер процесса в режиме нескольких процессов.
     """
     dp.include_router(router)
+    register_jobs()
 
     app = web.Application()
+    app['worker_id'] = worker_id
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     app.router.add_post('/yookassa/webhook', payment_webhook)
 
-    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WEBHOOK_PATH)
+    create_request_handler(dp, bot).register(app, path=WEBHOOK_PATH)
     setup_application(app, dp, bot=bot)
 
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT)
+    site = web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT, reuse_port=WEB_WORKERS > 1)
     await site.start()
+    metrics_runner = await start_metrics_server(reuse_port=WEB_WORKERS > 1)
 
-    print(f"Webhook URL: {WEBHOOK_URL}")
+    print(f"Webhook URL: {WEBHOOK_URL} (процесс {worker_id}, pid {os.getpid()})")
 
-    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
     for sig in (signal.SIGINT, signal.SIGTERM):
-        loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown_site(site)))
+        loop.add_signal_handler(sig, stop.set)
 
     try:
-        await asyncio.Event().wait()
+        await stop.wait()
     finally:
-        pending = asyncio.all_tasks()
-        for task in pending:
-            task.cancel()
-        await asyncio.gather(*pending, return_exceptions=True)
+        await shutdown_site(site)
+        await runner.cleanup()
+        await metrics_runner.cleanup()
+
+
+def run_worker(worker_id: int):
+    """
+    Запускает процесс-воркер и возвращает его pid. В дочернем процессе выполняется main(worker_id).
+
+    :param worker_id: Номер процесса.
+    :return: pid дочернего процесса.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+
+    exit_code = 0
+    try:
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, signal.SIG_DFL)
+        asyncio.run(main(worker_id))
+    except Exception as e:
+        logging.error(f"Ошибка в процессе {worker_id}: {e}")
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+
+def run_workers(count: int):
+    """
+    Главный процесс режима нескольких процессов (pre-fork).
+
+    Перед запуском процессов инициализирует базу данных, чтобы ни один процесс не принимал
+    запросы до создания таблиц. Затем запускает count процессов, которые слушают один порт
+    через SO_REUSEPORT, и следит за ними:
+    - упавший процесс перезапускается через WEB_WORKER_RESTART_DELAY секунд с тем же номером;
+    - SIGHUP - поочередный перезапуск: для каждого процесса сначала запускается замена, затем
+      старому процессу отправляется SIGTERM, так что порт все время кто-то слушает;
+    - SIGINT и SIGTERM передаются всем процессам, главный процесс ждет их завершения.
+
+    :param count: Количество процессов.
+    """
+    if FSM_STORAGE == 'memory':
+        logging.warning("FSM_STORAGE = 'memory' при нескольких процессах: состояние диалога не будет общим.")
+
+    asyncio.run(init_db())
+
+    received = []
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, lambda signum, frame: received.append(signum))
+
+    workers = {run_worker(worker_id): worker_id for worker_id in range(count)}
+    retiring = set()
+    stopping = False
+    logging.info(f"Запущено {count} процессов: {sorted(workers)}")
+
+    while workers:
+        while received:
+            signum = received.pop(0)
+            if signum == signal.SIGHUP and not stopping:
+                logging.info("Поочередный перезапуск процессов...")
+                for pid, worker_id in list(workers.items()):
+                    if pid in retiring:
+                        continue
+                    workers[run_worker(worker_id)] = worker_id
+                    time.sleep(WEB_WORKER_RESTART_DELAY)
+                    retiring.add(pid)
+                    os.kill(pid, signal.SIGTERM)
+            elif signum in (signal.SIGINT, signal.SIGTERM) and not stopping:
+                logging.info("Остановка процессов...")
+                stopping = True
+                for pid in workers:
+                    os.kill(pid, signal.SIGTERM)
+
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            time.sleep(0.2)
+            continue
+
+        worker_id = workers.pop(pid)
+        if pid in retiring:
+            retiring.discard(pid)
+        elif not stopping:
+            logging.error(f"Процесс {worker_id} (pid {pid}) завершился с кодом {os.waitstatus_to_exitcode(status)}, "
+                          f"перезапуск через {WEB_WORKER_RESTART_DELAY} с.")
+            time.sleep(WEB_WORKER_RESTART_DELAY)
+            workers[run_worker(worker_id)] = worker_id
+
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        if WEB_WORKERS > 1:
+            run_workers(WEB_WORKERS)
+        else:
+            asyncio.run(main())
     except Exception as e:
-        logging.error(f"Ошибка при запуске приложения: {e}")
\ No newline at end of file
+        logging.error(f"Ошибка при запуске приложения: {e}")
@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import os
+
+import asyncpg
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputMediaPhoto, Message
+
+from bot_api import input_file
+from config import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+_digests = {}
+_file_ids = {}
+
+
+def file_digest(path: str) -> str:
+    """
+    Возвращает sha256 содержимого файла. Хеш пересчитывается, только если изменились время
+    изменения или размер файла.
+
+    :param path: Путь к файлу.
+    :return: Шестнадцатеричный sha256.
+    """
+    stat = os.stat(path)
+    cached = _digests.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(65536), b''):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    _digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+async def _get_file_id(digest: str):
+    if digest in _file_ids:
+        return _file_ids[digest]
+
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        file_id = await conn.fetchval('SELECT file_id FROM media_cache WHERE sha256 = $1', digest)
+    finally:
+        await conn.close()
+    if file_id:
+        _file_ids[digest] = file_id
+    return file_id
+
+
+async def _save_file_id(digest: str, path: str, file_id: str):
+    _file_ids[digest] = file_id
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await conn.execute('''
+            INSERT INTO media_cache (sha256, file_id, path)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (sha256) DO UPDATE SET file_id = EXCLUDED.file_id, path = EXCLUDED.path, created_at = now()
+        ''', digest, file_id, path)
+    finally:
+        await conn.close()
+
+
+async def _forget_file_id(digest: str):
+    _file_ids.pop(digest, None)
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await conn.execute('DELETE FROM media_cache WHERE sha256 = $1', digest)
+    finally:
+        await conn.close()
+
+
+async def send_photo(bot: Bot, chat_id: int, path: str, **kwargs) -> Message:
+    """
+    Отправляет изображение из файла, загружая его в Telegram только один раз.
+
+    После первой загрузки file_id сохраняется в таблицу media_cache по sha256 содержимого файла,
+    и следующие отправки идут по file_id без передачи файла. Если файл изменился, у него другой хеш,
+    и он загружается заново. Если Telegram отклонил сохраненный file_id, запись удаляется и файл
+    загружается повторно.
+
+    :param bot: Объект бота.
+    :param chat_id: Идентификатор чата получателя.
+    :param path: Путь к файлу изображения.
+    :param kwargs: Остальные параметры send_photo (caption, parse_mode, reply_markup...).
+    :return: Отправленное сообщение.
+    """
+    digest = file_digest(path)
+    file_id = await _get_file_id(digest)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, file_id, **kwargs)
+        except TelegramBadRequest as e:
+            if 'file' not in str(e).lower():
+                raise
+            logger.warning(f"Telegram отклонил file_id для {path}, файл будет загружен заново: {e}")
+            await _forget_file_id(digest)
+
+    message = await bot.send_photo(chat_id, input_file(path), **kwargs)
+    await _save_file_id(digest, path, message.photo[-1].file_id)
+    logger.info(f"Файл {path} загружен в Telegram, file_id сохранен.")
+    return message
+
+
+async def edit_photo(bot: Bot, chat_id: int, message_id: int, path: str, caption: str = None,
+                     parse_mode: str = None, reply_markup=None):
+    """
+    Заменяет изображение и подпись в уже отправленном сообщении, используя тот же кэш file_id,
+    что и send_photo.
+
+    :param bot: Объект бота.
+    :param chat_id: Идентификатор чата.
+    :param message_id: Идентификатор сообщения с изображением.
+    :param path: Путь к файлу изображения.
+    :param caption: Новая подпись.
+    :param parse_mode: Режим разметки подписи.
+    :param reply_markup: Новая клавиатура.
+    :return: Измененное сообщение.
+    """
+    digest = file_digest(path)
+    file_id = await _get_file_id(digest)
+    if file_id:
+        try:
+            return await bot.edit_message_media(
+                InputMediaPhoto(media=file_id, caption=caption, parse_mode=parse_mode),
+                chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+            )
+        except TelegramBadRequest as e:
+            if 'file' not in str(e).lower():
+                raise
+            logger.warning(f"Telegram отклонил file_id для {path}, файл будет загружен заново: {e}")
+            await _forget_file_id(digest)
+
+    message = await bot.edit_message_media(
+        InputMediaPhoto(media=input_file(path), caption=caption, parse_mode=parse_mode),
+        chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+    )
+    if isinstance(message, Message) and message.photo:
+        await _save_file_id(digest, path, message.photo[-1].file_id)
+    return message
@@ -0,0 +1,162 @@
+import time
+
+from aiohttp import web
+
+import config
+
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9100)
+
+_registry = {}
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Counter:
+    """
+    Монотонно растущий счетчик.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge:
+    """
+    Текущее значение. Вместо set() можно передать функцию, которая вычисляет значение при выгрузке.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, func=None):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.func = func
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, self.func() if self.func else self.value
+
+
+class Histogram:
+    """
+    Распределение значений (обычно длительностей в секундах) по корзинам.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        for bound, count in zip(self.buckets, self.counts):
+            yield f'{self.name}_bucket{{le="{bound}"}}', count
+        yield f'{self.name}_bucket{{le="+Inf"}}', self.count
+        yield f'{self.name}_sum', self.sum
+        yield f'{self.name}_count', self.count
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.started)
+
+
+def _register(metric):
+    if metric.name in _registry:
+        return _registry[metric.name]
+    _registry[metric.name] = metric
+    return metric
+
+
+def counter(name: str, description: str) -> Counter:
+    return _register(Counter(name, description))
+
+
+def gauge(name: str, description: str, func=None) -> Gauge:
+    return _register(Gauge(name, description, func))
+
+
+def histogram(name: str, description: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, description, buckets))
+
+
+def render() -> str:
+    """
+    Выгружает все метрики процесса в текстовом формате Prometheus.
+    """
+    lines = []
+    for metric in _registry.values():
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, value in metric.samples():
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def metrics_handler(request):
+    """
+    Обработчик HTTP-запроса /metrics.
+
+    :param request: HTTP запрос.
+    :return: HTTP ответ с метриками в текстовом формате Prometheus.
+    """
+    return web.Response(text=render(), content_type='text/plain')
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT, reuse_port: bool = False):
+    """
+    Запускает отдельный HTTP-сервер с /metrics.
+
+    Метрики отдаются не на порту вебхука, который доступен Telegram и ЮKassa, а на METRICS_HOST:METRICS_PORT
+    (по умолчанию только на localhost).
+
+    :param reuse_port: Слушать порт вместе с другими процессами (режим WEB_WORKERS > 1).
+    :return: AppRunner сервера, который нужно остановить через cleanup().
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port, reuse_port=reuse_port).start()
+    return runner
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+
+import asyncpg
+from aiogram import Bot
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError,
+                                TelegramRetryAfter)
+from aiogram.types import InlineKeyboardMarkup
+
+import config
+from config import DATABASE_URL
+from flood_control import mark_bulk
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_WORKERS = getattr(config, 'OUTBOX_WORKERS', 4)
+OUTBOX_BATCH_SIZE = getattr(config, 'OUTBOX_BATCH_SIZE', 10)
+OUTBOX_MAX_ATTEMPTS = getattr(config, 'OUTBOX_MAX_ATTEMPTS', 5)
+OUTBOX_POLL_INTERVAL = getattr(config, 'OUTBOX_POLL_INTERVAL', 1.0)
+OUTBOX_LEASE_SECONDS = 60
+
+_wakeup = asyncio.Event()
+_workers = set()
+
+
+async def enqueue_message(chat_id: int, text: str, reply_markup: InlineKeyboardMarkup = None,
+                          parse_mode: str = None, dedup_key: str = None, conn=None):
+    """
+    Ставит исходящее сообщение в очередь outbox.
+
+    Если передано соединение, запись выполняется в нем, то есть в транзакции вызывающего кода:
+    сообщение будет отправлено только если транзакция зафиксирована.
+
+    :param chat_id: Идентификатор чата получателя.
+    :param text: Текст сообщения.
+    :param reply_markup: (необязательно) Inline-клавиатура сообщения.
+    :param parse_mode: (необязательно) Режим разметки текста.
+    :param dedup_key: (необязательно) Ключ дедупликации: повторная постановка с тем же ключом игнорируется.
+    :param conn: (необязательно) Открытое соединение asyncpg.
+    :return: True, если сообщение поставлено в очередь; False, если такой dedup_key уже есть.
+    """
+    markup_json = reply_markup.model_dump_json(exclude_none=True) if reply_markup else None
+
+    own_conn = conn is None
+    if own_conn:
+        conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        message_id = await conn.fetchval('''
+            INSERT INTO outbox (chat_id, text, parse_mode, reply_markup, dedup_key)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (dedup_key) DO NOTHING
+            RETURNING id
+        ''', chat_id, text, parse_mode, markup_json, dedup_key)
+    finally:
+        if own_conn:
+            await conn.close()
+
+    _wakeup.set()
+    return message_id is not None
+
+
+async def _claim_batch(conn):
+    """
+    Забирает пачку готовых к отправке сообщений и продлевает их аренду.
+
+    Строки блокируются через SKIP LOCKED, поэтому несколько воркеров и реплик не получают одно
+    и то же сообщение. Если воркер упадет до отметки результата, сообщение снова станет доступным
+    после окончания аренды.
+    """
+    return await conn.fetch('''
+        UPDATE outbox
+        SET attempts = attempts + 1,
+            next_attempt_at = now() + make_interval(secs => $2)
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= now()
+            ORDER BY next_attempt_at
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, chat_id, text, parse_mode, reply_markup, attempts
+    ''', OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS)
+
+
+async def _deliver(bot: Bot, conn, record):
+    """
+    Отправляет одно сообщение из outbox и фиксирует результат.
+
+    При retry_after переносится только это сообщение: остальные чаты продолжают получать
+    сообщения, а паузу для чата выдерживает flood_control.FloodControlMiddleware.
+    """
+    reply_markup = None
+    if record['reply_markup']:
+        reply_markup = InlineKeyboardMarkup.model_validate_json(record['reply_markup'])
+
+    try:
+        await bot.send_message(record['chat_id'], record['text'], parse_mode=record['parse_mode'],
+                               reply_markup=reply_markup)
+    except TelegramRetryAfter as e:
+        logger.warning(f"Flood control Telegram для чата {record['chat_id']}, сообщение {record['id']} "
+                       f"перенесено на {e.retry_after} с.")
+        await conn.execute('''
+            UPDATE outbox
+            SET attempts = attempts - 1, next_attempt_at = now() + make_interval(secs => $2)
+            WHERE id = $1
+        ''', record['id'], float(e.retry_after))
+        return
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        logger.info(f"Сообщение {record['id']} для {record['chat_id']} не может быть доставлено: {e}")
+        await conn.execute('''
+            UPDATE outbox SET status = 'failed', last_error = $2 WHERE id = $1
+        ''', record['id'], str(e))
+        return
+    except Exception as e:
+        if record['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            status = 'failed'
+            logger.error(f"Сообщение {record['id']} для {record['chat_id']} не доставлено: {e}")
+        else:
+            status = 'pending'
+            logger.warning(f"Ошибка при отправке сообщения {record['id']}, повтор позже: {e}")
+        await conn.execute('''
+            UPDATE outbox
+            SET status = $2, last_error = $3, next_attempt_at = now() + make_interval(secs => $4)
+            WHERE id = $1
+        ''', record['id'], status, str(e), float(2 ** record['attempts']))
+        return
+
+    await conn.execute('''
+        UPDATE outbox SET status = 'sent', sent_at = now(), last_error = NULL WHERE id = $1
+    ''', record['id'])
+
+
+async def outbox_worker(bot: Bot, worker_id: int):
+    """
+    Воркер, который разбирает очередь outbox и отправляет сообщения в Telegram.
+
+    :param bot: Объект бота для отправки сообщений.
+    :param worker_id: Номер воркера (используется в логах).
+    """
+    mark_bulk()
+    conn = None
+    while True:
+        try:
+            if conn is None or conn.is_closed():
+                conn = await asyncpg.connect(DATABASE_URL)
+
+            records = await _claim_batch(conn)
+            if not records:
+                _wakeup.clear()
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for record in records:
+                await _deliver(bot, conn, record)
+
+        except asyncio.CancelledError:
+            if conn is not None:
+                await conn.close()
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка в воркере outbox #{worker_id}: {e}")
+            if conn is not None:
+                await conn.close()
+                conn = None
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+
+def start_outbox_workers(bot: Bot):
+    """
+    Запускает пул воркеров outbox. Ссылки на задачи хранятся в модуле, чтобы их не собрал GC.
+
+    :param bot: Объект бота для отправки сообщений.
+    """
+    for worker_id in range(OUTBOX_WORKERS):
+        task = asyncio.create_task(outbox_worker(bot, worker_id))
+        _workers.add(task)
+        task.add_done_callback(_workers.discard)
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timezone
+
+import aiohttp
+
+import config
+from config import YOOKASSA_SECRET_KEY, YOOKASSA_SHOP_ID
+from metrics import counter, histogram
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_GATEWAY_TIMEOUT = getattr(config, 'PAYMENT_GATEWAY_TIMEOUT', 10)
+PAYMENT_GATEWAY_POOL_SIZE = getattr(config, 'PAYMENT_GATEWAY_POOL_SIZE', 20)
+PAYMENT_RETURN_URL = getattr(config, 'PAYMENT_RETURN_URL', 'https://pocomacho.ru/')
+PAYMENT_GATEWAY_BACKEND = getattr(config, 'PAYMENT_GATEWAY_BACKEND', 'yookassa')
+
+gateway_latency = histogram('payment_gateway_request_seconds', 'Длительность запросов к платежному шлюзу')
+gateway_errors = counter('payment_gateway_errors_total', 'Количество ошибок запросов к платежному шлюзу')
+
+
+class PaymentGatewayError(Exception):
+    """
+    Ошибка обращения к платежному шлюзу: таймаут, сетевая ошибка, ответ не 2xx или не JSON.
+    """
+
+
+class YooKassaGateway:
+    """
+    Асинхронный клиент API ЮKassa.
+
+    Запросы выполняются через один aiohttp-сеанс с пулом соединений, поэтому создание платежа
+    не блокирует цикл событий и не открывает новое TLS-соединение на каждый запрос.
+    """
+
+    API_URL = 'https://api.yookassa.ru/v3'
+
+    def __init__(self, shop_id: str, secret_key: str, timeout: float = PAYMENT_GATEWAY_TIMEOUT,
+                 pool_size: int = PAYMENT_GATEWAY_POOL_SIZE):
+        self.auth = aiohttp.BasicAuth(str(shop_id), secret_key)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self.session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                auth=self.auth,
+                timeout=self.timeout,
+            )
+        return self.session
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        session = self._get_session()
+        try:
+            with gateway_latency.time():
+                async with session.request(method, f'{self.API_URL}{path}', **kwargs) as response:
+                    try:
+                        data = await response.json(content_type=None)
+                    except ValueError as e:
+                        raise PaymentGatewayError(f"ЮKassa ответила {response.status} не в формате JSON: {e}") from e
+                    if response.status >= 300:
+                        raise PaymentGatewayError(f"ЮKassa ответила {response.status}: {data}")
+                    return data
+        except PaymentGatewayError:
+            gateway_errors.inc()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            gateway_errors.inc()
+            raise PaymentGatewayError(f"Ошибка запроса к ЮKassa: {e!r}") from e
+
+    async def create_payment(self, payload: dict, idempotence_key: str = None) -> dict:
+        """
+        Создает платеж.
+
+        :param payload: dict - Тело запроса создания платежа.
+        :param idempotence_key: str - (необязательно) Ключ идемпотентности запроса.
+        :return: dict - Объект платежа.
+        :raises PaymentGatewayError: Если запрос не удался.
+        """
+        headers = {'Idempotence-Key': idempotence_key or str(uuid.uuid4())}
+        return await self._request('POST', '/payments', json=payload, headers=headers)
+
+    async def list_payments(self, created_since: datetime, status: str = None, page_size: int = 100):
+        """
+        Постранично получает платежи, созданные начиная с указанного момента.
+
+        :param created_since: datetime - Нижняя граница времени создания платежа (UTC).
+        :param status: str - (необязательно) Фильтр по статусу платежа.
+        :param page_size: int - Размер страницы (не больше 100).
+        :return: Асинхронный генератор страниц - списков объектов платежей.
+        :raises PaymentGatewayError: Если запрос не удался.
+        """
+        params = {
+            'created_at.gte': created_since.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'limit': str(min(page_size, 100)),
+        }
+        if status:
+            params['status'] = status
+
+        while True:
+            page = await self._request('GET', '/payments', params=params)
+            yield page.get('items', [])
+            if not page.get('next_cursor'):
+                break
+            params['cursor'] = page['next_cursor']
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class LocalPaymentGateway:
+    """
+    Локальная замена платежного шлюза для разработки и проверок без ЮKassa.
+
+    Платежи хранятся в памяти процесса. Статус платежа меняется через set_status; события
+    вебхука при этом не отправляются, их можно доставить вручную или через сверку платежей.
+    """
+
+    def __init__(self):
+        self.payments = {}
+
+    async def create_payment(self, payload: dict, idempotence_key: str = None) -> dict:
+        payment_id = idempotence_key or str(uuid.uuid4())
+        if payment_id not in self.payments:
+            self.payments[payment_id] = {
+                'id': payment_id,
+                'status': 'pending',
+                'amount': payload['amount'],
+                'metadata': payload.get('metadata', {}),
+                'confirmation': {
+                    'type': 'redirect',
+                    'confirmation_url': f"{PAYMENT_RETURN_URL}?payment_id={payment_id}",
+                },
+                'created_at': datetime.now(timezone.utc).isoformat(),
+            }
+        return self.payments[payment_id]
+
+    def set_status(self, payment_id: str, status: str):
+        self.payments[payment_id]['status'] = status
+
+    async def list_payments(self, created_since: datetime, status: str = None, page_size: int = 100):
+        since = created_since.replace(tzinfo=created_since.tzinfo or timezone.utc)
+        items = [
+            payment for payment in self.payments.values()
+            if datetime.fromisoformat(payment['created_at']) >= since
+            and (status is None or payment['status'] == status)
+        ]
+        for start in range(0, len(items), page_size):
+            yield items[start:start + page_size]
+
+    async def close(self):
+        pass
+
+
+def build_payment_payload(amount: int, tg_id: int, full_name: str) -> dict:
+    """
+    Формирует тело запроса на создание платежа для пополнения баланса.
+
+    :param amount: int - Сумма пополнения в рублях.
+    :param tg_id: int - ID пользователя в Telegram.
+    :param full_name: str - Имя пользователя для чека.
+    :return: dict - Тело запроса.
+    """
+    return {
+        "amount": {
+            "value": str(amount),
+            "currency": "RUB"
+        },
+        "confirmation": {
+            "type": "redirect",
+            "return_url": PAYMENT_RETURN_URL
+        },
+        "capture": True,
+        "description": "Пополнение баланса",
+        "receipt": {
+            "customer": {
+                "full_name": full_name,
+                "email": f"{tg_id}@solo.net",
+                "phone": "79000000000"
+            },
+            "items": [
+                {
+                    "description": "Пополнение баланса",
+                    "quantity": "1.00",
+                    "amount": {
+                        "value": str(amount),
+                        "currency": "RUB"
+                    },
+                    "vat_code": 6
+                }
+            ]
+        },
+        "metadata": {
+            "user_id": tg_id
+        }
+    }
+
+
+if PAYMENT_GATEWAY_BACKEND == 'local':
+    gateway = LocalPaymentGateway()
+else:
+    gateway = YooKassaGateway(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+
+import asyncpg
+
+import config
+from config import DATABASE_URL
+from metrics import gauge, histogram
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_INBOX_WORKERS = getattr(config, 'PAYMENT_INBOX_WORKERS', 2)
+PAYMENT_INBOX_BATCH_SIZE = getattr(config, 'PAYMENT_INBOX_BATCH_SIZE', 10)
+PAYMENT_INBOX_MAX_ATTEMPTS = getattr(config, 'PAYMENT_INBOX_MAX_ATTEMPTS', 10)
+PAYMENT_INBOX_POLL_INTERVAL = getattr(config, 'PAYMENT_INBOX_POLL_INTERVAL', 1.0)
+PAYMENT_INBOX_LEASE_SECONDS = 60
+
+inbox_depth = gauge('payment_inbox_depth', 'Количество необработанных событий платежей')
+inbox_oldest_age = gauge('payment_inbox_oldest_age_seconds', 'Возраст самого старого необработанного события')
+inbox_lag = histogram('payment_inbox_lag_seconds', 'Время от получения вебхука до обработки события')
+
+_wakeup = asyncio.Event()
+_workers = set()
+
+
+async def store_payment_event(payment_id: str, event: str, payload: dict) -> bool:
+    """
+    Сохраняет событие платежа во входящую очередь.
+
+    Повторная доставка того же события (payment_id, event) игнорируется.
+
+    :param payment_id: ID платежа в ЮKassa.
+    :param event: Тип события, например payment.succeeded.
+    :param payload: Тело вебхука.
+    :return: True, если событие сохранено; False, если оно уже было в очереди.
+    """
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        event_id = await conn.fetchval('''
+            INSERT INTO payment_inbox (payment_id, event, payload)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (payment_id, event) DO NOTHING
+            RETURNING id
+        ''', payment_id, event, json.dumps(payload))
+    finally:
+        await conn.close()
+
+    _wakeup.set()
+    return event_id is not None
+
+
+async def _claim_batch(conn):
+    """
+    Забирает пачку готовых к обработке событий и продлевает их аренду (см. outbox._claim_batch).
+    """
+    return await conn.fetch('''
+        UPDATE payment_inbox
+        SET attempts = attempts + 1,
+            next_attempt_at = now() + make_interval(secs => $2)
+        WHERE id IN (
+            SELECT id FROM payment_inbox
+            WHERE status = 'pending' AND next_attempt_at <= now()
+            ORDER BY id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, payload, attempts, extract(epoch FROM now() - received_at) AS lag
+    ''', PAYMENT_INBOX_BATCH_SIZE, PAYMENT_INBOX_LEASE_SECONDS)
+
+
+async def _process(conn, record, handler):
+    """
+    Обрабатывает одно событие. Действия обработчика и отметка о выполнении фиксируются одной транзакцией.
+    """
+    try:
+        async with conn.transaction():
+            await handler(conn, json.loads(record['payload']))
+            await conn.execute('''
+                UPDATE payment_inbox SET status = 'done', processed_at = now(), last_error = NULL WHERE id = $1
+            ''', record['id'])
+        inbox_lag.observe(float(record['lag']))
+    except Exception as e:
+        if record['attempts'] >= PAYMENT_INBOX_MAX_ATTEMPTS:
+            status = 'failed'
+            logger.error(f"Событие платежа {record['id']} не обработано: {e}")
+        else:
+            status = 'pending'
+            logger.warning(f"Ошибка при обработке события платежа {record['id']}, повтор позже: {e}")
+        await conn.execute('''
+            UPDATE payment_inbox
+            SET status = $2, last_error = $3, next_attempt_at = now() + make_interval(secs => $4)
+            WHERE id = $1
+        ''', record['id'], status, str(e), float(min(2 ** record['attempts'], 600)))
+        return
+
+
+async def _update_stats(conn):
+    depth, oldest_age = await conn.fetchrow('''
+        SELECT count(*), coalesce(extract(epoch FROM now() - min(received_at)), 0)
+        FROM payment_inbox
+        WHERE status = 'pending'
+    ''')
+    inbox_depth.set(depth)
+    inbox_oldest_age.set(float(oldest_age))
+
+
+async def payment_inbox_worker(handler, worker_id: int):
+    """
+    Воркер, который разбирает входящую очередь событий платежей.
+
+    :param handler: Корутина handler(conn, event), применяющая событие в транзакции соединения conn.
+                    Может вернуть функцию без аргументов, которая вызывается после фиксации транзакции.
+    :param worker_id: Номер воркера (используется в логах).
+    """
+    conn = None
+    while True:
+        try:
+            if conn is None or conn.is_closed():
+                conn = await asyncpg.connect(DATABASE_URL)
+
+            records = await _claim_batch(conn)
+            # Статистика обновляется на каждой итерации, а не только в простое: под нагрузкой она нужнее всего.
+            await _update_stats(conn)
+            if not records:
+                _wakeup.clear()
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=PAYMENT_INBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for record in records:
+                await _process(conn, record, handler)
+
+        except asyncio.CancelledError:
+            if conn is not None:
+                await conn.close()
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка в воркере входящих платежей #{worker_id}: {e}")
+            if conn is not None:
+                await conn.close()
+                conn = None
+            await asyncio.sleep(PAYMENT_INBOX_POLL_INTERVAL)
+
+
+def start_payment_inbox_workers(handler):
+    """
+    Запускает пул воркеров входящей очереди платежей.
+
+    :param handler: Корутина handler(conn, event), применяющая событие платежа.
+    """
+    for worker_id in range(PAYMENT_INBOX_WORKERS):
+        task = asyncio.create_task(payment_inbox_worker(handler, worker_id))
+        _workers.add(task)
+        task.add_done_callback(_workers.discard)
@@ -0,0 +1,87 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+
+import config
+from config import ADMIN_ID, DATABASE_URL
+from handlers.pay import apply_payment_event, parse_payment_event
+from outbox import enqueue_message
+from payment_gateway import gateway
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_RECONCILE_INTERVAL = getattr(config, 'PAYMENT_RECONCILE_INTERVAL', 900)
+PAYMENT_RECONCILE_WINDOW_HOURS = getattr(config, 'PAYMENT_RECONCILE_WINDOW_HOURS', 48)
+
+FINAL_STATUSES = ('succeeded', 'canceled')
+
+
+async def _fetch_local_statuses(conn, payment_ids: list) -> dict:
+    records = await conn.fetch('''
+        SELECT payment_id, status FROM payments WHERE payment_id = ANY($1::text[])
+    ''', payment_ids)
+    return {record['payment_id']: record['status'] for record in records}
+
+
+async def reconcile_payments():
+    """
+    Сверяет платежи ЮKassa за последние PAYMENT_RECONCILE_WINDOW_HOURS часов с таблицей payments.
+
+    Платежи запрашиваются у шлюза постранично, каждая страница сверяется с базой одним запросом.
+    Успешный платеж, который не был зачислен (например, бот был недоступен, пока ЮKassa повторяла
+    вебхук), применяется так же, как событие вебхука: apply_payment_event идемпотентна, поэтому
+    сверка не зачислит платеж повторно, даже если вебхук придет одновременно с ней.
+    Отмененные платежи также переводятся в статус canceled. Об исправленных платежах
+    администратор получает сводку.
+    """
+    since = datetime.now(timezone.utc) - timedelta(hours=PAYMENT_RECONCILE_WINDOW_HOURS)
+    checked = 0
+    credited = []
+    canceled = 0
+
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        async for page in gateway.list_payments(since):
+            final = [payment for payment in page if payment.get('status') in FINAL_STATUSES]
+            checked += len(page)
+            if not final:
+                continue
+
+            local_statuses = await _fetch_local_statuses(conn, [payment['id'] for payment in final])
+            for payment in final:
+                local_status = local_statuses.get(payment['id'])
+                if local_status == payment['status'] or local_status == 'succeeded':
+                    continue
+
+                event = {'event': f"payment.{payment['status']}", 'object': payment}
+                try:
+                    payment_id, user_id, amount = parse_payment_event(event)
+                except ValueError as e:
+                    logger.warning(f"Платеж {payment.get('id')} пропущен при сверке: {e}")
+                    continue
+
+                async with conn.transaction():
+                    applied = await apply_payment_event(conn, event)
+
+                if payment['status'] == 'succeeded':
+                    # False - платеж успели зачислить вебхук или воркер входящей очереди, пока шла сверка
+                    if not applied:
+                        continue
+                    logger.warning(f"Сверка: зачислен пропущенный платеж {payment_id} "
+                                   f"пользователю {user_id} на {amount} руб.")
+                    credited.append((payment_id, user_id, amount))
+                else:
+                    canceled += 1
+    finally:
+        await conn.close()
+
+    logger.info(f"Сверка платежей: проверено {checked}, зачислено {len(credited)}, отменено {canceled}.")
+
+    if credited:
+        lines = [f"• {payment_id}: пользователь {user_id}, {amount} руб." for payment_id, user_id, amount in credited]
+        await enqueue_message(
+            ADMIN_ID,
+            f"Сверка платежей: зачислено {len(credited)} пропущенных платежей на сумму "
+            f"{sum(amount for _, _, amount in credited)} руб.\n" + "\n".join(lines)
+        )
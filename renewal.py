@@ -0,0 +1,79 @@
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import asyncpg
+
+from auth import login_with_credentials
+from client import extend_client_key
+from config import ADMIN_PASSWORD, ADMIN_USERNAME
+from database import update_balance
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def renewal_lock(conn: asyncpg.Connection, tg_id: int):
+    """
+    Рекомендательная блокировка продления ключей пользователя.
+
+    Ее берут все пути продления: кнопки продления, продление после оплаты и ежечасная проверка
+    истекших ключей. Под блокировкой ключи нужно перечитать: пока она ожидалась, их мог продлить
+    другой путь, и тогда старый срок действия уже неверен.
+
+    :param conn: Соединение, которое держит блокировку.
+    :param tg_id: ID пользователя в Telegram.
+    """
+    lock_key = f'renew_keys:{tg_id}'
+    await conn.execute('SELECT pg_advisory_lock(hashtext($1))', lock_key)
+    try:
+        yield
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock(hashtext($1))', lock_key)
+
+
+async def extend_keys(conn: asyncpg.Connection, tg_id: int, records, days: int, price: float) -> list:
+    """
+    Продлевает ключи на панелях и списывает оплату. Вызывается под renewal_lock с записями,
+    перечитанными под ней.
+
+    В панели каждого сервера выполняется один вход на все ключи этого сервера. Новый срок ключа
+    и списание price с баланса фиксируются одной транзакцией на соединении conn и только после
+    того, как панель подтвердила продление. Ключи, которые не удалось продлить, пропускаются.
+
+    :param conn: Соединение, которое держит блокировку пользователя.
+    :param tg_id: ID пользователя в Telegram.
+    :param records: Записи ключей с полями client_id, email, expiry_time и server_id.
+    :param days: На сколько дней продлить ключ от текущего срока (или от текущего времени, если ключ истек).
+    :param price: Стоимость продления одного ключа.
+    :return: Список пар (запись ключа, новое время истечения в миллисекундах) продленных ключей.
+    """
+    current_time = int(datetime.utcnow().timestamp() * 1000)
+    servers = {}
+    for record in records:
+        servers.setdefault(record['server_id'], []).append(record)
+
+    renewed = []
+    for server_id, server_records in servers.items():
+        try:
+            session = await login_with_credentials(server_id, ADMIN_USERNAME, ADMIN_PASSWORD)
+        except Exception as e:
+            logger.error(f"Не удалось войти в панель {server_id} для продления ключей {tg_id}: {e}")
+            continue
+        try:
+            for record in server_records:
+                new_expiry_time = max(record['expiry_time'], current_time) + days * 86400 * 1000
+                success = await extend_client_key(session, server_id, tg_id, record['client_id'],
+                                                  record['email'], new_expiry_time)
+                if not success:
+                    logger.error(f"Не удалось продлить ключ {record['client_id']} пользователя {tg_id}.")
+                    continue
+                async with conn.transaction():
+                    await conn.execute('''
+                        UPDATE keys SET expiry_time = $1, reminder_sent_hours = NULL WHERE client_id = $2
+                    ''', new_expiry_time, record['client_id'])
+                    await update_balance(tg_id, -price, conn=conn)
+                renewed.append((record, new_expiry_time))
+        finally:
+            await session.close()
+    return renewed
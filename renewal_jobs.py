@@ -0,0 +1,138 @@
+import asyncio
+import logging
+
+import asyncpg
+
+import config
+from config import DATABASE_URL
+from handlers.notifications import renew_user_keys
+from metrics import gauge, histogram
+
+logger = logging.getLogger(__name__)
+
+RENEWAL_JOB_WORKERS = getattr(config, 'RENEWAL_JOB_WORKERS', 1)
+RENEWAL_JOB_BATCH_SIZE = getattr(config, 'RENEWAL_JOB_BATCH_SIZE', 10)
+RENEWAL_JOB_MAX_ATTEMPTS = getattr(config, 'RENEWAL_JOB_MAX_ATTEMPTS', 10)
+RENEWAL_JOB_POLL_INTERVAL = getattr(config, 'RENEWAL_JOB_POLL_INTERVAL', 1.0)
+RENEWAL_JOB_LEASE_SECONDS = 300
+
+renewal_jobs_lag = histogram('renewal_jobs_lag_seconds', 'Время от зачисления платежа до продления ключей')
+
+_wakeup = asyncio.Event()
+_workers = set()
+_pending = 0
+
+gauge('renewal_jobs_pending', 'Количество ожидающих заданий продления ключей', func=lambda: _pending)
+
+
+async def enqueue_renewal(tg_id: int, conn):
+    """
+    Ставит задание продлить ключи пользователя после зачисления платежа.
+
+    Вызывается в транзакции зачисления, поэтому задание появляется тогда и только тогда, когда
+    платеж зачислен. На пользователя хранится одно задание: повторный платеж, пока задание еще
+    не выполнено, только переносит его на сейчас и сбрасывает счетчик попыток.
+
+    :param tg_id: ID пользователя в Telegram.
+    :param conn: Соединение с открытой транзакцией зачисления.
+    """
+    await conn.execute('''
+        INSERT INTO renewal_jobs (tg_id) VALUES ($1)
+        ON CONFLICT (tg_id) DO UPDATE
+        SET status = 'pending', attempts = 0, requested_at = now(), next_attempt_at = now(), last_error = NULL
+    ''', tg_id)
+    _wakeup.set()
+
+
+async def _claim_batch(conn):
+    """
+    Забирает пачку готовых заданий и продлевает их аренду (см. outbox._claim_batch).
+    """
+    return await conn.fetch('''
+        UPDATE renewal_jobs
+        SET attempts = attempts + 1,
+            next_attempt_at = now() + make_interval(secs => $2)
+        WHERE tg_id IN (
+            SELECT tg_id FROM renewal_jobs
+            WHERE status = 'pending' AND next_attempt_at <= now()
+            ORDER BY next_attempt_at
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING tg_id, attempts, requested_at, extract(epoch FROM now() - requested_at) AS lag
+    ''', RENEWAL_JOB_BATCH_SIZE, RENEWAL_JOB_LEASE_SECONDS)
+
+
+async def _process(conn, record):
+    """
+    Выполняет одно задание. Условие requested_at не дает затереть задание, которое поставил
+    новый платеж, пока выполнялось это.
+    """
+    tg_id = record['tg_id']
+    try:
+        await renew_user_keys(tg_id)
+    except Exception as e:
+        if record['attempts'] >= RENEWAL_JOB_MAX_ATTEMPTS:
+            status = 'failed'
+            logger.error(f"Ключи пользователя {tg_id} не продлены после оплаты: {e}")
+        else:
+            status = 'pending'
+            logger.warning(f"Ошибка при продлении ключей пользователя {tg_id} после оплаты, повтор позже: {e}")
+        await conn.execute('''
+            UPDATE renewal_jobs
+            SET status = $3, last_error = $4, next_attempt_at = now() + make_interval(secs => $5)
+            WHERE tg_id = $1 AND requested_at = $2
+        ''', tg_id, record['requested_at'], status, str(e), float(min(2 ** record['attempts'], 600)))
+        return
+
+    await conn.execute('DELETE FROM renewal_jobs WHERE tg_id = $1 AND requested_at = $2',
+                       tg_id, record['requested_at'])
+    renewal_jobs_lag.observe(float(record['lag']))
+
+
+async def renewal_job_worker(worker_id: int):
+    """
+    Воркер, который разбирает очередь заданий продления ключей.
+
+    :param worker_id: Номер воркера (используется в логах).
+    """
+    global _pending
+    conn = None
+    while True:
+        try:
+            if conn is None or conn.is_closed():
+                conn = await asyncpg.connect(DATABASE_URL)
+
+            records = await _claim_batch(conn)
+            _pending = await conn.fetchval("SELECT count(*) FROM renewal_jobs WHERE status = 'pending'")
+            if not records:
+                _wakeup.clear()
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=RENEWAL_JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for record in records:
+                await _process(conn, record)
+
+        except asyncio.CancelledError:
+            if conn is not None:
+                await conn.close()
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка в воркере продления ключей #{worker_id}: {e}")
+            if conn is not None:
+                await conn.close()
+                conn = None
+            await asyncio.sleep(RENEWAL_JOB_POLL_INTERVAL)
+
+
+def start_renewal_workers():
+    """
+    Запускает пул воркеров очереди продления ключей.
+    """
+    for worker_id in range(RENEWAL_JOB_WORKERS):
+        task = asyncio.create_task(renewal_job_worker(worker_id))
+        _workers.add(task)
+        task.add_done_callback(_workers.discard)
@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+from datetime import datetime, timedelta
+
+import asyncpg
+
+from config import DATABASE_URL
+from leader import run_as_leader
+
+logger = logging.getLogger(__name__)
+
+REPLICA_NAME = f"{socket.gethostname()}:{os.getpid()}"
+RESTART_DELAY = 10
+
+
+class IntervalSpec:
+    """
+    Расписание "каждые N секунд". Моменты запуска отсчитываются от первого запуска,
+    поэтому время выполнения задачи не накапливается в сдвиг расписания.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def next_run(self, previous: datetime) -> datetime:
+        return previous + timedelta(seconds=self.seconds)
+
+    def __str__(self):
+        return f"every {self.seconds}s"
+
+
+class CronSpec:
+    """
+    Расписание в формате cron из пяти полей: минута, час, день месяца, месяц, день недели.
+
+    Поддерживаются `*`, списки `a,b`, диапазоны `a-b` и шаг `*/n` или `a-b/n`.
+    День недели: 0 или 7 - воскресенье. Время задается в UTC.
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Некорректное cron-выражение: {expression}")
+
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse_field(part, low, high) for part, (low, high) in zip(parts, self.FIELDS)
+        )
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int) -> set:
+        values = set()
+        for item in field.split(','):
+            step = 1
+            if '/' in item:
+                item, step = item.split('/')
+                step = int(step)
+            if item == '*':
+                start, end = low, high
+            elif '-' in item:
+                start, end = (int(value) for value in item.split('-'))
+            else:
+                start = end = int(item)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Некорректное поле cron: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.isoweekday() % 7) in self.weekdays
+        if self.any_day:
+            return weekday_ok
+        if self.any_weekday:
+            return day_ok
+        return day_ok or weekday_ok
+
+    def next_run(self, previous: datetime) -> datetime:
+        moment = previous.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                month = moment.month % 12 + 1
+                moment = moment.replace(year=moment.year + (month == 1), month=month, day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron-выражение {self.expression} не дает ни одного запуска")
+
+    def __str__(self):
+        return f"cron '{self.expression}'"
+
+
+class Job:
+    """
+    Периодическая задача планировщика.
+
+    :param name: str - Уникальное имя задачи (используется в job_runs и как ключ блокировки лидера).
+    :param func: Функция без аргументов, возвращающая корутину одного запуска.
+    :param spec: IntervalSpec или CronSpec.
+    :param jitter: float - Случайная задержка запуска от 0 до jitter секунд.
+    :param timeout: float - (необязательно) Максимальная длительность одного запуска.
+    :param singleton: bool - Выполнять задачу только на реплике-лидере.
+    :param run_at_start: bool - Для IntervalSpec: выполнить первый запуск сразу после старта.
+    """
+
+    def __init__(self, name: str, func, spec, jitter: float = 0, timeout: float = None,
+                 singleton: bool = True, run_at_start: bool = True):
+        self.name = name
+        self.func = func
+        self.spec = spec
+        self.jitter = jitter
+        self.timeout = timeout
+        self.singleton = singleton
+        self.run_at_start = run_at_start
+
+
+async def _record_run(job: Job):
+    """
+    Выполняет один запуск задачи и записывает его в таблицу job_runs.
+    """
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        run_id = await conn.fetchval('''
+            INSERT INTO job_runs (job_name, replica, started_at, status)
+            VALUES ($1, $2, now(), 'running')
+            RETURNING id
+        ''', job.name, REPLICA_NAME)
+    finally:
+        await conn.close()
+
+    started = time.monotonic()
+    status, error = 'success', None
+    try:
+        if job.timeout:
+            await asyncio.wait_for(job.func(), timeout=job.timeout)
+        else:
+            await job.func()
+    except asyncio.TimeoutError:
+        status, error = 'timeout', f"Превышено время выполнения {job.timeout} с"
+    except asyncio.CancelledError:
+        status, error = 'cancelled', None
+        raise
+    except Exception as e:
+        status, error = 'error', repr(e)
+    finally:
+        duration_ms = int((time.monotonic() - started) * 1000)
+        log = logger.info if status == 'success' else logger.error
+        log(f"Задача {job.name}: {status} за {duration_ms} мс{f' ({error})' if error else ''}")
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            await conn.execute('''
+                UPDATE job_runs
+                SET finished_at = now(), duration_ms = $2, status = $3, error = $4
+                WHERE id = $1
+            ''', run_id, duration_ms, status, error)
+        finally:
+            await conn.close()
+
+
+async def _job_loop(job: Job):
+    """
+    Цикл запусков одной задачи.
+
+    Запуски выполняются последовательно, поэтому одна задача никогда не пересекается сама с собой.
+    Если запуск длился дольше периода, пропущенные моменты не догоняются: следующий запуск
+    назначается на ближайший момент расписания в будущем.
+    """
+    now = datetime.utcnow()
+    if isinstance(job.spec, IntervalSpec) and job.run_at_start:
+        scheduled = now
+    else:
+        scheduled = job.spec.next_run(now)
+
+    while True:
+        delay = (scheduled - datetime.utcnow()).total_seconds() + random.uniform(0, job.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        try:
+            await _record_run(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Не удалось записать запуск задачи {job.name}: {e}")
+
+        now = datetime.utcnow()
+        scheduled = job.spec.next_run(scheduled)
+        while scheduled <= now:
+            scheduled = job.spec.next_run(scheduled)
+
+
+class Scheduler:
+    """
+    Планировщик периодических задач с супервизией.
+
+    Каждая задача выполняется в собственной asyncio-задаче; если она завершилась из-за
+    непредвиденной ошибки, планировщик перезапускает ее через RESTART_DELAY секунд.
+    Задачи с singleton=True выполняются только на реплике-лидере (см. leader.run_as_leader).
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.tasks = {}
+
+    def add_job(self, name: str, func, spec, **kwargs) -> Job:
+        if name in self.jobs:
+            raise ValueError(f"Задача {name} уже зарегистрирована")
+        job = Job(name, func, spec, **kwargs)
+        self.jobs[name] = job
+        return job
+
+    def every(self, seconds: float, name: str, func, **kwargs) -> Job:
+        return self.add_job(name, func, IntervalSpec(seconds), **kwargs)
+
+    def cron(self, expression: str, name: str, func, **kwargs) -> Job:
+        return self.add_job(name, func, CronSpec(expression), **kwargs)
+
+    def start(self):
+        for job in self.jobs.values():
+            self._start_job(job)
+
+    def _start_job(self, job: Job):
+        if job.singleton:
+            task = asyncio.create_task(run_as_leader(f"job:{job.name}", lambda: _job_loop(job)))
+        else:
+            task = asyncio.create_task(_job_loop(job))
+        self.tasks[job.name] = task
+        task.add_done_callback(lambda finished: self._on_done(job, finished))
+
+    def _on_done(self, job: Job, task: asyncio.Task):
+        if task.cancelled():
+            return
+        logger.error(f"Задача {job.name} неожиданно остановилась: {task.exception()!r}, перезапуск "
+                     f"через {RESTART_DELAY} с.")
+        asyncio.get_running_loop().call_later(RESTART_DELAY, self._start_job, job)
+
+    async def stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
+
+
+scheduler = Scheduler()
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup, Message
+
+import config
+from media import edit_photo, file_digest, send_photo
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+SCREEN_CACHE_SIZE = getattr(config, 'SCREEN_CACHE_SIZE', 10000)
+
+screens_rendered = counter('screens_rendered_total', 'Экраны, показанные изменением сообщения')
+screens_skipped = counter('screens_skipped_total', 'Экраны, не изменившиеся с прошлого показа')
+screens_resent = counter('screens_resent_total', 'Экраны, которые пришлось отправить новым сообщением')
+
+_hashes = OrderedDict()
+
+
+def _content_hash(text: str, reply_markup, photo_digest, parse_mode) -> str:
+    markup = reply_markup.model_dump(exclude_none=True) if reply_markup else None
+    payload = json.dumps([text, parse_mode, photo_digest, markup], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _remember(chat_id: int, message_id: int, content_hash: str, result=None):
+    key = (chat_id, message_id)
+    _hashes[key] = (content_hash, result.edit_date if isinstance(result, Message) else None)
+    _hashes.move_to_end(key)
+    while len(_hashes) > SCREEN_CACHE_SIZE:
+        _hashes.popitem(last=False)
+
+
+async def render_screen(callback_query: CallbackQuery, text: str, reply_markup: InlineKeyboardMarkup = None,
+                        photo: str = None, parse_mode: str = 'HTML'):
+    """
+    Показывает экран в сообщении, на кнопку которого нажал пользователь.
+
+    Сообщение изменяется на месте: текст через edit_message_text, изображение с подписью через
+    edit_message_media. Если содержимое экрана (текст, клавиатура, изображение) совпадает с
+    показанным в этом сообщении в прошлый раз, и с тех пор сообщение не менялось (совпадают
+    время последнего изменения и клавиатура), запрос к Telegram не выполняется. Новое сообщение
+    отправляется (а старое удаляется), только если изменить старое нельзя: экран с изображением
+    нужно показать вместо текста или наоборот, сообщение слишком старое или не принадлежит боту.
+
+    :param callback_query: Нажатие кнопки.
+    :param text: Текст экрана (для экрана с изображением - подпись).
+    :param reply_markup: Клавиатура экрана.
+    :param photo: Путь к изображению экрана.
+    :param parse_mode: Режим разметки текста.
+    :return: Сообщение, в котором показан экран.
+    """
+    message = callback_query.message
+    bot = message.bot
+    chat_id = message.chat.id
+    content_hash = _content_hash(text, reply_markup, file_digest(photo) if photo else None, parse_mode)
+
+    unchanged = (isinstance(message, Message)
+                 and _hashes.get((chat_id, message.message_id)) == (content_hash, message.edit_date)
+                 and message.reply_markup == reply_markup)
+    if unchanged:
+        screens_skipped.inc()
+        return message
+
+    editable = (isinstance(message, Message) and message.from_user is not None and message.from_user.is_bot
+                and bool(message.photo) == bool(photo))
+    if editable:
+        try:
+            if photo:
+                result = await edit_photo(bot, chat_id, message.message_id, photo, caption=text,
+                                          parse_mode=parse_mode, reply_markup=reply_markup)
+            else:
+                result = await bot.edit_message_text(text, chat_id=chat_id, message_id=message.message_id,
+                                                     parse_mode=parse_mode, reply_markup=reply_markup)
+            screens_rendered.inc()
+            _remember(chat_id, message.message_id, content_hash, result)
+            return message
+        except TelegramBadRequest as e:
+            if 'message is not modified' in str(e):
+                screens_skipped.inc()
+                _remember(chat_id, message.message_id, content_hash, message)
+                return message
+            logger.info(f"Сообщение {message.message_id} в чате {chat_id} не изменить, экран будет отправлен заново: {e}")
+
+    if photo:
+        sent = await send_photo(bot, chat_id, photo, caption=text, parse_mode=parse_mode, reply_markup=reply_markup)
+    else:
+        sent = await bot.send_message(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+    screens_resent.inc()
+    _remember(chat_id, sent.message_id, content_hash, sent)
+
+    try:
+        await message.delete()
+    except TelegramBadRequest as e:
+        logger.info(f"Не удалось удалить сообщение {message.message_id} в чате {chat_id}: {e}")
+    _hashes.pop((chat_id, message.message_id), None)
+    return sent
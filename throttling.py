@@ -0,0 +1,157 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+
+import config
+from callback_router import callbacks
+from metrics import counter, gauge
+
+THROTTLE_RATE = getattr(config, 'THROTTLE_RATE', 2.0)
+THROTTLE_BURST = getattr(config, 'THROTTLE_BURST', 5)
+USER_LOCKS_MAX_ENTRIES = getattr(config, 'USER_LOCKS_MAX_ENTRIES', 10000)
+USER_LOCK_IDLE_TTL = getattr(config, 'USER_LOCK_IDLE_TTL', 600)
+
+# Действия кнопок, которые списывают баланс, создают платежи или меняют ключи на панели.
+MUTATING_ACTIONS = frozenset({
+    'amount', 'confirm_create_new_key', 'confirm_delete', 'confirm_delete_admin', 'connect_vpn',
+    'move_key', 'renew_all', 'renew_plan',
+})
+
+throttled_updates = counter('throttled_updates_total', 'Обновления, отброшенные из-за превышения частоты запросов')
+duplicate_callbacks = counter('duplicate_callbacks_total', 'Повторные нажатия кнопки, пока первое еще обрабатывается')
+
+
+class _UserSlot:
+    __slots__ = ('lock', 'tokens', 'updated_at', 'in_flight', 'refs', 'touched_at')
+
+    def __init__(self, burst: float, now: float):
+        self.lock = asyncio.Lock()
+        self.tokens = burst
+        self.updated_at = now
+        self.in_flight = set()
+        self.refs = 0
+        self.touched_at = now
+
+    def take_token(self, rate: float, burst: float, now: float) -> bool:
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class UserLockRegistry:
+    """
+    Реестр блокировок и счетчиков частоты запросов по tg_id.
+
+    Записи лежат в OrderedDict в порядке последнего обращения. Запись удаляется, если к ней
+    не обращались idle_ttl секунд или если записей больше max_entries, но только когда
+    по ней не выполняется ни один обработчик.
+    """
+
+    def __init__(self, max_entries: int = USER_LOCKS_MAX_ENTRIES, idle_ttl: float = USER_LOCK_IDLE_TTL,
+                 burst: float = THROTTLE_BURST):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.burst = burst
+        self.slots = OrderedDict()
+        gauge('user_locks_entries', 'Количество пользователей в реестре блокировок', func=lambda: len(self.slots))
+
+    def _evict(self, now: float):
+        for _ in range(len(self.slots)):
+            tg_id, slot = next(iter(self.slots.items()))
+            if len(self.slots) <= self.max_entries and now - slot.touched_at < self.idle_ttl:
+                break
+            if slot.refs:
+                self.slots.move_to_end(tg_id)
+                continue
+            self.slots.popitem(last=False)
+
+    def acquire(self, tg_id: int) -> _UserSlot:
+        """Возвращает запись пользователя и помечает ее занятой до вызова release."""
+        now = time.monotonic()
+        slot = self.slots.get(tg_id)
+        if slot is None:
+            slot = self.slots[tg_id] = _UserSlot(self.burst, now)
+        else:
+            self.slots.move_to_end(tg_id)
+        slot.refs += 1
+        slot.touched_at = now
+        self._evict(now)
+        return slot
+
+    def release(self, tg_id: int, slot: _UserSlot):
+        slot.refs -= 1
+        slot.touched_at = time.monotonic()
+        if self.slots.get(tg_id) is slot:
+            self.slots.move_to_end(tg_id)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту запросов пользователя и схлопывает повторные нажатия.
+
+    - Каждому пользователю доступно не больше THROTTLE_RATE обновлений в секунду с запасом
+      THROTTLE_BURST. Лишние обновления отбрасываются, на нажатие кнопки бот отвечает подсказкой.
+    - Нажатие кнопки с теми же данными, пока первое нажатие еще обрабатывается, отбрасывается.
+    - Сообщения и кнопки из MUTATING_ACTIONS одного пользователя выполняются по очереди,
+      поэтому двойное нажатие не спишет баланс дважды и не создаст два ключа.
+
+    Блокировки живут в памяти процесса. При WEB_WORKERS > 1 обновления одного пользователя
+    могут попасть в разные процессы, и тогда очередь соблюдается только внутри процесса.
+    """
+
+    def __init__(self, registry: UserLockRegistry = None, rate: float = THROTTLE_RATE,
+                 burst: float = THROTTLE_BURST):
+        self.registry = registry or UserLockRegistry(burst=burst)
+        self.rate = rate
+        self.burst = burst
+
+    @staticmethod
+    def _is_mutating(event: TelegramObject) -> bool:
+        if not isinstance(event, CallbackQuery):
+            return True
+        resolved = callbacks.resolve(event.data or '')
+        return resolved is not None and resolved[0].action in MUTATING_ACTIONS
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        slot = self.registry.acquire(user.id)
+        try:
+            if not slot.take_token(self.rate, self.burst, time.monotonic()):
+                throttled_updates.inc()
+                if isinstance(event, CallbackQuery):
+                    await event.answer("Слишком много запросов, подождите немного.")
+                return None
+
+            in_flight_key = event.data if isinstance(event, CallbackQuery) else None
+            if in_flight_key is not None:
+                if in_flight_key in slot.in_flight:
+                    duplicate_callbacks.inc()
+                    await event.answer("Запрос уже обрабатывается.")
+                    return None
+                slot.in_flight.add(in_flight_key)
+
+            try:
+                if self._is_mutating(event):
+                    async with slot.lock:
+                        return await handler(event, data)
+                return await handler(event, data)
+            finally:
+                if in_flight_key is not None:
+                    slot.in_flight.discard(in_flight_key)
+        finally:
+            self.registry.release(user.id, slot)
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import asyncpg
+
+import config
+from config import DATABASE_URL
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+UPDATE_DEDUP_MAX_ENTRIES = getattr(config, 'UPDATE_DEDUP_MAX_ENTRIES', 10000)
+UPDATE_DEDUP_SHARED = getattr(config, 'UPDATE_DEDUP_SHARED', getattr(config, 'WEB_WORKERS', 1) > 1)
+# Telegram хранит недоставленные обновления не дольше суток, дольше помнить update_id незачем.
+UPDATE_DEDUP_TTL = 86400
+UPDATE_DEDUP_CLEANUP_INTERVAL = 600
+
+duplicate_updates = counter('webhook_updates_duplicate_total', 'Повторно доставленные обновления, отброшенные до обработки')
+
+
+class UpdateDeduplicator:
+    """
+    Отбрасывает обновления, которые Telegram доставил повторно.
+
+    Если вебхук ответил слишком поздно или с ошибкой, Telegram присылает то же обновление еще раз,
+    и обработчики с побочными эффектами (создание и продление ключей) выполнились бы дважды.
+    Последние max_entries update_id хранятся в памяти процесса. При shared update_id
+    дополнительно записываются в таблицу processed_updates, чтобы повтор, попавший в другой
+    процесс (WEB_WORKERS > 1), тоже был отброшен. Если база недоступна, обновление
+    обрабатывается: лучше повтор, чем потерянное обновление.
+    """
+
+    def __init__(self, max_entries: int = UPDATE_DEDUP_MAX_ENTRIES, shared: bool = UPDATE_DEDUP_SHARED,
+                 dsn: str = DATABASE_URL):
+        self.max_entries = max_entries
+        self.shared = shared
+        self.dsn = dsn
+        self.seen = OrderedDict()
+        self.pool = None
+        self._pool_lock = asyncio.Lock()
+        self._last_cleanup = time.monotonic()
+
+    async def _get_pool(self):
+        async with self._pool_lock:
+            if self.pool is None:
+                self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=2)
+        return self.pool
+
+    async def _claim_shared(self, update_id: int) -> bool:
+        try:
+            pool = await self._get_pool()
+            claimed = await pool.fetchval('''
+                INSERT INTO processed_updates (update_id) VALUES ($1)
+                ON CONFLICT (update_id) DO NOTHING
+                RETURNING update_id
+            ''', update_id)
+            if time.monotonic() - self._last_cleanup > UPDATE_DEDUP_CLEANUP_INTERVAL:
+                self._last_cleanup = time.monotonic()
+                await pool.execute('''
+                    DELETE FROM processed_updates WHERE received_at < now() - make_interval(secs => $1)
+                ''', float(UPDATE_DEDUP_TTL))
+        except Exception as e:
+            logger.error(f"Ошибка при проверке повтора обновления {update_id}: {e}")
+            return True
+        return claimed is not None
+
+    async def claim(self, update_id: int) -> bool:
+        """
+        Отмечает обновление как принятое.
+
+        :param update_id: ID обновления.
+        :return: True, если обновление пришло впервые и его нужно обработать, False для повтора.
+        """
+        if update_id in self.seen:
+            self.seen.move_to_end(update_id)
+            duplicate_updates.inc()
+            return False
+
+        self.seen[update_id] = None
+        while len(self.seen) > self.max_entries:
+            self.seen.popitem(last=False)
+
+        if self.shared and not await self._claim_shared(update_id):
+            duplicate_updates.inc()
+            return False
+        return True
+
+    async def release(self, update_id: int):
+        """
+        Забывает обновление, которое было принято, но не будет обработано (например, вебхук
+        ответил 503), чтобы повторная доставка Telegram не была отброшена.
+
+        :param update_id: ID обновления.
+        """
+        self.seen.pop(update_id, None)
+        if not self.shared:
+            return
+        try:
+            pool = await self._get_pool()
+            await pool.execute('DELETE FROM processed_updates WHERE update_id = $1', update_id)
+        except Exception as e:
+            logger.error(f"Ошибка при удалении отметки обновления {update_id}: {e}")
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+
+deduplicator = UpdateDeduplicator()
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import BaseRequestHandler, SimpleRequestHandler
+from aiohttp import web
+
+import config
+from metrics import counter, gauge, histogram
+from update_dedup import UpdateDeduplicator, deduplicator
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_MODE = getattr(config, 'WEBHOOK_MODE', 'queue')
+WEBHOOK_WORKERS = getattr(config, 'WEBHOOK_WORKERS', 32)
+WEBHOOK_QUEUE_SIZE = getattr(config, 'WEBHOOK_QUEUE_SIZE', 1000)
+WEBHOOK_DRAIN_TIMEOUT = getattr(config, 'WEBHOOK_DRAIN_TIMEOUT', 10)
+WEBHOOK_REPLY_IN_RESPONSE = getattr(config, 'WEBHOOK_REPLY_IN_RESPONSE', False)
+WEBHOOK_REPLY_TIMEOUT = getattr(config, 'WEBHOOK_REPLY_TIMEOUT', 2.0)
+
+queue_wait = histogram('webhook_queue_wait_seconds', 'Время ожидания обновления в очереди вебхука')
+updates_rejected = counter('webhook_updates_rejected_total', 'Обновления, отклоненные с 503 из-за переполнения очереди')
+updates_failed = counter('webhook_updates_failed_total', 'Обновления, обработка которых завершилась ошибкой')
+updates_filtered = counter('webhook_updates_filtered_total', 'Обновления типов, для которых нет обработчиков')
+replies_in_response = counter('webhook_replies_in_response_total', 'Вызовы Bot API, отправленные в ответе на вебхук')
+
+# Telegram присылает update_id первым полем, а за ним поле с типом обновления, поэтому оба
+# можно найти в начале тела без разбора JSON.
+_UPDATE_HEAD = re.compile(rb'^\s*\{\s*"update_id"\s*:\s*(\d+)\s*,\s*"([a-z_]+)"')
+
+
+def peek_update(body: bytes) -> Tuple[Optional[int], Optional[str]]:
+    """
+    Возвращает update_id и тип обновления из тела вебхука без разбора JSON.
+
+    :param body: Тело запроса Telegram.
+    :return: (update_id, тип обновления) или (None, None), если тело начинается иначе.
+    """
+    match = _UPDATE_HEAD.match(body[:128])
+    if match is None:
+        return None, None
+    return int(match.group(1)), match.group(2).decode()
+
+
+class WebhookRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука, который отбрасывает ненужные обновления до разбора JSON.
+
+    - Обновления типов, для которых в диспетчере нет обработчиков (см. resolve_used_update_types),
+      отбрасываются. Telegram и так присылает только их, если вебхук установлен с allowed_updates,
+      но список в Telegram может отставать от кода, например во время обновления бота.
+    - Повторно доставленные обновления отбрасываются по update_id (см. UpdateDeduplicator).
+      Если обновление не удалось обработать и Telegram получит ошибку, отметка снимается,
+      и повторная доставка будет обработана.
+
+    update_id и тип берутся из начала тела запроса, поэтому отброшенное обновление не проходит
+    ни разбор JSON, ни построение моделей, ни обработчики.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, dedup: UpdateDeduplicator = deduplicator, **kwargs: Any):
+        super().__init__(dispatcher=dispatcher, bot=bot, **kwargs)
+        self.dedup = dedup
+        self.allowed_updates = None
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        super().register(app, path=path, **kwargs)
+        app.on_startup.append(self._resolve_allowed_updates)
+
+    async def _resolve_allowed_updates(self, app: web.Application):
+        # Роутеры подключаются к диспетчеру до запуска приложения, поэтому список берется при старте.
+        self.allowed_updates = frozenset(self.dispatcher.resolve_used_update_types())
+
+    async def _claim(self, request: web.Request) -> Tuple[bool, Optional[int]]:
+        """
+        Отмечает обновление запроса как принятое.
+
+        :return: (True, update_id) для обновления, которое нужно обработать,
+                 (False, update_id) для ненужного типа или повтора.
+        """
+        body = await request.read()
+        update_id, update_type = peek_update(body)
+        if update_id is None:
+            update = self.bot.session.json_loads(body)
+            update_id = update.get('update_id')
+            update_type = next((key for key in update if key != 'update_id'), None)
+
+        if self.allowed_updates is not None and update_type not in self.allowed_updates:
+            updates_filtered.inc()
+            return False, update_id
+        if update_id is None:
+            return True, None
+        return await self.dedup.claim(update_id), update_id
+
+    async def _release(self, update_id: Optional[int]):
+        if update_id is not None:
+            await self.dedup.release(update_id)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.bot):
+            return web.Response(body="Unauthorized", status=401)
+
+        accepted, update_id = await self._claim(request)
+        if not accepted:
+            return web.json_response({}, dumps=self.bot.session.json_dumps)
+        try:
+            return await super().handle(request)
+        except Exception:
+            await self._release(update_id)
+            raise
+
+    async def close(self) -> None:
+        await self.dedup.close()
+        await super().close()
+
+    __call__ = handle
+
+
+class QueuedRequestHandler(WebhookRequestHandler):
+    """
+    Обработчик вебхука с ограниченной очередью и пулом воркеров.
+
+    Telegram сразу получает ответ 200, а обновление кладется в очередь размером queue_size,
+    которую разбирают workers воркеров. Одновременно обрабатывается не больше workers
+    обновлений, сколько бы их ни пришло. Если очередь заполнена, вебхук отвечает 503, и Telegram
+    повторит доставку позже. Так нагрузка не превращается в неограниченное число задач.
+    Ненужные и повторно доставленные обновления отбрасываются до постановки в очередь.
+
+    При остановке приложения обработчик ждет до WEBHOOK_DRAIN_TIMEOUT секунд, пока воркеры
+    разберут уже принятые обновления.
+
+    При reply_in_response ответ Telegram откладывается до reply_timeout секунд. Если обработчик
+    за это время вернул вызов Bot API (например, return callback_query.answer()), вызов
+    отправляется в теле ответа на вебхук и не требует отдельного запроса к Telegram. Результат
+    такого вызова Telegram не сообщает, поэтому так стоит возвращать только вызовы, ошибка
+    которых не важна. Если обработчик не успел, ответ уходит пустым, а вызов выполняется
+    обычным запросом.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int = WEBHOOK_WORKERS,
+                 queue_size: int = WEBHOOK_QUEUE_SIZE, reply_in_response: bool = WEBHOOK_REPLY_IN_RESPONSE,
+                 reply_timeout: float = WEBHOOK_REPLY_TIMEOUT, dedup: UpdateDeduplicator = deduplicator, **data: Any):
+        super().__init__(dispatcher=dispatcher, bot=bot, dedup=dedup, handle_in_background=False, **data)
+        self.workers = workers
+        self.reply_in_response = reply_in_response
+        self.reply_timeout = reply_timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.busy = 0
+        self._tasks = set()
+        gauge('webhook_queue_depth', 'Количество обновлений в очереди вебхука', func=self.queue.qsize)
+        gauge('webhook_workers_busy', 'Количество воркеров вебхука, занятых обработкой', func=lambda: self.busy)
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        super().register(app, path=path, **kwargs)
+        app.on_startup.append(self._start)
+        # Очередь должна быть разобрана до остальных обработчиков остановки, которые отменяют задачи.
+        app.on_shutdown.insert(0, self._drain)
+
+    async def _start(self, app: web.Application):
+        for worker_id in range(self.workers):
+            task = asyncio.create_task(self._worker(worker_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            received_at, update, reply = await self.queue.get()
+            queue_wait.observe(time.monotonic() - received_at)
+            self.busy += 1
+            try:
+                result = await self.dispatcher.feed_raw_update(bot=self.bot, update=update, **self.data)
+                if not isinstance(result, TelegramMethod):
+                    result = None
+                if reply is not None and not reply.done():
+                    reply.set_result(result)
+                elif result is not None:
+                    await self.dispatcher.silent_call_request(bot=self.bot, result=result)
+            except Exception as e:
+                if reply is not None and not reply.done():
+                    reply.set_result(None)
+                updates_failed.inc()
+                logger.error(f"Ошибка при обработке обновления {update.get('update_id')} "
+                             f"в воркере вебхука #{worker_id}: {e}")
+            finally:
+                self.busy -= 1
+                self.queue.task_done()
+
+    async def _drain(self, app: web.Application):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Очередь вебхука не разобрана за {WEBHOOK_DRAIN_TIMEOUT} с, "
+                           f"потеряно обновлений: {self.queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.bot):
+            return web.Response(body="Unauthorized", status=401)
+
+        accepted, update_id = await self._claim(request)
+        if not accepted:
+            return web.json_response({}, dumps=self.bot.session.json_dumps)
+
+        update: Dict[str, Any] = await request.json(loads=self.bot.session.json_loads)
+        reply = asyncio.get_running_loop().create_future() if self.reply_in_response else None
+        try:
+            self.queue.put_nowait((time.monotonic(), update, reply))
+        except asyncio.QueueFull:
+            updates_rejected.inc()
+            await self._release(update_id)
+            return web.Response(status=503, headers={'Retry-After': '1'})
+
+        if reply is None:
+            return web.json_response({}, dumps=self.bot.session.json_dumps)
+        return await self._reply(reply)
+
+    async def _reply(self, reply: asyncio.Future) -> web.Response:
+        try:
+            await asyncio.wait_for(asyncio.shield(reply), timeout=self.reply_timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # Если ответ еще не готов, воркер выполнит вызов сам обычным запросом.
+            reply.cancel()
+
+        result = None if reply.cancelled() else reply.result()
+        if result is None:
+            return web.json_response({}, dumps=self.bot.session.json_dumps)
+        replies_in_response.inc()
+        return web.Response(body=self._build_response_writer(bot=self.bot, result=result))
+
+    __call__ = handle
+
+
+def create_request_handler(dispatcher: Dispatcher, bot: Bot, mode: str = WEBHOOK_MODE, **data: Any) -> BaseRequestHandler:
+    """
+    Создает обработчик вебхука по имени из настройки WEBHOOK_MODE.
+
+    :param mode: 'queue' - ограниченная очередь и пул воркеров (по умолчанию),
+                 'background' - отдельная задача на каждое обновление без ограничений,
+                 'inline' - обновление обрабатывается до ответа Telegram.
+    :return: Обработчик, который нужно зарегистрировать в приложении aiohttp.
+    """
+    if mode == 'queue':
+        return QueuedRequestHandler(dispatcher, bot, **data)
+    if mode == 'background':
+        return WebhookRequestHandler(dispatcher, bot, handle_in_background=True, **data)
+    if mode == 'inline':
+        return WebhookRequestHandler(dispatcher, bot, handle_in_background=False, **data)
+    raise ValueError(f"Неизвестный режим вебхука: {mode}")